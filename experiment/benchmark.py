@@ -0,0 +1,277 @@
+""" runs task1 and task2 swarms over a sweep of peer counts and datasets, a number of trials each, and writes
+every trial and percentiles of them as JSON and CSV, see plots/plot_multiple.py for plotting them
+
+    python experiment/benchmark.py --peers 2 6 20 50 --datasets rfcs rfcs_large --trials 5 --output bench
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import queue
+import socket
+import sys
+import time
+from threading import Thread
+
+from p2p.client.client import Peer
+from p2p.client.manifest import Manifest
+from p2p.proto.proto import Message
+from p2p.server.rs import RegistrationServer
+from p2p.server.server import Server
+from p2p.utils.app_constants import RS_HOST, GOAL_RFC_STATE
+from p2p.utils.app_utils import get_true_hostname, logger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATASETS = {'rfcs': os.path.join(ROOT, 'p2p', 'rfcs'),
+            'rfcs_large': os.path.join(ROOT, 'rfcs_large'),
+            'rfcs_very_large': os.path.join(ROOT, 'rfcs_very_large')}
+
+TASKS = ('task1', 'task2')
+
+PERCENTILES = (50, 90, 99)
+
+
+class PortAllocator(object):
+    """ hands out blocks of free ports below the kernel's ephemeral port range
+
+    random ports collide with each other, and ports the kernel picks may also be picked as the source port of a
+    connection the swarm opens before the server binds them. Ports below the ephemeral range never are, and each
+    one is bound once to make sure nothing else listens on it.
+    """
+
+    FIRST = 20000
+
+    def __init__(self, first=FIRST):
+        self.first = first
+        self.last = self._ephemeral_range()[0] - 1
+        self.next = first
+
+    def block(self, n):
+        """ n free ports, wraps around to the first port once the range is used up """
+        ports = []
+        for _ in range(self.last - self.first + 1):
+            if len(ports) == n:
+                return ports
+            port, self.next = self.next, self.next + 1 if self.next < self.last else self.first
+            if self._free(port):
+                ports.append(port)
+        if len(ports) < n:
+            raise RuntimeError("Only {} of {} ports between {} and {} are free".format(len(ports), n, self.first,
+                                                                                       self.last))
+        return ports
+
+    @staticmethod
+    def _free(port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            # the same options servers bind with, the TIME_WAIT of an earlier trial doesn't count as used
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind((get_true_hostname(), port))
+                return True
+            except OSError:
+                return False
+
+    @staticmethod
+    def _ephemeral_range():
+        try:
+            with open('/proc/sys/net/ipv4/ip_local_port_range') as f:
+                low, high = f.read().split()
+            return int(low), int(high)
+        except (OSError, ValueError):
+            return 49152, 65535  # IANA range, used by Windows and macOS
+
+
+def distribute(task, n):
+    """ RFCs each of n peers starts with, task1: the first peer has them all, task2: they are dealt out evenly """
+    if task == 'task1':
+        return [set(GOAL_RFC_STATE)] + [set() for _ in range(n - 1)]
+    rfcs = sorted(GOAL_RFC_STATE)
+    return [set(rfcs[i::n]) for i in range(n)]
+
+
+def wait_listening(address, server_thread, timeout=30):
+    """ returns once something accepts connections on address, raises if the server thread died before that """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            if not server_thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("Nothing listens on {}:{}".format(*address))
+            time.sleep(0.01)
+
+
+def wait_registered(peers, timeout=30):
+    """ returns once every peer registered with the RS, so that none of them misses another in its PQuery """
+    deadline = time.monotonic() + timeout
+    while not all(peer.registered for peer in peers):
+        if time.monotonic() > deadline:
+            raise RuntimeError("{} of {} peers did not register".format(
+                sum(1 for peer in peers if not peer.registered), len(peers)))
+        time.sleep(0.01)
+
+
+def run_trial(task, n, dataset, ports, **peer_options):
+    """ runs one swarm of n peers and an RS on ports[0], returns Dict{total, times, complete}
+
+    the peers start downloading together, once the RS listens and every one of them registered. total is the
+    time the slowest peer took to reach the goal state, times the time of each peer that downloaded anything and
+    complete how many peers reached the goal state
+    """
+    rs_port, ports = ports[0], ports[1:]
+    rs = RegistrationServer(RS_HOST, rs_port, peer_options.get('event_loop', Server.SELECT))
+    options = dict(peer_options, rs=((RS_HOST, rs_port),), rfc_path=DATASETS[dataset])
+    peers = [Peer("127.0.0.1", port, rfcs, **options) for port, rfcs in zip(ports, distribute(task, n))]
+    # in task1 the first peer only serves
+    downloading = peers[1:] if task == 'task1' else peers
+
+    rs_thread = Thread(target=rs.start)
+    rs_thread.start()
+    started = []
+    try:
+        wait_listening((RS_HOST, rs_port), rs_thread)
+        for peer in peers:
+            peer.start()
+            started.append(peer)
+        wait_registered(peers)
+
+        result_queue = queue.Queue()
+        tasks = [Thread(target=lambda p=peer: result_queue.put(p.main())) for peer in downloading]
+        for t in tasks:
+            t.start()
+        for t in tasks:
+            t.join()
+        complete = sum(1 for peer in peers if all(rfc in peer.rfc_data for rfc in peer.goal_state))
+    finally:
+        for peer in started:
+            peer.stop()
+        rs.stop()
+        rs_thread.join()
+
+    times = []
+    while not result_queue.empty():
+        _, cumulative_time, _ = result_queue.get()
+        times.append(cumulative_time)
+    return dict(total=max(times, default=0.0), times=times, complete=complete)
+
+
+def percentile(values, p):
+    """ p-th percentile of values, interpolated between the closest ranks """
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(trials):
+    """ one row of percentiles for every (task, dataset, peers) of the trials
+
+    only trials in which every peer reached the goal state count towards the times, how many did not is
+    reported as incomplete. The times are None when no trial was complete.
+    """
+    groups = {}
+    for trial in trials:
+        groups.setdefault((trial['task'], trial['dataset'], trial['peers']), []).append(trial)
+
+    summary = []
+    for (task, dataset, n), group in groups.items():
+        complete = [trial for trial in group if trial['complete'] == n]
+        totals = [trial['total'] for trial in complete]
+        times = [t for trial in complete for t in trial['times']]
+        row = dict(task=task, dataset=dataset, peers=n, trials=len(group), incomplete=len(group) - len(complete),
+                   complete=sum(trial['complete'] for trial in group) / (n * len(group)),
+                   total_mean=sum(totals) / len(totals) if totals else None)
+        for p in PERCENTILES:
+            row['total_p{}'.format(p)] = percentile(totals, p)
+        for p in PERCENTILES:
+            row['peer_p{}'.format(p)] = percentile(times, p)
+        summary.append(row)
+    return summary
+
+
+def benchmark(peer_counts, datasets, tasks, trials, processes=False, **peer_options):
+    """ runs every combination trials times, returns Dict{meta, trials, summary}
+
+    with processes, the RS and every peer run in processes of their own (launcher.py) rather than as threads here
+    """
+    if processes:
+        from launcher import run_trial as run
+    else:
+        run = run_trial
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    ports = PortAllocator()
+    for dataset in datasets:
+        # hash each dataset once here, rather than in every peer of the first trial at the same time
+        Manifest(DATASETS[dataset]).load()
+
+    results = []
+    for dataset in datasets:
+        for task in tasks:
+            for n in peer_counts:
+                for trial in range(trials):
+                    result = run(task, n, dataset, ports.block(n + 1), **peer_options)
+                    result.update(task=task, dataset=dataset, peers=n, trial=trial)
+                    results.append(result)
+                    print("{} {} peers={} trial={} total={:.3f}s complete={}/{}".format(
+                        dataset, task, n, trial, result['total'], result['complete'], n), file=sys.stderr)
+
+    meta = dict(started=started, python=platform.python_version(),
+                platform=platform.platform(), processes=processes, peer_options={k: str(v) for k, v in peer_options.items()})
+    return dict(meta=meta, trials=results, summary=summarize(results))
+
+
+def write(results, output):
+    """ writes output.json with everything and output.csv with the summary """
+    with open(output + '.json', 'w') as f:
+        json.dump(results, f, indent=2)
+    with open(output + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results['summary'][0]) if results['summary'] else [])
+        writer.writeheader()
+        writer.writerows(results['summary'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="P2P swarm benchmark")
+    parser.add_argument('--peers', type=int, nargs='+', default=[2, 6, 20])
+    parser.add_argument('--datasets', nargs='+', choices=sorted(DATASETS), default=['rfcs'])
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=list(TASKS))
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--output', default='benchmark', help="writes OUTPUT.json and OUTPUT.csv")
+    parser.add_argument('--version', choices=(Message.VERSION, Message.VERSION2), default=Message.VERSION)
+    parser.add_argument('--max-inflight', type=int, default=1)
+    parser.add_argument('--max-inflight-per-peer', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--multiplex', action='store_true')
+    # select can't watch descriptors above 1024, which a swarm of more than about 40 peers in one process needs
+    parser.add_argument('--event-loop', choices=(Server.SELECT, Server.SELECTORS), default=Server.SELECTORS)
+    parser.add_argument('--locate', action='store_true')
+    parser.add_argument('--processes', action='store_true', help="run the RS and every peer in a process of its own")
+    parser.add_argument('--verbose', action='store_true', help="log what every peer does")
+    args = parser.parse_args(argv)
+    if min(args.peers) < 2:
+        parser.error("a swarm needs 2 peers at least")
+    if not args.verbose:
+        logger().setLevel(logging.WARNING)
+
+    results = benchmark(args.peers, args.datasets, args.tasks, args.trials, args.processes, version=args.version,
+                        max_inflight=args.max_inflight, max_inflight_per_peer=args.max_inflight_per_peer,
+                        chunk_size=args.chunk_size, multiplex=args.multiplex, locate=args.locate,
+                        event_loop=args.event_loop)
+    write(results, args.output)
+    for row in results['summary']:
+        if row['incomplete'] == row['trials']:
+            print("{task} {dataset} peers={peers}: no complete trial, complete={complete:.0%}".format(**row))
+            continue
+        print("{task} {dataset} peers={peers}: total p50={total_p50:.3f}s p90={total_p90:.3f}s "
+              "p99={total_p99:.3f}s, {incomplete} incomplete trial(s), complete={complete:.0%}".format(**row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+""" runs the RS and every peer of a swarm as its own process on this machine, so peers don't share a GIL
+
+    python experiment/launcher.py --peers 200 --task task2 --dataset rfcs
+
+each process is driven over a control pipe: it reports once its server listens (and the peer registered),
+downloads when told to go and hands the result of Peer.main back, and stops when told to stop. All peers are
+told to go at once, after every one of them registered.
+"""
+import argparse
+import logging
+import time
+from multiprocessing.connection import wait
+from threading import Thread
+
+from benchmark import DATASETS, TASKS, PortAllocator, distribute, wait_listening
+from p2p.client.client import Peer
+from p2p.server.rs import RegistrationServer
+from p2p.server.server import Server
+from p2p.utils.app_constants import RS_HOST
+from p2p.utils.app_utils import logger, process_context
+
+READY = "ready"
+GO = "go"
+DONE = "done"
+STOP = "stop"
+ERROR = "error"
+
+
+def _run_rs(conn, port, event_loop, verbose):
+    """ runs the RS in its own process until told to stop """
+    if not verbose:
+        logger().setLevel(logging.WARNING)
+    try:
+        rs = RegistrationServer(RS_HOST, port, event_loop)
+        rs_thread = Thread(target=rs.start)
+        rs_thread.start()
+        wait_listening((RS_HOST, port), rs_thread)
+        conn.send((READY, None))
+        conn.recv()
+        rs.stop()
+        rs_thread.join()
+    except Exception as e:
+        conn.send((ERROR, repr(e)))
+
+
+def _run_peer(conn, port, rfcs, download, verbose, peer_options):
+    """ runs one peer in its own process: registers, downloads on GO if download is set, stops on STOP """
+    if not verbose:
+        logger().setLevel(logging.WARNING)
+    try:
+        peer = Peer("127.0.0.1", port, rfcs, **peer_options)
+        peer.start()
+        while not peer.registered:
+            time.sleep(0.01)
+        conn.send((READY, str(peer)))
+
+        if conn.recv() == GO:  # or STOP, when the swarm is torn down before it starts
+            result = peer.main() if download else None
+            complete = all(rfc in peer.rfc_data for rfc in peer.goal_state)
+            conn.send((DONE, (result, complete)))
+            conn.recv()
+        peer.stop()
+    except Exception as e:
+        conn.send((ERROR, repr(e)))
+
+
+class Launcher(object):
+    """ a task1 or task2 swarm of n peers and its RS, each running in a process of its own
+
+    ports are a block handed out by a PortAllocator, the RS gets the first one
+    """
+
+    def __init__(self, task, n, dataset='rfcs', ports=None, timeout=600, verbose=False, **peer_options):
+        self.task = task
+        self.n = n
+        self.ports = ports or PortAllocator().block(n + 1)
+        self.timeout = timeout  # seconds to wait for any one step of the swarm
+        self.verbose = verbose
+        self.rs_address = (RS_HOST, self.ports[0])
+        self.peer_options = dict(peer_options, rs=(self.rs_address,), rfc_path=DATASETS[dataset])
+        self.event_loop = peer_options.get('event_loop', Server.SELECT)
+        self._rs = None  # (process, control pipe) of the RS
+        self._peers = []  # (process, control pipe) of every peer
+        self.logger = logger()
+
+    def __enter__(self):
+        try:
+            self.start()
+        except BaseException:
+            self.stop()  # __exit__ is not called when __enter__ raises
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """ starts the RS, then all peers, and returns once all of them registered """
+        context = process_context()
+        self._rs = self._spawn(context, "RS-{}".format(self.rs_address[1]), _run_rs,
+                               self.rs_address[1], self.event_loop, self.verbose)
+        self._collect([self._rs[1]], READY)
+
+        # in task1 the first peer only serves
+        for i, (port, rfcs) in enumerate(zip(self.ports[1:], distribute(self.task, self.n))):
+            download = i > 0 or self.task != 'task1'
+            self._peers.append(self._spawn(context, "Peer-{}".format(port), _run_peer,
+                                           port, rfcs, download, self.verbose, self.peer_options))
+        self._collect([conn for _, conn in self._peers], READY)
+        self.logger.info("Started RS and {} peers".format(self.n))
+
+    def run(self):
+        """ tells every peer to go at once, returns Dict{total, times, complete} like benchmark.run_trial """
+        conns = [conn for _, conn in self._peers]
+        for conn in conns:
+            conn.send(GO)
+        times, complete = [], 0
+        for result, done in self._collect(conns, DONE):
+            if result is not None:
+                _, cumulative_time, _ = result
+                times.append(cumulative_time)
+            complete += done
+        return dict(total=max(times, default=0.0), times=times, complete=complete)
+
+    def stop(self):
+        """ stops the peers and then the RS, which they leave while stopping, terminates whichever doesn't stop
+        in time """
+        self._stop(self._peers)
+        self._stop([self._rs] if self._rs else [])
+        self._peers, self._rs = [], None
+
+    def _stop(self, processes):
+        for process, conn in processes:
+            if process.is_alive():
+                try:
+                    conn.send(STOP)
+                except OSError:
+                    pass
+        for process, conn in processes:
+            process.join(self.timeout)
+            if process.is_alive():
+                self.logger.error("{} did not stop, terminating it".format(process.name))
+                process.terminate()
+                process.join()
+            conn.close()
+
+    @staticmethod
+    def _spawn(context, name, target, *args):
+        parent, child = context.Pipe()
+        process = context.Process(name=name, target=target, args=(child,) + args, daemon=True)
+        process.start()
+        child.close()  # the parent sees EOF on its end once the process exits
+        return process, parent
+
+    def _collect(self, conns, expected):
+        """ waits for the expected message from every pipe, returns their payloads in the order of conns """
+        payloads = {}
+        deadline = time.monotonic() + self.timeout
+        while len(payloads) < len(conns):
+            ready = wait([c for c in conns if c not in payloads], max(0, deadline - time.monotonic()))
+            if not ready:
+                raise TimeoutError("{} of {} processes did not report {}".format(len(conns) - len(payloads),
+                                                                               len(conns), expected))
+            for conn in ready:
+                try:
+                    kind, payload = conn.recv()
+                except EOFError:
+                    raise RuntimeError("A process exited before it reported {}".format(expected))
+                if kind != expected:
+                    raise RuntimeError("A process reported {} instead of {}: {}".format(kind, expected, payload))
+                payloads[conn] = payload
+        return [payloads[conn] for conn in conns]
+
+
+def run_trial(task, n, dataset, ports, **peer_options):
+    """ benchmark.run_trial, with every peer and the RS in a process of its own """
+    with Launcher(task, n, dataset, ports, **peer_options) as launcher:
+        return launcher.run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="P2P swarm of processes")
+    parser.add_argument('--peers', type=int, default=6)
+    parser.add_argument('--task', choices=TASKS, default='task1')
+    parser.add_argument('--dataset', choices=sorted(DATASETS), default='rfcs')
+    parser.add_argument('--timeout', type=int, default=600, help="seconds to wait for any one step of the swarm")
+    parser.add_argument('--max-inflight', type=int, default=1)
+    parser.add_argument('--max-inflight-per-peer', type=int, default=1)
+    parser.add_argument('--event-loop', choices=(Server.SELECT, Server.SELECTORS), default=Server.SELECTORS)
+    parser.add_argument('--verbose', action='store_true', help="log what every peer does")
+    args = parser.parse_args(argv)
+    if args.peers < 2:
+        parser.error("a swarm needs 2 peers at least")
+    if not args.verbose:
+        logger().setLevel(logging.WARNING)
+
+    with Launcher(args.task, args.peers, args.dataset, timeout=args.timeout, verbose=args.verbose,
+                  max_inflight=args.max_inflight, max_inflight_per_peer=args.max_inflight_per_peer,
+                  event_loop=args.event_loop) as launcher:
+        result = launcher.run()
+    print("{} {} peers={}: total={:.3f}s complete={}/{}".format(args.task, args.dataset, args.peers, result['total'],
+                                                                result['complete'], args.peers))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,39 @@
-from ast import literal_eval
-
-import matplotlib.pyplot as plt
-import numpy as np
+""" plots the summary experiment/benchmark.py wrote, one figure per dataset
 
+    python plot_multiple.py ../../bench.json
+"""
+import json
+import sys
 
-def plot_bar_x(x1, y1, x2, y2, title=None, filename=None):
-    N = 6
-    width = 0.4
-    ind = np.arange(N)
-    fig, ax = plt.subplots()
-    task1 = ax.bar(ind, y1, width=width, color='#ffab91')
-    task2 = ax.bar(ind + width, y2, width=width, color='#a5d6a7')
+import matplotlib.pyplot as plt
 
-    # add some
-    ax.set_ylabel("Cumulative Time")
-    ax.set_xlabel("Peer")
-    ax.set_xticks(ind + width / 2)
-    ax.set_xticklabels(('P0', 'P1', 'P2', 'P3', 'P4', 'P5'))
+COLORS = {'task1': '#ffab91', 'task2': '#a5d6a7'}
 
-    ax.legend((task1[0], task2[0]), ('Task-1', 'Task-2'))
 
-    plt.yticks(np.linspace(0, max(y1 + y2), 20))
+def plot_scaling(rows, title=None, filename=None):
+    """ median time the slowest peer took against the number of peers, for each task, shaded up to the 90th
+    percentile of the trials """
+    fig, ax = plt.subplots()
+    for task in sorted(set(row['task'] for row in rows)):
+        points = sorted((row for row in rows if row['task'] == task), key=lambda row: row['peers'])
+        peers = [row['peers'] for row in points]
+        color = COLORS.get(task)
+        ax.plot(peers, [row['total_p50'] for row in points], marker='o', color=color, label=task.capitalize())
+        ax.fill_between(peers, [row['total_p50'] for row in points], [row['total_p90'] for row in points],
+                        color=color, alpha=0.3)
+
+    ax.set_ylabel("Time to reach the goal state (s)")
+    ax.set_xlabel("Peers")
+    ax.legend()
     plt.title(title, pad=10)
     plt.savefig(filename)
     plt.show()
 
 
-with open('data1.txt') as f:
-    data1 = literal_eval(f.read())
-    data1['P0'] = (0.000, {})
-
-with open('data2.txt') as f:
-    data2 = literal_eval(f.read())
-
-data1 = sorted(map(lambda i: (i[0], i[1][0]), data1.items()), key=lambda i: i[0])
-data2 = sorted(map(lambda i: (i[0], i[1][0]), data2.items()), key=lambda i: i[0])
-x_axis1, y_axis1 = list(map(lambda d: d[0], data1)), list(map(lambda d: d[1], data1))
-x_axis2, y_axis2 = list(map(lambda d: d[0], data2)), list(map(lambda d: d[1], data2))
+if __name__ == '__main__':
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'benchmark.json') as f:
+        summary = json.load(f)['summary']
 
-_title = "Time taken by each Peer to download 50 RFCs"
-plot_bar_x(x_axis1, y_axis1, x_axis2, y_axis2, _title, "Local")
+    for dataset in sorted(set(row['dataset'] for row in summary)):
+        _title = "Time taken by the slowest Peer to download 60 RFCs ({})".format(dataset)
+        plot_scaling([row for row in summary if row['dataset'] == dataset], _title, "Scaling {}".format(dataset))
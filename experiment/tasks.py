@@ -10,15 +10,16 @@ from p2p.utils.app_constants import *
 random.seed(1)
 
 
-def task1():
+def task1(**peer_options):
+    """ peer_options are passed to every Peer, e.g. max_inflight=8 for parallel downloads """
     rs = RegistrationServer(RS_HOST, RS_PORT)
 
-    p0 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=GOAL_RFC_STATE)
-    p1 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE)
-    p2 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE)
-    p3 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE)
-    p4 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE)
-    p5 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE)
+    p0 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p1 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p2 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p3 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p4 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p5 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET_EMPTY, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
 
     peers = {str(p1): ('P1', p1),
              str(p2): ('P2', p2),
@@ -73,15 +74,16 @@ def task1():
     return _map_alias(peers, result_queue)
 
 
-def task2():
+def task2(**peer_options):
+    """ peer_options are passed to every Peer, e.g. max_inflight=8 for parallel downloads """
     rs = RegistrationServer(RS_HOST, RS_PORT)
 
-    p0 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET1, goal_rfc_state=GOAL_RFC_STATE)
-    p1 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET2, goal_rfc_state=GOAL_RFC_STATE)
-    p2 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET3, goal_rfc_state=GOAL_RFC_STATE)
-    p3 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET4, goal_rfc_state=GOAL_RFC_STATE)
-    p4 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET5, goal_rfc_state=GOAL_RFC_STATE)
-    p5 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET6, goal_rfc_state=GOAL_RFC_STATE)
+    p0 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET1, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p1 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET2, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p2 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET3, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p3 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET4, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p4 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET5, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
+    p5 = Peer("127.0.0.1", random.randint(64430, 64530), initial_rfc_state=RFC_SET6, goal_rfc_state=GOAL_RFC_STATE, **peer_options)
 
     peers = {str(p0): ('P0', p0),
              str(p1): ('P1', p1),
@@ -157,3 +159,7 @@ def _print(task, results):
 if __name__ == '__main__':
     _print(1, task1())
     # _print(2, task2())
+    # _print(1, task1(max_inflight=8, max_inflight_per_peer=4))
+    # _print(2, task2(max_inflight=8, max_inflight_per_peer=4))
+    # _print(1, task1(server_processes=4, max_inflight=8, max_inflight_per_peer=4))
+    # _print(1, task1(version="P2Pv2", encodings=("lzma", "zlib")))
@@ -4,47 +4,84 @@ import random
 from ast import literal_eval
 from collections import defaultdict
 from datetime import datetime
-from socket import socket, AF_INET, SOCK_STREAM, error
+from socket import error
 from threading import Lock
 from threading import Thread
 
-from p2p.proto.proto import Message, MethodTypes, Headers
+from p2p.proto.proto import Message, MethodTypes, Headers, ContentTypes
 from p2p.proto.proto import ResponseStatus as Status
-from p2p.proto.proto import ServerResponse as Response
+from p2p.proto.proto import ServerResponse as Response, RawResponse, encode_index, decode_index
+from p2p.proto.proto import parse_range, parse_content_range, encode_rfc_set, decode_rfc_set
+from p2p.proto.proto import choose_encoding, decompress, encode_digests, decode_digests
+from p2p.client.downloader import Downloader
+from p2p.client.pool import ConnectionPool
+from p2p.client.multiplex import MultiplexedConnection
+from p2p.client.store import RFCStore
+from p2p.client.manifest import Manifest
+from p2p.client.scheduler import Scheduler
 from p2p.server.server import Server
+from p2p.server.ring import HashRing
 from p2p.utils.app_constants import RS, RFC_PATH, GOAL_RFC_STATE, RFC_SET1
-from p2p.utils.app_utils import logger, send, recv, retry, flatten, ForbiddenError, CriticalError, NotFoundError
+from p2p.utils.app_utils import logger, retry, flatten, ForbiddenError, CriticalError, NotFoundError, RECV_SIZE
+from p2p.utils.app_utils import process_context
 
 SEP = Message.SR_FIELDS
 
 
 class Peer:
 
-    def __init__(self, host, port, initial_rfc_state, goal_rfc_state=GOAL_RFC_STATE):
+    # RFCs asked for in one Locate message, keeps the Wanted header within a P2Pv2 field
+    LOCATE_BATCH = 4096
+
+    def __init__(self, host, port, initial_rfc_state, goal_rfc_state=GOAL_RFC_STATE, version=Message.VERSION,
+                 max_inflight=1, max_inflight_per_peer=1, chunk_size=None, pool_size=32, idle_timeout=30,
+                 multiplex=False, event_loop=Server.SELECT, server_workers=0, server_processes=1,
+                 store_budget=RFCStore.BUDGET, spool_dir=None, manifest_path=None, locate=False,
+                 peer_sample=None, rs=(RS,), encodings=None, recv_size=RECV_SIZE, scheduler=Scheduler,
+                 rfc_path=RFC_PATH):
         self.logger = logger()
         self.mutex = Lock()
-        self.server = P2PServer(host, port, self)
+        self.server = P2PServer(host, port, self, event_loop, server_workers, reuse_port=server_processes > 1,
+                                recv_size=recv_size)
+        self.rs = HashRing(rs)  # RS shards, PQuery and Locate go to all of them
+        self.home_rs = self.rs.owner(str(self))  # shard this peer registers and keeps alive with
+        self.server_processes = server_processes  # processes sharing the P2PServer port, only this one registers
+        self._processes = []
         self._server_thread = None
-        self.rfc_index = self._prepare_rfc_index(initial_rfc_state)
-        self.rfc_data = {}
+        self.index_parent = None  # in a worker process, pipe to the peer's own process, which answers index_since
+        self._index_parent_lock = Lock()
+        self.rfc_index = defaultdict(set)
+        self.index_version = 0  # bumped on every change to rfc_index
+        self.index_epoch = os.urandom(4).hex()  # versions count from 0 again in every run of this peer
+        self.index_log = []  # (peer, rfcs added) of every version, index_log[v - 1] holds version v
+        self.index_seen = {}  # peer -> (epoch, version) of its RFC Index merged so far
+        self._update_rfc_index({str(self): initial_rfc_state})
+        self.rfc_data = RFCStore(store_budget, spool_dir)  # RFC files are mapped when requested, not read upfront
+        self.manifest = Manifest(rfc_path, manifest_path)  # RFCs this peer starts with are read from rfc_path
         self.goal_state = goal_rfc_state
         self.registered = False
+        self.version = version  # protocol version used for requests sent by this peer
+        # chunked downloads are verified and resumable when spooled to disk
+        self.downloader = Downloader(self, max_inflight, max_inflight_per_peer, partial_dir=spool_dir)
+        self.scheduler = scheduler()  # picks the peer each RFC is downloaded from, a Scheduler class is given
+        self.chunk_size = chunk_size  # when set, each RFC is downloaded in chunks from all peers having it
+        self.recv_size = recv_size  # most bytes asked for by one recv_into on connections to peers and the RS
+        self.pool = ConnectionPool(pool_size, idle_timeout, recv_size)  # connections to other peers and the RS
+        self.locate = locate  # when set, main asks the RS who holds the missing RFCs before querying peers
+        self.peer_sample = peer_sample  # when set, PQuery asks the RS for a random sample of this many peers
+        self.encodings = encodings  # codecs GetRFC responses may be compressed with, preferred first, P2Pv2 only
+        self.multiplex = multiplex  # when set, all requests to a peer share one MultiplexedConnection
+        self.channels = {}  # peer address -> MultiplexedConnection
 
     def __str__(self):
         return "{}:{}".format(self.server.host, self.server.port)
 
-    def _prepare_rfc_index(self, initial_state):
-        rfc_index = defaultdict(set)
-        rfc_index[str(self)].update(initial_state.copy())
-        return rfc_index
-
     def load_rfcs(self):
-        """ loads RFCs into memory """
-        for file in os.listdir(RFC_PATH):
-            idx = file.split('/')[-1][3:7]
-            if idx in flatten(self.rfc_index.values()):
-                with open("{}/{}".format(RFC_PATH, file)) as f:
-                    self.rfc_data[idx] = f.read()
+        """ adds RFCs found in rfc_path to the RFC store, from the manifest instead of reading the files """
+        indexed = self._flatten(self.rfc_index)
+        for idx in self.manifest.load():
+            if idx in indexed:
+                self.rfc_data.add_file(idx, self.manifest.file(idx))
         self.logger.info("Loaded {} RFCs".format(len(self.rfc_data)))
 
     def main(self):
@@ -55,6 +92,14 @@ class Peer:
 
         start_time = time.perf_counter()
 
+        if self.locate:
+            # one round trip to the RS instead of an RFCQuery to every peer, peers it doesn't know of are queried below
+            located = defaultdict(set)
+            for rfc, peers in self.Locate(self.goal_state - self._flatten(self.rfc_index)).items():
+                for peer in peers:
+                    located[peer].add(rfc)
+            self._update_rfc_index(located)
+
         # loop to fetch and merge RFC Index from other peers
         done = False
         while not done:
@@ -72,7 +117,7 @@ class Peer:
 
                     if remaining:
                         # missing RFCs available from this peer
-                        peer_rfc_index = self.RFCQuery(peer)
+                        peer_rfc_index = self.RFCQuery(peer, remaining)
                         interested = remaining & self._flatten(peer_rfc_index)
 
                         if interested:
@@ -90,17 +135,18 @@ class Peer:
                 self.logger.error("[CLIENT] Critical error encountered, stopping client task: {}".format(e))
                 break
 
-        times = defaultdict(list)
-
-        # loop to fetch actual RFC data
-        for peer, index in self.rfc_index.items():
-            if peer != str(self):
-                # fetch interested RFCs one at a time
+        # fetch actual RFC data, max_inflight requests at a time
+        holders = defaultdict(list)
+        with self.mutex:
+            for peer, index in self.rfc_index.items():
                 for rfc in index:
-                    _start_time = time.perf_counter()
-                    new_rfc = self.fetch_interested_rfc(peer, rfc)
-                    times[peer].append((rfc, time.perf_counter() - _start_time))
-                    self._update_rfc_data(new_rfc)
+                    if peer != str(self) and rfc not in self.rfc_data:
+                        holders[rfc].append(peer)
+        if self.chunk_size:
+            # every holder serves chunks, the scheduler decides which RFCs are started first
+            times = self.downloader.download_chunked(holders, self.chunk_size, self.scheduler)
+        else:
+            times = self.downloader.download(holders, self.scheduler)
 
         cumulative_time = time.perf_counter() - start_time
 
@@ -118,22 +164,57 @@ class Peer:
 
     def fetch_interested_rfc(self, peer, rfc):
         """ GetRFC wrapper """
-        try:
-            new_rfc = literal_eval(self.GetRFC(peer, rfc))  # dict_str -> Dict{rfc_number: rfc_data}
-        except:
-            raise Exception("Literal eval parsing error at peer: {}".format(self))
-        return new_rfc
+        return self.GetRFC(peer, rfc)
 
     def _update_rfc_index(self, interested):
-        """ update this peers RFC Index """
+        """ merges Dict{peer: rfcs} into this peers RFC Index, every peer with new RFCs gets a new version """
         with self.mutex:
-            self.rfc_index.update(interested)
+            for peer, rfcs in interested.items():
+                added = set(rfcs) - self.rfc_index[peer]
+                if added:
+                    self.index_version += 1
+                    self.index_log.append((peer, frozenset(added)))
+                    self.rfc_index[peer] |= added
+
+    def index_since(self, version, epoch=None):
+        """ Dict{peer: rfcs} added to this peers RFC Index after version of run epoch, and the current version
+
+        a worker process asks the peer's own process, so every process of the peer answers from the same index
+        """
+        if self.index_parent is not None:
+            with self._index_parent_lock:
+                self.index_parent.send((version, epoch))
+                return self.index_parent.recv()
+        with self.mutex:
+            if epoch != self.index_epoch or not 0 < version <= self.index_version:
+                # first query, or the client saw a version of an earlier run of this peer
+                return {peer: set(rfcs) for peer, rfcs in self.rfc_index.items()}, self.index_version
+            delta = defaultdict(set)
+            for peer, rfcs in self.index_log[version:]:
+                delta[peer] |= rfcs
+            return delta, self.index_version
+
+    def blocks(self, rfc):
+        """ sha256 of every Manifest.BLOCK_SIZE bytes of an RFC this peer serves, from the manifest if it has them """
+        path = self.rfc_data.path(rfc)
+        if rfc in self.manifest.entries and path == self.manifest.file(rfc):
+            return self.manifest.blocks(rfc)
+        return self.rfc_data.blocks(rfc)
 
     def _update_rfc_data(self, new_rfc):
         """ update this peers RFC Data """
         with self.mutex:
             self.rfc_data.update(new_rfc)
 
+    def new_message(self, method, payload="", headers=None):
+        """ creates a request in this peers protocol version """
+        msg = Message()
+        msg.method = method.name
+        msg.version = self.version
+        msg.headers = headers or {}
+        msg.payload = payload
+        return msg
+
     @staticmethod
     def _flatten(data):
         """ flattens nested data structure into a set"""
@@ -141,146 +222,313 @@ class Peer:
 
     def start(self, tname=None):
         """ starts the P2PServer on this peer """
+        if self.server_processes > 1 and not self._processes:
+            context = process_context()
+            for i in range(self.server_processes - 1):
+                conn, child = context.Pipe()
+                process = context.Process(name="{}-{}".format(self, i + 1), target=_serve, daemon=True,
+                                          args=(self.server.host, self.server.port, set(self.rfc_index[str(self)]),
+                                                self.server.event_loop, self.server.workers,
+                                                self.manifest.directory, self.server.recv_size,
+                                                self.rfc_data.spool_dir, self.index_epoch, child))
+                process.start()
+                child.close()
+                self._processes.append(process)
+                Thread(name="{}-index".format(process.name), target=self._answer_index, args=(conn,),
+                       daemon=True).start()
         self._server_thread = Thread(name=tname, target=self.server.start)
         self._server_thread.start()
 
+    def _answer_index(self, conn):
+        """ answers the index_since calls of a worker process until it exits """
+        with conn:
+            while True:
+                try:
+                    version, epoch = conn.recv()
+                except (EOFError, OSError):
+                    return
+                conn.send(self.index_since(version, epoch))
+
     def stop(self):
         """ stops the P2PServer running on this peer """
         self.Leave()
         self._server_thread.join()
+        for process in self._processes:
+            process.terminate()
+            process.join()
+        self._processes = []
+        self.pool.close()
+        with self.mutex:
+            channels, self.channels = self.channels, {}
+        for channel in channels.values():
+            channel.close()
+
+    def _request(self, address, msg):
+        """ sends a request to another peer, returns its Response """
+        if not self.multiplex:
+            return Response().from_bytes(self.pool.request(address, msg))
+        with self.mutex:
+            channel = self.channels.get(address)
+            if not channel or channel.closed:
+                channel = self.channels[address] = MultiplexedConnection(address, self.recv_size)
+        return channel.request(msg)
+
+    @staticmethod
+    def _address(peer):
+        """ 'host:port' -> (host, port) """
+        host, port = peer.split(':')
+        return host, int(port)
 
     def PQuery(self):
-        """ sends PQuery message RS to get the list of active peers """
-        msg = Message()
-        msg.method = MethodTypes.PQuery.name
-        msg.version = Message.VERSION
-        msg.payload = "{}{}{}".format(self.server.host, SEP, self.server.port)
-        msg.headers[Headers.Cookie.name] = self.server.cookie
+        """ sends PQuery message RS to get the list of active peers other than this one """
+        msg = self.new_message(MethodTypes.PQuery, "{}{}{}".format(self.server.host, SEP, self.server.port),
+                               {Headers.Cookie.name: self.server.cookie})
+        if self.peer_sample:
+            msg.headers[Headers.Sample.name] = self.peer_sample
 
         peers = []
-        with socket(AF_INET, SOCK_STREAM) as conn:
+        for rs in self.rs.nodes:  # each shard lists the peers registered with it
             try:
-                conn.connect(RS)
-                send(conn, msg)
-                response = Response().from_bytes(recv(conn))
+                response = Response().from_bytes(self.pool.request(rs, msg))
                 if response.payload:
-                    peers = response.payload.split(SEP)
-                self.logger.info("[CLIENT] {} active peer(s) found".format(len(peers)))
+                    peers.extend(peer for peer in response.payload.split(SEP) if peer != str(self))
             except error as se:
                 self.logger.error("[CLIENT] Socket error: {}".format(se))
             except Exception as e:
                 self.logger.error("[CLIENT] Error while retrieving active peers: {}".format(e))
                 raise CriticalError
+        if self.peer_sample and len(peers) > self.peer_sample:
+            peers = random.sample(peers, self.peer_sample)
+        self.logger.info("[CLIENT] {} active peer(s) found".format(len(peers)))
         return peers
 
-    def RFCQuery(self, peer):
-        """ sends RFCQuery message to an active peer to get its RFC Index """
-        msg = Message()
-        msg.method = MethodTypes.RFCQuery.name
-        msg.version = Message.VERSION
+    def Locate(self, rfcs):
+        """ sends Locate messages to RS to get Dict{rfc: peers holding it} for the given RFCs """
+        located = {}
+        rfcs = sorted(rfcs)
+        for i in range(0, len(rfcs), self.LOCATE_BATCH):
+            msg = self.new_message(MethodTypes.Locate, "{}{}{}".format(self.server.host, SEP, self.server.port),
+                                   {Headers.Cookie.name: self.server.cookie,
+                                    Headers.Wanted.name: encode_rfc_set(rfcs[i: i + self.LOCATE_BATCH])})
+            for rs in self.rs.nodes:  # each shard only knows the holdings of the peers registered with it
+                try:
+                    response = Response().from_bytes(self.pool.request(rs, msg))
+                    if int(response.status) != Status.Success.value:
+                        raise Exception(response.payload)
+                    if response.payload and response.version == Message.VERSION2:
+                        holders = decode_index(response.payload)
+                    else:
+                        holders = literal_eval(response.payload) if response.payload else {}
+                    for rfc, peers in holders.items():
+                        located.setdefault(rfc, set()).update(peers)
+                except error as se:
+                    self.logger.error("[CLIENT] Socket error: {}".format(se))
+                except Exception as e:
+                    self.logger.error("[CLIENT] Error while locating RFCs: {}".format(e))
+        self.logger.info("[CLIENT] {} RFC(s) located".format(len(located)))
+        return located
+
+    def RFCQuery(self, peer, wanted=None):
+        """ sends RFCQuery message to an active peer to get the part of its RFC Index added since the last query,
+        only RFCs in wanted are returned when it is given """
+        headers = {}
+        if peer in self.index_seen:
+            headers[Headers.IndexEpoch.name], headers[Headers.Since.name] = self.index_seen[peer]
+        if wanted is not None:
+            value = encode_rfc_set(wanted)
+            if len(value) <= Message.V2_MAX_FIELD:  # otherwise ask for everything
+                headers[Headers.Wanted.name] = value
+        msg = self.new_message(MethodTypes.RFCQuery, headers=headers)
 
         index = dict()
-        with socket(AF_INET, SOCK_STREAM) as conn:
-            try:
-                host, port = peer.split(':')
-                conn.connect((host, int(port)))
-                send(conn, msg)
-                response = Response().from_bytes(recv(conn))
-                if response.payload:
-                    index = defaultdict(set, literal_eval(response.payload))
-                self.logger.info("[CLIENT] RFC Index retrieved from peer {}".format(peer))
-            except error as se:
-                self.logger.error("[CLIENT] Socket error: {}".format(se))
-            except Exception as e:
-                self.logger.error("[CLIENT] Error while retrieving RFC Index from peer {}: {}".format(peer, e))
+        try:
+            start_time = time.perf_counter()
+            response = self._request(self._address(peer), msg)
+            self.scheduler.record_latency(peer, time.perf_counter() - start_time)
+            if response.payload and response.version == Message.VERSION2:
+                index = decode_index(response.payload)
+            elif response.payload:
+                index = defaultdict(set, literal_eval(response.payload))
+            version = response.headers.get(Headers.IndexVersion.name)
+            epoch = response.headers.get(Headers.IndexEpoch.name)
+            if version is not None and epoch is not None:
+                with self.mutex:
+                    self.index_seen[peer] = epoch, int(version)
+            self.logger.info("[CLIENT] RFC Index retrieved from peer {}".format(peer))
+        except error as se:
+            self.logger.error("[CLIENT] Socket error: {}".format(se))
+        except Exception as e:
+            self.logger.error("[CLIENT] Error while retrieving RFC Index from peer {}: {}".format(peer, e))
         return index
 
     def GetRFC(self, peer, rfc):
         """ sends GetRFC message to an active peer requesting a specific RFC of interest """
-        msg = Message()
-        msg.method = MethodTypes.GetRFC.name
-        msg.version = Message.VERSION
-        msg.payload = rfc
+        msg = self.new_message(MethodTypes.GetRFC, rfc, {Headers.Accept.name: ContentTypes.Raw.name})
+        if self.encodings and self.version == Message.VERSION2:
+            msg.headers[Headers.AcceptEncoding.name] = ",".join(self.encodings)
 
         new_rfc = {}
-        with socket(AF_INET, SOCK_STREAM) as conn:
-            try:
-                host, port = peer.split(':')
-                conn.connect((host, int(port)))
-                send(conn, msg)
-                response = Response().from_bytes(recv(conn))
-                if response.payload:
-                    new_rfc = response.payload
-                self.logger.info("[CLIENT] {} new RFC fetched from peer {}".format(1, peer))
-            except error as se:
-                self.logger.error("[CLIENT] Socket error: {}".format(se))
-            except Exception as e:
-                self.logger.error("[CLIENT] Error while fetching new RFCs from peer {}: {}".format(peer, e))
+        response = self._get_rfc(peer, msg)
+        if response and int(response.status) == Status.Success.value and response.payload:
+            new_rfc = self._decode_rfc(rfc, response)
+            self.logger.info("[CLIENT] {} new RFC fetched from peer {}".format(1, peer))
         return new_rfc
 
+    def GetRFCRange(self, peer, rfc, first, last):
+        """ sends GetRFC message requesting bytes first..last of an RFC, returns (data, total size, digests),
+        digests is (block size, [sha256 of every block]) when the peer sent them, None otherwise """
+        msg = self.new_message(MethodTypes.GetRFC, rfc, {Headers.Accept.name: ContentTypes.Raw.name,
+                                                         Headers.Range.name: "{}-{}".format(first, last)})
+        # P2Pv1 frames are decoded as text, which a range could cut in the middle of a character
+        msg.version = Message.VERSION2
+
+        chunk, total, digests = b'', 0, None
+        response = self._get_rfc(peer, msg)
+        if response and int(response.status) == Status.Success.value:
+            chunk = response.payload
+            total = parse_content_range(response.headers[Headers.ContentRange.name])[2]
+            if Headers.Digests.name in response.headers:
+                digests = decode_digests(response.headers[Headers.Digests.name])
+            self.logger.info("[CLIENT] Bytes {}-{} of RFC {} fetched from peer {}".format(first, last, rfc, peer))
+        return chunk, total, digests
+
+    def _get_rfc(self, peer, msg):
+        """ sends a GetRFC request, returns the response or None """
+        response = None
+        try:
+            response = self._request(self._address(peer), msg)
+        except error as se:
+            self.logger.error("[CLIENT] Socket error: {}".format(se))
+        except Exception as e:
+            self.logger.error("[CLIENT] Error while fetching new RFCs from peer {}: {}".format(peer, e))
+        return response
+
+    def _decode_rfc(self, rfc, response):
+        """ GetRFC response -> Dict{rfc_number: rfc_data} """
+        if response.headers.get(Headers.ContentType.name) == ContentTypes.Raw.name:
+            data = response.payload  # P2Pv2: a memoryview of the received frame
+            if Headers.ContentEncoding.name in response.headers:
+                return {rfc: decompress(data, response.headers[Headers.ContentEncoding.name])}
+            return {rfc: data.encode('utf-8') if isinstance(data, str) else data}
+        try:
+            new_rfc = literal_eval(response.payload)  # dict_str -> Dict{rfc_number: rfc_data}
+        except:
+            raise Exception("Literal eval parsing error at peer: {}".format(self))
+        return {k: v.encode('utf-8') for k, v in new_rfc.items()}
+
     def Leave(self):
         """ sends Leave message to RS to rescind the registration of this peers P2PServer """
         self.server.stop()
 
-        msg = Message()
-        msg.method = MethodTypes.Leave.name
-        msg.version = Message.VERSION
-        msg.payload = "{}{}{}".format(self.server.host, SEP, self.server.port)
-        msg.headers[Headers.Cookie.name] = self.server.cookie
+        msg = self.new_message(MethodTypes.Leave, "{}{}{}".format(self.server.host, SEP, self.server.port),
+                               {Headers.Cookie.name: self.server.cookie})
 
         status = None
-        with socket(AF_INET, SOCK_STREAM) as conn:
-            try:
-                conn.connect(RS)
-                send(conn, msg)
-                response = Response().from_bytes(recv(conn))
-                status = response.status
-                if int(status) == Status.Success.value:
-                    self.logger.info("[Client] Successfully left P2P-DI system")
-                else:
-                    self.logger.error("[CLIENT] Failed to leave P2P-DI system")
-                    self.start()
-            except error as se:
-                self.logger.error("[CLIENT] Socket error: {}".format(se))
-            except Exception as e:
-                self.logger.error("[CLIENT] Error while attempting to leave P2P-DI system: {}".format(e))
+        try:
+            response = Response().from_bytes(self.pool.request(self.home_rs, msg))
+            status = response.status
+            if int(status) == Status.Success.value:
+                self.logger.info("[Client] Successfully left P2P-DI system")
+            else:
+                self.logger.error("[CLIENT] Failed to leave P2P-DI system")
+                self.start()
+        except error as se:
+            self.logger.error("[CLIENT] Socket error: {}".format(se))
+        except Exception as e:
+            self.logger.error("[CLIENT] Error while attempting to leave P2P-DI system: {}".format(e))
         return status
 
 
+def _serve(host, port, rfcs, event_loop, workers, rfc_path, recv_size, spool_dir, index_epoch, index_parent):
+    """ runs in a worker process of a peer, serves the RFCs the peer started with and those it spooled on the
+    peer's port, RFCQuery from the peer's RFC Index """
+    peer = Peer(host, port, rfcs, rfc_path=rfc_path, spool_dir=spool_dir)
+    peer.index_epoch, peer.index_parent = index_epoch, index_parent
+    peer.server = P2PServer(host, port, peer, event_loop, workers, reuse_port=True, register=False,
+                            recv_size=recv_size)
+    peer.server.start()
+
+
 class P2PServer(Server):
 
-    def __init__(self, host, port, _peer):
-        super().__init__(host, port)
+    def __init__(self, host, port, _peer, event_loop=Server.SELECT, workers=0, reuse_port=False, register=True,
+                 recv_size=RECV_SIZE):
+        super().__init__(host, port, event_loop, workers, reuse_port, recv_size)
         self.cookie = -1
+        self.published = None  # holdings last sent to the RS
         self.platform_peer = _peer  # platform peer is the host peer on which this P2PServer is running
+        self.register = register  # False in worker processes, the peer registers and keeps alive only once
 
     def _on_start(self):
         """ load RFCs in memory and register this peer """
         self.platform_peer.load_rfcs()
-        self.Register()
+        if self.register:
+            self.Register()
 
     def _reconcile(self):
         """ reconcile state of the server periodically """
-        self.KeepAlive()
+        if self.register:
+            self.KeepAlive()
 
     def _handle_rfcquery(self, _conn, _msg):
-        """ return this peers RFC Index """
+        """ return this peers RFC Index, only what changed after the Since version and what the client Wanted
+        when it sends these headers. Since counts in the IndexEpoch sent with it, the whole index is returned when
+        that is not the current run of this peer """
         try:
-            with self.platform_peer.mutex:
-                payload = str(dict(self.platform_peer.rfc_index))
-                response = Response(payload, Status.Success.value)
+            index, version = self.platform_peer.index_since(int(_msg.headers.get(Headers.Since.name, 0)),
+                                                            _msg.headers.get(Headers.IndexEpoch.name))
+            if Headers.Wanted.name in _msg.headers:
+                wanted = decode_rfc_set(_msg.headers[Headers.Wanted.name])
+                index = {peer: rfcs & wanted for peer, rfcs in index.items() if not rfcs.isdisjoint(wanted)}
+            if _msg.version == Message.VERSION2:
+                payload = encode_index(index)
+            else:
+                payload = str(dict(index))
+            response = Response(payload, Status.Success.value)
+            response.headers[Headers.IndexVersion.name] = version
+            response.headers[Headers.IndexEpoch.name] = self.platform_peer.index_epoch
+        except ValueError as e:
+            self.logger.error("Bad RFC Index request: {}".format(e))
+            response = Response(Status.BadMessage.name, Status.BadMessage.value)
         except Exception as e:
             self.logger.error("Failed to return RFC Index: {}".format(e))
             response = Response(Status.InternalError.name, Status.InternalError.value)
         return response
 
     def _handle_getrfc(self, _conn, _msg):
-        """ return data for requested RFCs as List[Dict] where each Dict is {RFC Index: RFC Data}"""
+        """ return data for requested RFC, either raw or as {RFC Index: RFC Data} depending on Accept header """
         try:
             rfc = _msg.payload
-            with self.platform_peer.mutex:
-                payload = str({rfc: self.platform_peer.rfc_data[rfc]})
-                response = Response(payload, Status.Success.value)
+            store = self.platform_peer.rfc_data
+            store.refresh(rfc)
+            path = store.path(rfc)
+            accept = _msg.headers.get(Headers.AcceptEncoding.name)
+            encoding = None
+            if accept and _msg.version == Message.VERSION2 and Headers.Range.name not in _msg.headers:
+                encoding = choose_encoding(accept)
+            compressed = None
+            if _msg.headers.get(Headers.Accept.name) == ContentTypes.Raw.name and encoding:
+                # compressed once per RFC and codec, then served from the store's cache. The event loop doesn't
+                # wait for that, it sends the RFC as is until the store has compressed it in the background
+                compressed = store.compress(rfc, encoding, wait=not self.on_loop())
+            if compressed is not None:
+                response = RawResponse(body=compressed)
+                response.headers[Headers.ContentEncoding.name] = encoding
+            elif _msg.headers.get(Headers.Accept.name) == ContentTypes.Raw.name:
+                # RFCs with a file are streamed from disk with sendfile, downloaded ones from memory
+                byte_range = _msg.headers.get(Headers.Range.name)
+                response = RawResponse(body=b'' if path else store[rfc], path=path,
+                                       byte_range=byte_range and parse_range(byte_range))
+                if byte_range and response.offset == 0:
+                    # the first chunk of a download also brings what to verify the others against
+                    digests = encode_digests(Manifest.BLOCK_SIZE, self.platform_peer.blocks(rfc))
+                    if len(digests) <= Message.V2_MAX_FIELD:
+                        response.headers[Headers.Digests.name] = digests
+            else:
+                response = Response(str({rfc: str(store[rfc], 'utf-8')}), Status.Success.value)
+        except ValueError as e:
+            self.logger.error("Bad RFC request: {}".format(e))
+            response = Response(Status.BadMessage.name, Status.BadMessage.value)
         except Exception as e:
             self.logger.error("Failed to return RFC data: {}".format(e))
             response = Response(Status.InternalError.name, Status.InternalError.value)
@@ -314,54 +562,62 @@ class P2PServer(Server):
                 "Took {} ms to process request {}".format((datetime.now() - start_time).microseconds / 1000,
                                                           p2pmsg.method))
             # send some message back to the client no matter what
-            self.messages[conn].put(response.to_bytes())
+            self.messages[conn].put(response.negotiate(p2pmsg).to_frame())
+
+    def _holdings(self, headers, changed_only=False):
+        """ adds the RFCs this peer can serve to the headers of a Register or KeepAlive, returns them
+
+        with several server processes, only RFCs with a file: worker processes don't have those downloaded
+        into memory here """
+        store = self.platform_peer.rfc_data
+        if self.platform_peer.server_processes > 1:
+            holdings = {rfc for rfc in store if store.path(rfc)}
+        else:
+            holdings = set(store)
+        value = encode_rfc_set(holdings)
+        if (holdings != self.published or not changed_only) and len(value) <= Message.V2_MAX_FIELD:
+            headers[Headers.Holdings.name] = value
+        return holdings
 
     def Register(self):
         """ sends Register message to RS """
-        msg = Message()
-        msg.method = MethodTypes.Register.name
-        msg.headers = {}
-        msg.version = Message.VERSION
-        msg.payload = "{}{}{}".format(self.host, SEP, self.port)
+        msg = self.platform_peer.new_message(MethodTypes.Register, "{}{}{}".format(self.host, SEP, self.port))
+        holdings = self._holdings(msg.headers)
 
-        with socket(AF_INET, SOCK_STREAM) as conn:
-            try:
-                conn.connect(RS)
-                send(conn, msg)
-                response = Response().from_bytes(recv(conn))
-                cookie = response.headers.get(Headers.Cookie.name, None)
-                if not cookie:
-                    raise Exception("Cookie not received from RS")
-                self.cookie = cookie
-                self.platform_peer.registered = True
-                self.logger.info("Peer registered")
-            except error as se:
-                self.logger.error("Socket error: {}".format(se))
-            except Exception as e:
-                self.logger.error("Error while registering Peer: {}".format(e))
+        try:
+            response = Response().from_bytes(self.platform_peer.pool.request(self.platform_peer.home_rs, msg))
+            cookie = response.headers.get(Headers.Cookie.name, None)
+            if not cookie:
+                raise Exception("Cookie not received from RS")
+            self.cookie = cookie
+            self.published = holdings
+            self.platform_peer.registered = True
+            self.logger.info("Peer registered")
+        except error as se:
+            self.logger.error("Socket error: {}".format(se))
+        except Exception as e:
+            self.logger.error("Error while registering Peer: {}".format(e))
 
     def KeepAlive(self):
         """ sends KeepAlive message to RS """
-        msg = Message()
-        msg.method = MethodTypes.KeepAlive.name
-        msg.headers = {Headers.Cookie.name: self.cookie}
-        msg.version = Message.VERSION
-        msg.payload = "{}{}{}".format(self.host, SEP, self.port)
+        msg = self.platform_peer.new_message(MethodTypes.KeepAlive, "{}{}{}".format(self.host, SEP, self.port),
+                                             {Headers.Cookie.name: self.cookie})
+        holdings = self._holdings(msg.headers, changed_only=True)
 
-        with socket(AF_INET, SOCK_STREAM) as conn:
-            try:
-                conn.connect(RS)
-                send(conn, msg)
-                response = Response().from_bytes(recv(conn))
-                if int(response.status) == 403:
-                    raise ForbiddenError(response.payload)
-                self.logger.info("TTL extended")
-            except ForbiddenError as e:
-                self.logger.error(e)
-            except error as se:
-                self.logger.error("[CLIENT] Socket error: {}".format(se))
-            except Exception as e:
-                self.logger.error("Error while extending TTL: {}".format(e))
+        try:
+            response = Response().from_bytes(self.platform_peer.pool.request(self.platform_peer.home_rs, msg))
+            if int(response.status) == 403:
+                raise ForbiddenError(response.payload)
+            self.published = holdings
+            self.logger.info("TTL extended")
+        except ForbiddenError as e:
+            # the RS lost our registration, e.g. in a restart, or expired us
+            self.logger.error("{}, registering again".format(e))
+            self.Register()
+        except error as se:
+            self.logger.error("[CLIENT] Socket error: {}".format(se))
+        except Exception as e:
+            self.logger.error("Error while extending TTL: {}".format(e))
 
 
 class ClientEntry(object):
@@ -376,9 +632,20 @@ class ClientEntry(object):
         self.p2port = p2port  # port on which P2P server is running
         self.cookie = cookie
         self.flag = ClientEntry.FLAG_ACTIVE
-        self.ttl = ClientEntry.TTL
+        self.expires = time.time() + ClientEntry.TTL  # wall clock deadline, so that it can be persisted
+        self.deadline = None  # deadline the RS scheduled this entry to expire at
         self.activity = 0
         self.last_active = 0
+        self.rfcs = set()  # RFCs the client holds, as of its last Register or KeepAlive
+
+    @property
+    def ttl(self):
+        """ seconds left until the entry expires """
+        return max(0, self.expires - time.time())
+
+    @ttl.setter
+    def ttl(self, ttl):
+        self.expires = time.time() + ttl
 
     def __str__(self):
         return "{}:{}".format(self.host, self.p2port)
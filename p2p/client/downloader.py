@@ -0,0 +1,263 @@
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from p2p.client.partial import PartialFile
+from p2p.client.scheduler import Scheduler
+from p2p.utils.app_utils import logger
+
+
+class Downloader(object):
+    """ fetches RFCs from peers with a bounded number of GetRFC requests in flight """
+
+    def __init__(self, platform_peer, max_inflight=1, max_inflight_per_peer=1, partial_dir=None):
+        self.platform_peer = platform_peer  # peer on whose behalf RFCs are downloaded
+        self.max_inflight = max(1, max_inflight)
+        self.max_inflight_per_peer = max(1, max_inflight_per_peer)
+        self.partial_dir = partial_dir  # chunked downloads are written here as PartialFiles when set
+        self.logger = logger()
+
+    def download(self, holders, scheduler=None):
+        """ downloads every RFC in Dict{rfc: [peers having it]} once, returns Dict{peer: [(rfc, seconds)]} like
+        Peer.main
+
+        whenever a slot frees up, the scheduler picks the holder of the next RFC knowing the transfers completed so
+        far. An RFC whose chosen holder is at its per peer limit waits for it rather than going to another one.
+        An RFC a holder failed to send is fetched again from one of its other holders.
+        """
+        scheduler = scheduler or Scheduler()
+        holders = {rfc: list(peers) for rfc, peers in holders.items() if peers}
+        pending = scheduler.order(holders)  # RFCs not requested yet, in the order to start them
+
+        times = defaultdict(list)
+        inflight = {}  # future -> (peer, rfc)
+        per_peer = defaultdict(int)  # requests in flight to each peer
+        with ThreadPoolExecutor(max_workers=self.max_inflight) as pool:
+            while pending or inflight:
+                # fill free slots, never exceeding the per peer limit
+                for rfc in list(pending):
+                    if len(inflight) >= self.max_inflight:
+                        break
+                    peer = scheduler.choose(rfc, holders[rfc], per_peer)
+                    if per_peer[peer] >= self.max_inflight_per_peer:
+                        continue
+                    pending.remove(rfc)
+                    inflight[pool.submit(self._fetch, peer, rfc)] = (peer, rfc)
+                    per_peer[peer] += 1
+
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    peer, rfc = inflight.pop(future)
+                    per_peer[peer] -= 1
+                    size, elapsed = future.result()
+                    times[peer].append((rfc, elapsed))
+                    if size is not None:
+                        scheduler.record_transfer(peer, size, elapsed)
+                        continue
+
+                    # this peer failed, give the RFC to another holder
+                    self.logger.error("Failed fetching RFC {} from {}".format(rfc, peer))
+                    holders[rfc].remove(peer)
+                    if holders[rfc]:
+                        pending.insert(0, rfc)
+                    else:
+                        self.logger.error("No peer left to fetch RFC {} from".format(rfc))
+        return times
+
+    def download_chunked(self, holders, chunk_size, scheduler=None):
+        """ downloads every RFC in Dict{rfc: [peers having it]} in chunks pulled from all of its holders
+
+        a peer with a free slot takes the next missing chunk of any RFC it holds, so fast peers end up
+        serving more chunks than slow ones. The first chunk of an RFC also tells its total size and the digests
+        of its blocks. With a partial_dir, the blocks are verified and written to a PartialFile there, and an
+        RFC left incomplete by an earlier call is resumed from its missing blocks, chunk_size bytes of them at a
+        time. A partial download whose digests no holder matches is discarded and started over, once. RFCs are started in the
+        scheduler's order, and every chunk is recorded with it as a transfer of the peer serving it.
+        Returns Dict{peer: [(rfc, seconds)]} with the time each peer spent serving each RFC.
+        """
+        scheduler = scheduler or Scheduler()
+        holders = {rfc: list(holders[rfc]) for rfc in scheduler.order(holders)}
+        everyone = {rfc: list(peers) for rfc, peers in holders.items()}  # holders to start an RFC over with
+        chunks = {}  # rfc -> missing (first, last) byte ranges
+        buffers = {}  # rfc -> bytearray of its total size or PartialFile, once known
+        remaining = {}  # rfc -> number of chunks not yet written to its bytearray
+        generation = defaultdict(int)  # rfc -> times it was started over, chunks of earlier attempts are ignored
+        mismatched = set()  # RFCs with a chunk that failed verification against the digests of their PartialFile
+        finished = set()
+        dropped = set()  # RFCs given up on, chunks of them still in flight are ignored
+
+        def restart(rfc):
+            """ drops the PartialFile of rfc, whose digests no holder matches, and starts it over from all of its
+            holders, only once, returns False and gives rfc up if it was started over before """
+            buffers.pop(rfc).discard()
+            chunks.pop(rfc, None)
+            mismatched.discard(rfc)
+            if generation[rfc]:
+                dropped.add(rfc)
+                return False
+            generation[rfc] += 1
+            holders[rfc] = list(everyone[rfc])
+            chunks[rfc] = deque([(0, chunk_size - 1)])
+            return True
+
+        for rfc in holders:
+            partial = self._resume(rfc)
+            if partial is None:
+                chunks[rfc] = deque([(0, chunk_size - 1)])
+            elif partial.complete():
+                self._finish(rfc, partial)
+                finished.add(rfc)
+            else:
+                buffers[rfc] = partial
+                chunks[rfc] = deque(partial.missing(chunk_size))
+        peers = list(dict.fromkeys(p for ps in holders.values() for p in ps))
+
+        times = defaultdict(lambda: defaultdict(float))
+        inflight = {}  # future -> (peer, rfc, first, last, generation of rfc)
+        per_peer = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=self.max_inflight) as pool:
+            while chunks or inflight:
+                for peer in peers:
+                    for rfc in [r for r in chunks if peer in holders[r]]:
+                        while chunks[rfc] and len(inflight) < self.max_inflight \
+                                and per_peer[peer] < self.max_inflight_per_peer:
+                            first, last = chunks[rfc].popleft()
+                            if isinstance(buffers.get(rfc), PartialFile) and buffers[rfc].verified(first, last):
+                                continue
+                            future = pool.submit(self._fetch_range, peer, rfc, first, last)
+                            inflight[future] = (peer, rfc, first, last, generation[rfc])
+                            per_peer[peer] += 1
+
+                if not inflight:
+                    break  # chunks are left, but none of their holders can serve them
+
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    peer, rfc, first, last, attempt = inflight.pop(future)
+                    per_peer[peer] -= 1
+                    chunk, total, digests, elapsed = future.result()
+                    times[peer][rfc] += elapsed
+                    if len(chunk):
+                        scheduler.record_transfer(peer, len(chunk), elapsed)
+                    if rfc in finished or rfc in dropped or attempt != generation[rfc]:
+                        continue
+
+                    buffer = buffers.get(rfc)
+                    if isinstance(buffer, PartialFile) and digests \
+                            and (total,) + tuple(digests) != (buffer.total, buffer.block_size, buffer.digests):
+                        # the RFC changed since the download started, or it started from wrong digests
+                        if restart(rfc):
+                            self.logger.error("RFC {} from {} differs from its partial download, starting over"
+                                              .format(rfc, peer))
+                        continue
+
+                    if rfc not in buffers and total:
+                        # size is known now, queue the rest of the RFC
+                        partial = self._create(rfc, total, digests)
+                        if partial is not None:
+                            buffers[rfc] = partial
+                            chunks[rfc].extend(partial.missing(chunk_size))  # those this chunk verifies are skipped
+                        else:
+                            buffers[rfc] = bytearray(total)
+                            last = min(last, total - 1)
+                            rest = [(i, min(i + chunk_size, total) - 1) for i in range(last + 1, total, chunk_size)]
+                            chunks[rfc].extend(rest)
+                            remaining[rfc] = len(rest) + 1
+
+                    received = total and len(chunk) == min(last, total - 1) - first + 1
+                    if not received or not self._write(buffers[rfc], first, chunk):
+                        # this peer failed, give the chunk to another holder
+                        self.logger.error("Failed fetching bytes {}-{} of RFC {} from {}".format(first, last, rfc, peer))
+                        if received:
+                            mismatched.add(rfc)
+                        if peer in holders[rfc]:
+                            holders[rfc].remove(peer)
+                        chunks.setdefault(rfc, deque()).append((first, last))
+                        if not holders[rfc]:
+                            if rfc in mismatched and isinstance(buffers.get(rfc), PartialFile):
+                                # don't leave digests no holder matches behind for the next download either
+                                if restart(rfc):
+                                    self.logger.error("No holder of RFC {} matches its digests, starting over"
+                                                      .format(rfc))
+                                    continue
+                            self.logger.error("No peer left to fetch RFC {} from".format(rfc))
+                            chunks.pop(rfc, None)
+                            buffers.pop(rfc, None)  # a PartialFile stays on disk to be resumed
+                            dropped.add(rfc)
+                        continue
+
+                    if isinstance(buffers[rfc], PartialFile):
+                        complete = buffers[rfc].complete()
+                    else:
+                        remaining[rfc] -= 1
+                        complete = not remaining[rfc]
+                    if complete:
+                        self._finish(rfc, buffers.pop(rfc))
+                        finished.add(rfc)
+                        chunks.pop(rfc, None)
+                    if rfc in chunks and not chunks[rfc]:
+                        del chunks[rfc]
+        return {peer: list(t.items()) for peer, t in times.items()}
+
+    def _resume(self, rfc):
+        """ PartialFile an earlier download of rfc left in partial_dir, or None """
+        if not self.partial_dir:
+            return None
+        partial = PartialFile.resume(self._path(rfc))
+        if partial is not None:
+            self.logger.info("Resuming RFC {}, {} block(s) missing".format(rfc, len(partial.missing())))
+        return partial
+
+    def _create(self, rfc, total, digests):
+        """ PartialFile to download rfc into, None without a partial_dir or digests to verify it against """
+        if not self.partial_dir or not digests:
+            return None
+        try:
+            return PartialFile.create(self._path(rfc), total, *digests)
+        except (OSError, ValueError) as e:
+            self.logger.error("Downloading RFC {} in memory: {}".format(rfc, e))
+            return None
+
+    def _write(self, buffer, first, chunk):
+        """ puts a chunk into its bytearray or PartialFile, False if it failed verification """
+        if not isinstance(buffer, PartialFile):
+            buffer[first: first + len(chunk)] = chunk
+            return True
+        try:
+            buffer.write(first, chunk)
+            return True
+        except (OSError, ValueError) as e:
+            self.logger.error(e)
+            return False
+
+    def _finish(self, rfc, buffer):
+        """ hands a downloaded RFC over to the platform peer """
+        if isinstance(buffer, PartialFile):
+            buffer.finish()
+            self.platform_peer.rfc_data.add_file(rfc, buffer.path)
+        else:
+            self.platform_peer._update_rfc_data({rfc: bytes(buffer)})
+
+    def _path(self, rfc):
+        return os.path.join(self.partial_dir, "rfc{}.txt".format(rfc))
+
+    def _fetch_range(self, peer, rfc, first, last):
+        """ fetches bytes first..last of one RFC, returns (data, total size, block digests, seconds taken) """
+        start_time = time.perf_counter()
+        chunk, total, digests = self.platform_peer.GetRFCRange(peer, rfc, first, last)
+        return chunk, total, digests, time.perf_counter() - start_time
+
+    def _fetch(self, peer, rfc):
+        """ fetches one RFC, returns (its size, None if the peer failed to send it, seconds taken) """
+        start_time = time.perf_counter()
+        try:
+            new_rfc = self.platform_peer.fetch_interested_rfc(peer, rfc)
+        except Exception as e:
+            self.logger.error(e)
+            new_rfc = {}
+        elapsed = time.perf_counter() - start_time
+        if rfc not in new_rfc:
+            return None, elapsed
+        self.platform_peer._update_rfc_data(new_rfc)
+        return len(new_rfc[rfc]), elapsed
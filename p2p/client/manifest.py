@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+from p2p.utils.app_utils import logger
+
+
+class Manifest(object):
+    """ size, mtime, sha256, sha256 of every block and offset of every RFC file in a directory, kept in a file next
+    to them
+
+    loading only stats the files, a file is read and hashed again only when its size or mtime changed,
+    so a peer knows its catalog in milliseconds without reading any RFC
+    """
+
+    NAME = ".manifest.json"
+
+    # files are hashed in blocks of this many bytes, the hashes of the blocks let downloads verify them one by one
+    BLOCK_SIZE = 1 << 18
+
+    def __init__(self, directory, path=None):
+        self.directory = directory
+        self.path = path or os.path.join(directory, Manifest.NAME)
+        self.entries = {}  # rfc -> {'file', 'size', 'mtime', 'sha256', 'blocks', 'offset'}
+        self.mutex = Lock()
+        self.logger = logger()
+
+    def load(self):
+        """ brings the manifest up to date with the directory, returns Dict{rfc: entry} """
+        with self.mutex:
+            saved = self._read()
+            entries, changed = {}, False
+            for item in os.scandir(self.directory):
+                if item.name.startswith('.') or not item.is_file():
+                    continue
+                stat = item.stat()
+                rfc = item.name[3:7]
+                entry = saved.get(rfc)
+                if not entry or entry['file'] != item.name or entry['size'] != stat.st_size \
+                        or entry['mtime'] != stat.st_mtime_ns or 'blocks' not in entry:
+                    blocks = []
+                    entry = dict(file=item.name, size=stat.st_size, mtime=stat.st_mtime_ns,
+                                 sha256=self._hash(item.path, blocks), blocks=blocks, offset=0)
+                    changed = True
+                entries[rfc] = entry
+            if changed or entries.keys() != saved.keys():
+                self._write(entries)
+            self.entries = entries
+            return entries
+
+    def file(self, rfc):
+        """ path of the file holding rfc """
+        return os.path.join(self.directory, self.entries[rfc]['file'])
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning("Rebuilding unreadable manifest {}: {}".format(self.path, e))
+            return {}
+
+    def _write(self, entries):
+        """ replaces the manifest atomically, peers sharing a directory may write it at the same time """
+        part = "{}.{}.{}".format(self.path, os.getpid(), id(self))
+        try:
+            with open(part, 'w') as f:
+                json.dump(entries, f)
+            os.replace(part, self.path)
+        except OSError as e:
+            self.logger.warning("Could not save manifest {}: {}".format(self.path, e))
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+
+    def blocks(self, rfc):
+        """ sha256 of every BLOCK_SIZE bytes of rfc, None when the rfc is not in the manifest """
+        entry = self.entries.get(rfc)
+        return entry and entry['blocks']
+
+    @staticmethod
+    def digests(data):
+        """ sha256 of every BLOCK_SIZE bytes of data """
+        return [hashlib.sha256(data[i: i + Manifest.BLOCK_SIZE]).hexdigest()
+                for i in range(0, len(data), Manifest.BLOCK_SIZE)]
+
+    @staticmethod
+    def _hash(path, blocks=None):
+        """ sha256 of the file, the sha256 of each of its blocks is appended to blocks when given """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(Manifest.BLOCK_SIZE), b''):
+                digest.update(block)
+                if blocks is not None:
+                    blocks.append(hashlib.sha256(block).hexdigest())
+        return digest.hexdigest()
@@ -0,0 +1,102 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from itertools import count
+from socket import create_connection, error, IPPROTO_TCP, TCP_NODELAY, SHUT_RDWR
+from threading import Lock, Thread
+
+from p2p.proto.proto import Headers, ServerResponse as Response
+from p2p.utils.app_utils import logger, send, recv, RECV_SIZE
+
+
+class MultiplexedConnection(object):
+    """ a single connection carrying many requests at once, responses are matched to requests by RequestId """
+
+    # seconds a request waits for its response
+    TIMEOUT = 30
+
+    def __init__(self, address, recv_size=RECV_SIZE, timeout=TIMEOUT):
+        self.address = address
+        self.recv_size = recv_size  # most bytes asked for by one recv_into
+        self.timeout = timeout
+        self.conn = create_connection(address)
+        self.conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.pending = {}  # request id -> Future, oldest first
+        self.closed = False
+        self.mutex = Lock()  # guards pending
+        self.send_lock = Lock()  # keeps frames of concurrent requests from interleaving
+        self._ids = count(1)
+        self.logger = logger()
+        self._reader = Thread(name="mux-{}:{}".format(*address), target=self._read, daemon=True)
+        self._reader.start()
+
+    def submit(self, msg):
+        """ sends msg without waiting for earlier requests, returns a Future of its Response """
+        future = Future()
+        with self.mutex:
+            if self.closed:
+                raise ConnectionResetError("Connection to {}:{} is closed".format(*self.address))
+            request_id = next(self._ids)
+            self.pending[request_id] = future
+        msg.headers[Headers.RequestId.name] = request_id
+        try:
+            with self.send_lock:
+                send(self.conn, msg)
+        except error:
+            with self.mutex:
+                self.pending.pop(request_id, None)
+            raise
+        return future
+
+    def request(self, msg, timeout=None):
+        """ sends msg and waits for its Response, raises TimeoutError after timeout (self.timeout) seconds """
+        future = self.submit(msg)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            with self.mutex:
+                self.pending.pop(msg.headers[Headers.RequestId.name], None)
+            raise TimeoutError("No response from {}:{} in time".format(*self.address))
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+        try:
+            # wakes up the reader blocked in recv, close alone leaves it and the connection hanging
+            self.conn.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def _read(self):
+        """ hands every response to the Future of the request with the same id """
+        try:
+            while True:
+                data = recv(self.conn, self.recv_size)
+                if not data:
+                    break
+                response = Response().from_bytes(data)
+                request_id = int(response.headers.get(Headers.RequestId.name, 0))
+                with self.mutex:
+                    if request_id:
+                        future = self.pending.pop(request_id, None)
+                    elif self.pending:
+                        # the server couldn't read the request id, it answers requests in the order they came
+                        future = self.pending.pop(next(iter(self.pending)))
+                    else:
+                        future = None
+                if future and request_id:
+                    future.set_result(response)
+                elif future:
+                    future.set_exception(ValueError("Response without RequestId from {}:{}, status {}".format(
+                        *self.address, response.status)))
+                else:
+                    # its request timed out already
+                    self.logger.error("[CLIENT] Response for unknown request from {}:{}".format(*self.address))
+        except (error, ValueError) as e:
+            if not self.closed:
+                self.logger.error("[CLIENT] Multiplexed connection to {}:{} failed: {}".format(*self.address, e))
+        finally:
+            with self.mutex:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionResetError("Connection to {}:{} closed".format(*self.address)))
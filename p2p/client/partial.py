@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+
+
+class PartialFile(object):
+    """ an RFC being downloaded in blocks into a sparse file next to the path it ends up at
+
+    a state file next to it records the total size, the sha256 of every block as published by the peer the
+    download started from, and a bitmap of the blocks written and verified so far. A download interrupted by
+    a peer leaving or this peer restarting resumes from the missing blocks, from whichever peer holds the RFC.
+    """
+
+    DATA = ".partial"
+    STATE = ".partial.json"
+
+    def __init__(self, path, total, block_size, digests, bitmap=None):
+        self.path = path  # where the RFC is moved once complete
+        self.total = total
+        self.block_size = block_size
+        self.digests = digests  # sha256 hex digest of every block
+        self.bitmap = bitmap or bytearray((len(digests) + 7) // 8)  # bit i is set once block i is verified
+
+    @staticmethod
+    def create(path, total, block_size, digests):
+        """ starts the download of a total bytes RFC into path, replacing an earlier partial download """
+        if block_size <= 0 or len(digests) != (total + block_size - 1) // block_size:
+            raise ValueError("{} digests don't cover {} bytes in blocks of {}".format(len(digests), total, block_size))
+        partial = PartialFile(path, total, block_size, digests)
+        with open(path + PartialFile.DATA, 'wb') as f:
+            f.truncate(total)  # sparse, blocks are written wherever they land
+        partial._save()
+        return partial
+
+    @staticmethod
+    def resume(path):
+        """ the partial download of path an earlier attempt left behind, None if there is none """
+        try:
+            with open(path + PartialFile.STATE) as f:
+                state = json.load(f)
+            if os.path.getsize(path + PartialFile.DATA) != state['total']:
+                return None
+            return PartialFile(path, state['total'], state['block_size'], state['digests'],
+                               bytearray.fromhex(state['bitmap']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def verified(self, first, last):
+        """ True if every block overlapping bytes first..last is verified """
+        return all(self._has(i) for i in range(first // self.block_size, last // self.block_size + 1))
+
+    def missing(self, chunk_size=None):
+        """ (first byte, last byte) of every block not verified yet, runs of them merged into ranges of up to
+        chunk_size bytes when given, rounded to whole blocks """
+        ranges = []
+        step = max(1, (chunk_size or 0) // self.block_size)  # blocks per range
+        for i in range(len(self.digests)):
+            if self._has(i):
+                continue
+            first, last = self._range(i)
+            if ranges and ranges[-1][1] + 1 == first and (last + 1 - ranges[-1][0]) <= step * self.block_size:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    def complete(self):
+        return all(self._has(i) for i in range(len(self.digests)))
+
+    def write(self, first, data):
+        """ writes the blocks lying wholly within data, which starts at byte first, returns how many were written
+
+        raises ValueError for a block that doesn't match its sha256
+        """
+        written = 0
+        view = memoryview(data)
+        with open(self.path + PartialFile.DATA, 'r+b') as f:
+            for i in range((first + self.block_size - 1) // self.block_size, len(self.digests)):
+                start, end = self._range(i)
+                if end >= first + len(data):
+                    break
+                if self._has(i):
+                    continue
+                block = view[start - first: end - first + 1]
+                if hashlib.sha256(block).hexdigest() != self.digests[i]:
+                    raise ValueError("Block {} of {} does not match its sha256".format(i, self.path))
+                f.seek(start)
+                f.write(block)
+                self.bitmap[i >> 3] |= 1 << (i & 7)
+                written += 1
+            if written:
+                # the blocks are on disk before the state says so
+                f.flush()
+                os.fsync(f.fileno())
+        if written:
+            self._save()
+        return written
+
+    def discard(self):
+        """ removes the partial download, the next one starts over """
+        for suffix in (PartialFile.DATA, PartialFile.STATE):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def finish(self):
+        """ moves the complete RFC to its path """
+        os.replace(self.path + PartialFile.DATA, self.path)
+        os.remove(self.path + PartialFile.STATE)
+
+    def _has(self, i):
+        return self.bitmap[i >> 3] & (1 << (i & 7))
+
+    def _range(self, i):
+        return i * self.block_size, min((i + 1) * self.block_size, self.total) - 1
+
+    def _save(self):
+        state = dict(total=self.total, block_size=self.block_size, digests=self.digests, bitmap=self.bitmap.hex())
+        with open(self.path + PartialFile.STATE + ".part", 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + PartialFile.STATE + ".part", self.path + PartialFile.STATE)
@@ -0,0 +1,119 @@
+import time
+from collections import deque
+from socket import create_connection, error, IPPROTO_TCP, TCP_NODELAY, MSG_PEEK
+from threading import Lock
+
+from p2p.proto.proto import MethodTypes
+from p2p.utils.app_utils import logger, send, recv, RECV_SIZE
+
+# requests which may be sent again when it is unknown whether the first attempt reached the other side,
+# a second Register would get a new cookie and a second Leave could rescind a registration made meanwhile
+IDEMPOTENT = {MethodTypes.PQuery.name, MethodTypes.Locate.name, MethodTypes.KeepAlive.name,
+              MethodTypes.RFCQuery.name, MethodTypes.GetRFC.name}
+
+
+class ConnectionPool(object):
+    """ keeps connections to peers and the RS open so consecutive requests skip the TCP handshake """
+
+    def __init__(self, max_size=32, idle_timeout=30, recv_size=RECV_SIZE):
+        self.max_size = max_size  # maximum number of idle connections kept open
+        self.idle_timeout = idle_timeout  # seconds after which an idle connection is closed
+        self.recv_size = recv_size  # most bytes asked for by one recv_into
+        self.idle = {}  # address -> deque of (conn, last used)
+        self.mutex = Lock()
+        self.logger = logger()
+
+    def request(self, address, msg):
+        """ sends msg to address and returns the raw reply, reusing an idle connection when possible
+
+        an idle connection the other side closed is replaced before anything is sent on it. A reused connection
+        failing during the exchange may have delivered msg already, it is sent again only if it is IDEMPOTENT
+        """
+        conn = self._acquire(address)
+        if conn:
+            try:
+                data = self._exchange(conn, msg)
+                self._release(address, conn)
+                return data
+            except error:
+                # closed while msg was on its way
+                conn.close()
+                if getattr(msg, 'method', None) not in IDEMPOTENT:
+                    raise
+        conn = create_connection(address)
+        # a kept-alive connection leaves slow start and quick acks behind, so small frames must not wait for ACKs
+        conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        try:
+            data = self._exchange(conn, msg)
+        except error:
+            conn.close()
+            raise
+        self._release(address, conn)
+        return data
+
+    def close(self):
+        """ closes every idle connection """
+        with self.mutex:
+            for conns in self.idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self.idle.clear()
+
+    def __len__(self):
+        with self.mutex:
+            return sum(len(conns) for conns in self.idle.values())
+
+    def _exchange(self, conn, msg):
+        send(conn, msg)
+        data = recv(conn, self.recv_size)
+        if not data:
+            raise ConnectionResetError("Connection closed by {}".format(conn.getpeername()))
+        return data
+
+    def _acquire(self, address):
+        """ most recently used idle connection to address which has not timed out, or None """
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self.mutex:
+            conns = self.idle.get(address)
+            while conns:
+                _conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout and self._alive(_conn):
+                    conn = _conn
+                    break
+                expired.append(_conn)
+            if conns is not None and not conns:
+                del self.idle[address]
+        for _conn in expired:
+            _conn.close()
+        return conn
+
+    @staticmethod
+    def _alive(conn):
+        """ False once the other side closed an idle connection, a reset or EOF is waiting on it then """
+        try:
+            conn.setblocking(False)
+            try:
+                # nothing is due on an idle connection, anything readable means it can't be used anymore
+                conn.recv(1, MSG_PEEK)
+                return False
+            finally:
+                conn.setblocking(True)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except error:
+            return False
+
+    def _release(self, address, conn):
+        """ returns a connection to the pool, closing the least recently used one when the pool is full """
+        evicted = None
+        with self.mutex:
+            self.idle.setdefault(address, deque()).append((conn, time.monotonic()))
+            if sum(len(conns) for conns in self.idle.values()) > self.max_size:
+                oldest = min(self.idle, key=lambda a: self.idle[a][0][1])
+                evicted, _ = self.idle[oldest].popleft()
+                if not self.idle[oldest]:
+                    del self.idle[oldest]
+        if evicted:
+            evicted.close()
@@ -0,0 +1,74 @@
+from threading import Lock
+
+
+class Scheduler(object):
+    """ decides in which order missing RFCs are downloaded and which peer each one is downloaded from
+
+    peers are measured as they are used: RFCQuery round trips give their latency, GetRFC transfers their
+    throughput. The Downloader asks choose for the next RFC whenever a slot frees up, so what was measured so far
+    in a download counts for the rest of it. This one takes RFCs in RFC Index order, each from its first holder,
+    like Peer.main always did. Pass a subclass to Peer(scheduler=...) to compare strategies, every peer makes its
+    own instance.
+    """
+
+    # weight of a new sample in the moving averages
+    ALPHA = 0.3
+
+    def __init__(self):
+        self.latency = {}  # peer -> seconds, moving average of RFCQuery round trips
+        self.throughput = {}  # peer -> bytes per second, moving average of GetRFC transfers
+        self.mean_size = 0  # bytes, moving average of the RFCs downloaded
+        self.mutex = Lock()
+
+    def record_latency(self, peer, seconds):
+        with self.mutex:
+            self.latency[peer] = self._average(self.latency.get(peer), seconds)
+
+    def record_transfer(self, peer, size, seconds):
+        """ size bytes took seconds to fetch from peer, its round trip is not counted as transfer time """
+        with self.mutex:
+            seconds = max(seconds - self.latency.get(peer, 0), 1e-6)
+            self.throughput[peer] = self._average(self.throughput.get(peer), size / seconds)
+            self.mean_size = self._average(self.mean_size or None, size)
+
+    def order(self, holders):
+        """ Dict{rfc: [peers holding it]} -> RFCs having a holder, in the order to start them """
+        return [rfc for rfc, peers in holders.items() if peers]
+
+    def choose(self, rfc, peers, load):
+        """ the peer among the holders of rfc to fetch it from, load is Dict{peer: requests queued at it} """
+        return peers[0]
+
+    def _average(self, average, sample):
+        return sample if average is None else (1 - self.ALPHA) * average + self.ALPHA * sample
+
+
+class RarestFirstScheduler(Scheduler):
+    """ RFCs held by the fewest peers first, each from the holder with the fewest requests queued
+
+    the rare RFCs are fetched while their few holders are still around, and copies of them spread sooner
+    """
+
+    def order(self, holders):
+        return sorted((rfc for rfc, peers in holders.items() if peers), key=lambda rfc: (len(holders[rfc]), rfc))
+
+    def choose(self, rfc, peers, load):
+        return min(peers, key=lambda p: (load[p], p))
+
+
+class ThroughputScheduler(RarestFirstScheduler):
+    """ rarest RFCs first, each from the holder expected to finish it soonest given the requests queued at it
+
+    an RFC is expected to take a peer its latency plus the mean RFC size over its throughput, after the requests
+    queued at it took as long each. Peers not measured yet are assumed to be as good as DEFAULT_THROUGHPUT and
+    DEFAULT_SIZE make them, so that they get tried.
+    """
+
+    DEFAULT_THROUGHPUT = 50 * 1024 * 1024  # bytes per second
+    DEFAULT_SIZE = 64 * 1024  # bytes
+
+    def choose(self, rfc, peers, load):
+        with self.mutex:
+            size = self.mean_size or self.DEFAULT_SIZE
+            cost = {p: self.latency.get(p, 0) + size / self.throughput.get(p, self.DEFAULT_THROUGHPUT) for p in peers}
+        return min(peers, key=lambda p: ((load[p] + 1) * cost[p], p))
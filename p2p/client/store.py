@@ -0,0 +1,173 @@
+import mmap
+import os
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from threading import Lock, Thread
+
+from p2p.client.manifest import Manifest
+from p2p.proto.proto import compress
+
+
+class RFCStore(MutableMapping):
+    """ RFC data by RFC number, behaves like the dict it replaces
+
+    RFCs on disk are memory mapped when first looked up instead of being read at startup, and only
+    budget bytes of them stay mapped, least recently used ones are unmapped first. Downloaded RFCs are
+    written to spool_dir when one is given and are then served like the ones on disk, otherwise they
+    are kept in memory. Compressed copies of recently requested RFCs are kept within compressed_budget
+    bytes, so a hot RFC is compressed once rather than for every request.
+    """
+
+    # bytes of memory mapped RFCs kept around
+    BUDGET = 64 * 1024 * 1024
+
+    # bytes of compressed RFCs kept around
+    COMPRESSED_BUDGET = 16 * 1024 * 1024
+
+    def __init__(self, budget=BUDGET, spool_dir=None, compressed_budget=COMPRESSED_BUDGET):
+        self.budget = budget
+        self.compressed_budget = compressed_budget
+        self.spool_dir = spool_dir
+        self.files = {}  # rfc -> path of its file
+        self.memory = {}  # rfc -> bytes of downloaded RFCs without a file
+        self.mapped = OrderedDict()  # rfc -> mmap of its file, least recently used first
+        self.mapped_bytes = 0
+        self.compressed = OrderedDict()  # (rfc, encoding) -> compressed data, least recently used first
+        self.compressed_bytes = 0
+        self.compressing = set()  # (rfc, encoding) being compressed in the background
+        self.oversized = set()  # (rfc, encoding) whose compressed data doesn't fit compressed_budget
+        self.digests = {}  # rfc -> sha256 of every Manifest.BLOCK_SIZE bytes, once asked for
+        self.mutex = Lock()
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+
+    def add_file(self, rfc, path):
+        """ makes the RFC in path available without reading it """
+        with self.mutex:
+            self._forget(rfc)
+            self.memory.pop(rfc, None)
+            self.files[rfc] = path
+
+    def compress(self, rfc, encoding, wait=True):
+        """ RFC data compressed with encoding, see proto.CODECS
+
+        without wait, only a cached copy is returned. None means there is none yet, and the RFC is then
+        compressed on a thread of its own for the requests to come, so an event loop never compresses
+        """
+        key = rfc, encoding
+        with self.mutex:
+            if key in self.compressed:
+                self.compressed.move_to_end(key)
+                return self.compressed[key]
+            if not wait:
+                if key not in self.compressing and key not in self.oversized:
+                    self.compressing.add(key)
+                    Thread(name="compress-{}".format(rfc), target=self._compress_later, args=key, daemon=True).start()
+                return None
+        data = compress(self[rfc], encoding)  # outside the mutex, other RFCs are served meanwhile
+        with self.mutex:
+            if len(data) > self.compressed_budget:
+                self.oversized.add(key)
+            elif key not in self.compressed:
+                self.compressed[key] = data
+                self.compressed_bytes += len(data)
+                while self.compressed_bytes > self.compressed_budget:
+                    _, dropped = self.compressed.popitem(last=False)
+                    self.compressed_bytes -= len(dropped)
+        return data
+
+    def blocks(self, rfc):
+        """ sha256 of every Manifest.BLOCK_SIZE bytes of the RFC data """
+        with self.mutex:
+            if rfc in self.digests:
+                return self.digests[rfc]
+        digests = Manifest.digests(self[rfc])
+        with self.mutex:
+            self.digests[rfc] = digests
+        return digests
+
+    def refresh(self, rfc):
+        """ picks rfc up from spool_dir when another process sharing the directory downloaded it there """
+        if not self.spool_dir or not rfc.isdigit() or rfc in self:
+            return
+        path = self._spool_path(rfc)
+        if os.path.isfile(path):
+            self.add_file(rfc, path)
+
+    def path(self, rfc):
+        """ file the RFC can be streamed from, None if it only lives in memory """
+        return self.files.get(rfc)
+
+    def __getitem__(self, rfc):
+        with self.mutex:
+            if rfc in self.memory:
+                return self.memory[rfc]
+            if rfc in self.mapped:
+                self.mapped.move_to_end(rfc)
+                return self.mapped[rfc]
+            path = self.files[rfc]
+            with open(path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return b''  # empty files can't be mapped
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped[rfc] = data
+            self.mapped_bytes += len(data)
+            while self.mapped_bytes > self.budget and len(self.mapped) > 1:
+                self._unmap(next(iter(self.mapped)))
+            return data
+
+    def __setitem__(self, rfc, data):
+        if not self.spool_dir:
+            with self.mutex:
+                self._forget(rfc)
+                self.files.pop(rfc, None)
+                # a memoryview of a received frame is kept as is, nothing else writes to the frame
+                self.memory[rfc] = data if isinstance(data, (bytes, memoryview)) else bytes(data)
+            return
+        path = self._spool_path(rfc)
+        with open(path + ".part", 'wb') as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+        self.add_file(rfc, path)
+
+    def __delitem__(self, rfc):
+        with self.mutex:
+            self._forget(rfc)
+            if self.memory.pop(rfc, None) is None:
+                del self.files[rfc]
+
+    def __contains__(self, rfc):
+        return rfc in self.memory or rfc in self.files
+
+    def __iter__(self):
+        with self.mutex:
+            return iter(list(self.files) + list(self.memory))
+
+    def __len__(self):
+        return len(self.files) + len(self.memory)
+
+    def _unmap(self, rfc):
+        """ forgets the mapping of rfc, it is unmapped once nobody uses it anymore """
+        data = self.mapped.pop(rfc, None)
+        if data is not None:
+            self.mapped_bytes -= len(data)
+
+    def _forget(self, rfc):
+        """ drops everything held of rfc before its data changes or goes away """
+        self._unmap(rfc)
+        self.digests.pop(rfc, None)
+        for key in [key for key in self.compressed if key[0] == rfc]:
+            self.compressed_bytes -= len(self.compressed.pop(key))
+        self.oversized = {key for key in self.oversized if key[0] != rfc}
+
+    def _compress_later(self, rfc, encoding):
+        try:
+            self.compress(rfc, encoding)
+        except (KeyError, OSError, ValueError):
+            pass  # gone or changed meanwhile, the next request tries again
+        finally:
+            with self.mutex:
+                self.compressing.discard((rfc, encoding))
+
+    def _spool_path(self, rfc):
+        return os.path.join(self.spool_dir, "rfc{}.txt".format(rfc))
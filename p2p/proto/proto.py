@@ -1,5 +1,18 @@
+import bz2
+import os
 import logging
+import lzma
+import zlib
 from enum import Enum
+from collections import defaultdict
+from struct import Struct
+
+from p2p.utils.app_utils import FileFrame
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class MethodTypes(Enum):
@@ -8,6 +21,7 @@ class MethodTypes(Enum):
     Leave = 2
     PQuery = 3
     KeepAlive = 4
+    Locate = 8  # peers holding each of the Wanted RFCs
 
     # peer to peer
     RFCQuery = 5
@@ -22,6 +36,27 @@ class Headers(Enum):
     ContentLength = 1
     ContentType = 2
     Cookie = 3
+    Accept = 4
+    Range = 5  # "<first byte>-<last byte>", both inclusive
+    ContentRange = 6  # "<first byte>-<last byte>/<total size>"
+    RequestId = 7  # set by the client, echoed by the server to match responses sent out of order
+    Since = 8  # RFCQuery: index version the client already has, only later changes are returned
+    IndexVersion = 9  # RFCQuery response: index version the payload brings the client up to
+    Wanted = 10  # RFCQuery, Locate: RFC numbers the client still needs, see encode_rfc_set
+    Holdings = 11  # Register, KeepAlive: RFC numbers the peer can serve, see encode_rfc_set
+    Limit = 12  # PQuery: at most this many peers
+    Offset = 13  # PQuery: skip this many peers of the list, for paging through it with Limit
+    Sample = 14  # PQuery: a random sample of this many peers instead of a page
+    AcceptEncoding = 15  # GetRFC: codecs the client can decompress, preferred first, e.g. "zstd,zlib"
+    ContentEncoding = 16  # GetRFC response: codec the body is compressed with, see CODECS
+    Digests = 17  # GetRFC response to a Range from byte 0: sha256 of every block of the RFC, see encode_digests
+    IndexEpoch = 18  # RFCQuery response: run of the peer IndexVersion counts in, RFCQuery: run Since was counted in
+
+
+class ContentTypes(Enum):
+    """ payload encodings of a GetRFC response """
+    Literal = 1  # str({rfc: rfc_data}), parsed with literal_eval
+    Raw = 2  # RFC data as is
 
 
 class ResponseStatus(Enum):
@@ -52,6 +87,19 @@ class Message(object):
     SR_HEADERS = "<hs>"
 
     VERSION = "P2Pv1"
+    VERSION2 = "P2Pv2"
+
+    # P2Pv2 binary frame: magic, version, method, status, flags, header count, body length
+    MAGIC = b'\xffP2P'  # 0xff never starts a utf-8 encoded P2Pv1 message
+    V2_HEADER = Struct('>4sBBHBBI')
+    V2_FIELD = Struct('>BBH')  # header id, value type, value length
+    V2_INT = Struct('>q')
+    V2_MAX_FIELD = 0xffff  # longest header value a V2_FIELD can carry
+
+    # P2Pv2 flags and field types
+    FL_TEXT = 1  # body is utf-8 text, otherwise raw bytes
+    FT_STR = 0
+    FT_INT = 1
 
     def __init__(self):
         self.method = ""
@@ -61,10 +109,19 @@ class Message(object):
         self.logger = logging.getLogger(__name__)
 
     def to_bytes(self):
+        if self.version == Message.VERSION2:
+            return self._pack()
         return bytes(self.__str__(), 'utf-8')
 
+    def to_frame(self):
+        """ what the server puts on the wire, see app_utils.send """
+        return self.to_bytes()
+
     def from_bytes(self, msg):
-        return self.from_str(msg.decode('utf-8'))
+        if msg[:len(self.MAGIC)] == self.MAGIC:
+            self._unpack(msg)
+            return self
+        return self.from_str(str(msg, 'utf-8'))
 
     def from_str(self, msg):
         """ loads a message from string """
@@ -101,6 +158,54 @@ class Message(object):
     def _get_headers(self, header_str):
         return dict([h.split(': ') for h in [_ for _ in header_str.split(self.SR_FIELDS)]])
 
+    def _pack(self, status=0, body_size=None):
+        """ P2Pv2 frame, body_size is given when the body is sent separately """
+        fields = []
+        try:
+            for k, v in self.headers.items():
+                if isinstance(v, int):
+                    value, field_type = self.V2_INT.pack(v), self.FT_INT
+                else:
+                    value, field_type = bytes(str(v), 'utf-8'), self.FT_STR
+                fields.append(self.V2_FIELD.pack(Headers[k].value, field_type, len(value)) + value)
+            method = MethodTypes[self.method].value
+        except KeyError as e:
+            raise ValueError("{} not supported by {}".format(e, Message.VERSION2))
+        body, flags = self.payload or b'', 0
+        if body_size is not None:
+            body = b''
+        elif isinstance(body, str):
+            body, flags = bytes(body, 'utf-8'), self.FL_TEXT
+        if body_size is None:
+            body_size = len(body)
+        header = self.V2_HEADER.pack(self.MAGIC, 2, method, status, flags, len(fields), body_size)
+        return b''.join([header] + fields + [body])
+
+    def _unpack(self, msg):
+        """ loads a P2Pv2 frame, returns its status. A raw body is a slice of msg, a memoryview when msg is one """
+        try:
+            _, _, method, status, flags, count, size = self.V2_HEADER.unpack_from(msg)
+            self.method, self.version = MethodTypes(method).name, Message.VERSION2
+            offset = self.V2_HEADER.size
+            for _ in range(count):
+                key, field_type, length = self.V2_FIELD.unpack_from(msg, offset)
+                offset += self.V2_FIELD.size
+                value = msg[offset: offset + length]
+                offset += length
+                if field_type == self.FT_INT:
+                    value = self.V2_INT.unpack(value)[0]
+                else:
+                    value = str(value, 'utf-8')
+                self.headers[Headers(key).name] = value
+            body = msg[offset: offset + size]
+            if len(body) != size:
+                raise ValueError("truncated body")
+            self.payload = str(body, 'utf-8') if flags & self.FL_TEXT else body
+            return status
+        except Exception as e:
+            self.logger.error("Error parsing message: {}".format(e))
+            raise ValueError("Invalid message {}".format(e))
+
 
 class ServerResponse(Message):
     """ a special message sent by server as a response """
@@ -118,6 +223,25 @@ class ServerResponse(Message):
     def __str__(self):
         return self.SR_COMPONENT.join([super().__str__(), str(self.status)])
 
+    def to_bytes(self):
+        if self.version == Message.VERSION2:
+            return self._pack(int(self.status))
+        return super().to_bytes()
+
+    def from_bytes(self, msg):
+        if msg[:len(self.MAGIC)] == self.MAGIC:
+            self.status = str(self._unpack(msg))
+            return self
+        return self.from_str(str(msg, 'utf-8'))
+
+    def negotiate(self, request):
+        """ answer in the protocol version the request was sent with, tagged with its request id """
+        if request.version == Message.VERSION2:
+            self.version = Message.VERSION2
+        if Headers.RequestId.name in request.headers:
+            self.headers[Headers.RequestId.name] = request.headers[Headers.RequestId.name]
+        return self
+
     def from_str(self, msg):
         """ loads a message from string """
         try:
@@ -130,3 +254,156 @@ class ServerResponse(Message):
     def _get_components(self, msg):
         meta, payload, _ = msg.split(self.SR_COMPONENT)
         return meta, payload
+
+
+class RawResponse(ServerResponse):
+    """ a response carrying raw RFC data, streamed from disk with os.sendfile when a path is given """
+
+    def __init__(self, body=b'', path=None, byte_range=None, status=ResponseStatus.Success.value):
+        super(RawResponse, self).__init__("", status)
+        self.path = path
+        total = os.path.getsize(path) if path else len(body)
+        self.offset, self.size = 0, total
+        if byte_range:
+            first, last = byte_range[0], min(byte_range[1], total - 1)
+            if not 0 <= first <= last:
+                raise ValueError("Range {}-{} not satisfiable for {} bytes".format(first, last, total))
+            self.offset, self.size = first, last - first + 1
+            self.headers[Headers.ContentRange.name] = "{}-{}/{}".format(first, last, total)
+        self.body = memoryview(body)[self.offset: self.offset + self.size]
+        self.headers[Headers.ContentType.name] = ContentTypes.Raw.name
+        self.headers[Headers.ContentLength.name] = self.size
+
+    def to_bytes(self):
+        if self.path:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                self.body = f.read(self.size)
+        if self.version == Message.VERSION2:
+            return self._head() + self.body
+        return b''.join([self._head(), self.body, self._tail()])
+
+    def to_frame(self):
+        if self.path:
+            return FileFrame(self._head(), self.path, self.offset, self.size, self._tail())
+        return self.to_bytes()
+
+    def _head(self):
+        if self.version == Message.VERSION2:
+            return self._pack(int(self.status), body_size=self.size)
+        return bytes(Message.__str__(self), 'utf-8')
+
+    def _tail(self):
+        if self.version == Message.VERSION2:
+            return b''
+        return bytes(self.SR_COMPONENT + str(self.status), 'utf-8')
+
+
+# codecs a P2Pv2 GetRFC body may be compressed with: name -> (compress, decompress)
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "bz2": (lambda data: bz2.compress(data, 9), bz2.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+# what the decompress functions of CODECS raise for corrupt or truncated data
+CODEC_ERRORS = (zlib.error, lzma.LZMAError, OSError, ValueError, EOFError)
+if zstandard is not None:
+    CODECS["zstd"] = (lambda data: zstandard.ZstdCompressor(level=19).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+    CODEC_ERRORS += (zstandard.ZstdError,)
+
+
+def choose_encoding(accept):
+    """ AcceptEncoding header -> first of its codecs found in CODECS, None if there is none """
+    for name in accept.split(","):
+        if name.strip() in CODECS:
+            return name.strip()
+    return None
+
+
+def compress(data, encoding):
+    return CODECS[encoding][0](data)
+
+
+def decompress(data, encoding):
+    """ raises ValueError for an unknown encoding or corrupt data """
+    try:
+        _, _decompress = CODECS[encoding]
+    except KeyError:
+        raise ValueError("Unknown content encoding {}".format(encoding))
+    try:
+        return _decompress(data)
+    except CODEC_ERRORS as e:
+        raise ValueError("Corrupt {} body: {}".format(encoding, e))
+
+
+def encode_digests(block_size, digests):
+    """ block size and sha256 hex digest of every block -> Digests header, '262144:<sha256>,<sha256>' """
+    return "{}:{}".format(block_size, ",".join(digests))
+
+
+def decode_digests(value):
+    """ inverse of encode_digests, returns (block size, [sha256]) """
+    block_size, digests = value.split(":")
+    return int(block_size), digests.split(",") if digests else []
+
+
+def parse_range(value):
+    """ Range header -> (first byte, last byte) """
+    first, last = value.split("-")
+    return int(first), int(last)
+
+
+def parse_content_range(value):
+    """ ContentRange header -> (first byte, last byte, total size) """
+    byte_range, total = value.split("/")
+    return parse_range(byte_range) + (int(total),)
+
+
+def encode_index(index):
+    """ RFC Index -> 'peer<fs>rfc,rfc' lines, the P2Pv2 alternative to str(dict) """
+    return "\n".join(["{}{}{}".format(peer, Message.SR_FIELDS, ",".join(rfcs)) for peer, rfcs in index.items()])
+
+
+def decode_index(payload):
+    """ inverse of encode_index """
+    index = defaultdict(set)
+    for line in payload.splitlines():
+        peer, rfcs = line.split(Message.SR_FIELDS)
+        index[peer].update(filter(None, rfcs.split(",")))
+    return index
+
+
+# most RFC numbers decode_rfc_set expands a Wanted or Holdings header into, a few bytes of ranges can list billions
+MAX_RFC_SET = 65536
+
+
+def encode_rfc_set(rfcs):
+    """ set of RFC numbers -> Wanted header, '8423-8430,8440' with consecutive numbers collapsed into ranges """
+    numbers = sorted(int(rfc) for rfc in rfcs if rfc.isdigit() and str(int(rfc)) == rfc)
+    parts = sorted(rfc for rfc in rfcs if not (rfc.isdigit() and str(int(rfc)) == rfc))  # e.g. '0791'
+    i = 0
+    while i < len(numbers):
+        j = i
+        while j + 1 < len(numbers) and numbers[j + 1] == numbers[j] + 1:
+            j += 1
+        parts.append(str(numbers[i]) if i == j else "{}-{}".format(numbers[i], numbers[j]))
+        i = j + 1
+    return ",".join(parts)
+
+
+def decode_rfc_set(value, limit=MAX_RFC_SET):
+    """ inverse of encode_rfc_set, raises ValueError rather than expand ranges into more than limit RFC numbers """
+    rfcs = set()
+    for part in filter(None, value.split(",")):
+        first, _, last = part.partition("-")
+        if last:
+            first, last = int(first), int(last)
+            if len(rfcs) + last - first + 1 > limit:
+                raise ValueError("{} lists more than {} RFCs".format(value[:64], limit))
+            rfcs.update(str(n) for n in range(first, last + 1))
+        else:
+            rfcs.add(part)
+    if len(rfcs) > limit:
+        raise ValueError("{} lists more than {} RFCs".format(value[:64], limit))
+    return rfcs
@@ -0,0 +1,61 @@
+import os
+import sys
+
+from p2p.server.rs import RegistrationServer
+from p2p.server.server import Server
+from p2p.utils.app_constants import RS_HOST, RS_PORT
+from p2p.utils.app_utils import logger, process_context
+
+
+def _serve(port, secret, event_loop, workers, journal_dir):
+    """ runs one shard of a cluster in its own process """
+    rs = RegistrationServer(RS_HOST, port, event_loop, workers, journal_dir=journal_dir, secret=secret)
+    rs.start()
+
+
+class Cluster(object):
+    """ RegistrationServer shards running as processes on this machine
+
+    peers hash their id onto the shards with a HashRing (ring.py) and register with the owning shard only.
+    The shards share a secret their cookies are derived from, so any of them accepts the PQuery and Locate
+    messages a peer fans out to all of them.
+    """
+
+    def __init__(self, ports, secret=None, event_loop=Server.SELECT, workers=0, journal_dir=None):
+        self.addresses = [(RS_HOST, port) for port in ports]  # the Peer(rs=...) of the peers using this cluster
+        self.secret = secret or os.urandom(16)
+        self.event_loop = event_loop
+        self.workers = workers
+        self.journal_dir = journal_dir  # each shard keeps its journal in a directory named after its port
+        self._processes = []
+        self.logger = logger()
+
+    def start(self):
+        """ starts a process per shard """
+        context = process_context()
+        for _, port in self.addresses:
+            journal_dir = os.path.join(self.journal_dir, str(port)) if self.journal_dir else None
+            process = context.Process(name="RS-{}".format(port), target=_serve, daemon=True,
+                                      args=(port, self.secret, self.event_loop, self.workers, journal_dir))
+            process.start()
+            self._processes.append(process)
+        self.logger.info("Started {} RS shards".format(len(self._processes)))
+
+    def stop(self):
+        """ stops all shards """
+        for process in self._processes:
+            process.terminate()
+            process.join()
+        self._processes = []
+
+
+if __name__ == "__main__":
+    shards = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    cluster = Cluster(range(RS_PORT, RS_PORT + shards))
+    cluster.start()
+    try:
+        for p in cluster._processes:
+            p.join()
+    except KeyboardInterrupt:
+        print("Stopping...")
+        cluster.stop()
@@ -0,0 +1,165 @@
+import json
+import os
+import time
+from threading import Event, Lock, Thread
+
+from p2p.utils.app_utils import logger
+
+
+class Journal(object):
+    """ write-ahead log of the RegistrationServer's client list, compacted into snapshots
+
+    every mutation is appended as one json line. Appends are fsynced in batches, once every sync_interval
+    seconds, so a crash loses at most that much. Once snapshot_every records are logged, the caller hands over
+    the whole state as a snapshot: the log is set aside and a new one started right away, and the journal
+    thread writes the snapshot and drops the old log, so the caller never waits for the disk.
+    """
+
+    LOG = "clients.log"
+    OLD_LOG = "clients.log.old"
+    SNAPSHOT = "clients.snapshot"
+
+    def __init__(self, directory, sync_interval=1.0, snapshot_every=10000):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.log_path = os.path.join(directory, Journal.LOG)
+        self.old_log_path = os.path.join(directory, Journal.OLD_LOG)
+        self.snapshot_path = os.path.join(directory, Journal.SNAPSHOT)
+        self.log = None
+        self.records = 0  # records in the log since the last snapshot
+        self.dirty = False  # appended but not yet fsynced
+        self.pending = None  # state of a snapshot not written yet
+        self.mutex = Lock()
+        self.writing = Lock()  # held while a snapshot is written
+        self.wake = Event()  # wakes the journal thread up before its next sync
+        self.logger = logger()
+        os.makedirs(directory, exist_ok=True)
+
+    def recover(self):
+        """ replays the snapshot and the log, returns Dict{client id: state} as it was before the restart """
+        start_time = time.perf_counter()
+        state = {}
+        try:
+            with open(self.snapshot_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        self.records = 0
+        # a log set aside for a snapshot the crash came before holds what the new log doesn't
+        for path in (self.old_log_path, self.log_path):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break  # torn write of the last record before a crash
+                        self.apply(state, record)
+                        self.records += 1
+            except FileNotFoundError:
+                pass
+        self.logger.info("Recovered {} clients from {} log records in {:.3f} s".format(
+            len(state), self.records, time.perf_counter() - start_time))
+        return state
+
+    @staticmethod
+    def apply(state, record):
+        """ applies one log record to Dict{client id: state} """
+        op, _id = record.pop("op"), record.pop("id")
+        if op == "register":
+            state[_id] = record
+        elif _id in state:
+            state[_id].update(record)
+
+    def open(self):
+        """ starts appending, fsyncing in the background """
+        self.log = open(self.log_path, 'a')
+        Thread(name="journal", target=self._sync_loop, daemon=True).start()
+
+    def append(self, op, _id, **fields):
+        """ logs a mutation of client _id, op is register for a new entry or anything else for an update """
+        line = json.dumps(dict(fields, op=op, id=_id)) + "\n"
+        with self.mutex:
+            if self.log is None:
+                return
+            self.log.write(line)
+            self.records += 1
+            self.dirty = True
+
+    def due(self):
+        """ True once the log is long enough to be compacted and no snapshot is being written """
+        return self.records >= self.snapshot_every and self.pending is None
+
+    def snapshot(self, state):
+        """ replaces snapshot and log with Dict{client id: state}, call with whatever state is taken from locked
+
+        only starts a new log here, appends made from now on go to it. The journal thread writes state and then
+        drops the old log, until then recover replays both on top of the last snapshot.
+        """
+        with self.mutex:
+            if self.pending is not None:
+                return  # the one being written covers the log up to now, the next one the rest
+            if self.log is not None:
+                self.log.close()
+            if os.path.exists(self.old_log_path) and os.path.exists(self.log_path):
+                # left over by a crash, its records are not in the last snapshot either
+                with open(self.log_path) as src, open(self.old_log_path, 'a') as dst:
+                    dst.write(src.read())
+                os.remove(self.log_path)
+            elif os.path.exists(self.log_path):
+                os.replace(self.log_path, self.old_log_path)
+            if self.log is not None:
+                self.log = open(self.log_path, 'w')
+            self.pending = state
+            self.records = 0
+            self.dirty = False
+        self.wake.set()
+
+    def _write_snapshot(self):
+        """ writes the pending snapshot, once it is durable the log set aside for it is dropped """
+        with self.writing:
+            state = self.pending
+            if state is None:
+                return
+            part = self.snapshot_path + ".part"
+            with open(part, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(part, self.snapshot_path)
+            # a crash before the old log is removed replays it on top of the snapshot, which is harmless
+            try:
+                os.remove(self.old_log_path)
+            except FileNotFoundError:
+                pass
+            with self.mutex:
+                self.pending = None
+
+    def sync(self):
+        """ makes everything appended so far durable """
+        with self.mutex:
+            if self.log is None or not self.dirty:
+                return
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.dirty = False
+
+    def close(self):
+        self._write_snapshot()
+        self.sync()
+        with self.mutex:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+        self.wake.set()
+
+    def _sync_loop(self):
+        while self.log is not None:
+            self.wake.wait(self.sync_interval)
+            self.wake.clear()
+            try:
+                self._write_snapshot()
+                self.sync()
+            except (OSError, ValueError) as e:
+                self.logger.error("Failed syncing journal: {}".format(e))
@@ -0,0 +1,35 @@
+import bisect
+import hashlib
+
+
+class HashRing(object):
+    """ consistent hashing of peer ids onto RS shards
+
+    every shard is placed on the ring replicas times, a peer id belongs to the first shard at or after its hash.
+    Adding or removing a shard only moves the peers next to its points.
+    """
+
+    # points per shard, more of them spread the peers more evenly
+    REPLICAS = 64
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(dict.fromkeys(tuple(node) for node in nodes))  # (host, port) of every shard
+        if not self.nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self.ring = sorted((self._hash("{}:{}#{}".format(host, port, i)), (host, port))
+                           for host, port in self.nodes for i in range(replicas))
+        self.points = [point for point, _ in self.ring]
+
+    def owner(self, key):
+        """ (host, port) of the shard owning key """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        i = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.ring[i][1]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
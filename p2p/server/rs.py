@@ -1,11 +1,17 @@
+import hashlib
+import heapq
+import hmac
 import random
+import time
 import datetime
+from collections import defaultdict
 from threading import Lock
 from p2p.server.server import Server
 from p2p.client.client import ClientEntry as Client
 from p2p.proto.proto import Message, ServerResponse as Response
 from p2p.proto.proto import ResponseStatus as Status, MethodTypes
-from p2p.proto.proto import Headers
+from p2p.proto.proto import Headers, encode_index, encode_rfc_set, decode_rfc_set
+from p2p.server.journal import Journal
 from p2p.utils.app_utils import ForbiddenError
 from p2p.utils.app_constants import RS_HOST, RS_PORT
 
@@ -15,22 +21,108 @@ random.seed(0)
 class RegistrationServer(Server):
     """ Registration Server """
 
-    def __init__(self, host, port):
-        super().__init__(host, port)
+    def __init__(self, host, port, event_loop=Server.SELECT, workers=0, journal_dir=None, secret=None):
+        super().__init__(host, port, event_loop, workers)
+        # shared by the shards of a cluster, cookies derived from it are accepted by every shard
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
         self.mutex = Lock()
+        self.journal = Journal(journal_dir) if journal_dir else None  # client list survives restarts when set
+        self.holders = defaultdict(set)  # rfc -> ids of active clients holding it
+        self.deadlines = []  # heap of (deadline, client id), about one entry per active client
+        self.active = set()  # ids of active clients
+        self._active = None  # (sorted active ids, PQuery payload listing them), built again after a change
 
-    def _reconcile(self):
-        """ reconcile state of the server periodically """
-        active = 0
-        for _, client in self.clients.items():
-            if client.flag is Client.FLAG_ACTIVE:
-                client.ttl = client.ttl - Server.INTERVAL
-                if client.ttl <= 0:
+    def _on_start(self):
+        """ recovers the client list logged before a restart, cookies included, so peers need not register again """
+        if self.journal is None:
+            return
+        now = time.time()
+        with self.mutex:
+            for _id, entry in self.journal.recover().items():
+                client = Client(host=entry["host"], p2port=entry["p2port"], cookie=entry["cookie"])
+                client.expires = entry["expires"]
+                client.rfcs = decode_rfc_set(entry["rfcs"])
+                self.clients[_id] = client
+                if entry["flag"] != Client.FLAG_ACTIVE or client.expires <= now:
                     client.flag = Client.FLAG_INACTIVE
-                    self.logger.info("Setting client {} inactive".format(client))
-                else:
-                    active += 1
-        self.logger.info("Reconcile status: {} clients active".format(active))
+                    continue
+                self._set_active(_id, True)
+                self._schedule(_id, client)
+                self._publish(_id, client, client.rfcs)
+            self.journal.open()
+            self.journal.snapshot(self._snapshot())
+        self.logger.info("{} of {} recovered clients active".format(len(self.active), len(self.clients)))
+
+    def _on_stop(self):
+        if self.journal is not None:
+            self.journal.close()
+
+    def _reconcile(self):
+        """ reconcile state of the server periodically, only looks at clients whose deadline has passed """
+        expired = 0
+        now = time.time()
+        with self.mutex:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, _id = heapq.heappop(self.deadlines)
+                client = self.clients.get(_id)
+                if client is None or client.deadline != deadline or client.flag is not Client.FLAG_ACTIVE:
+                    continue  # registered again or left since it was scheduled
+                if client.expires > now:
+                    self._schedule(_id, client)  # kept alive since it was scheduled
+                    continue
+                client.flag = Client.FLAG_INACTIVE
+                self._set_active(_id, False)
+                self._unpublish(_id, client)
+                expired += 1
+                self.logger.info("Setting client {} inactive".format(client))
+            active = len(self.active)
+            if self.journal is not None and self.journal.due():
+                self.journal.snapshot(self._snapshot())
+        self.logger.info("Reconcile status: {} clients expired, {} active".format(expired, active))
+
+    def _set_active(self, _id, active):
+        """ adds a client to or removes it from the active set, call with mutex held """
+        if active != (_id in self.active):
+            if active:
+                self.active.add(_id)
+            else:
+                self.active.discard(_id)
+            self._active = None
+
+    def _active_peers(self):
+        """ sorted list of active client ids and the PQuery payload listing them, call with mutex held """
+        if self._active is None:
+            active_peers = sorted(self.active)
+            self._active = active_peers, Message.SR_FIELDS.join(active_peers)
+        return self._active
+
+    @staticmethod
+    def _entry(client):
+        """ what the journal keeps of a client """
+        return dict(host=client.host, p2port=client.p2port, cookie=client.cookie, expires=client.expires,
+                    flag=client.flag, rfcs=encode_rfc_set(client.rfcs))
+
+    def _snapshot(self):
+        """ Dict{client id: entry} of all clients, call with mutex held """
+        return {_id: self._entry(client) for _id, client in self.clients.items()}
+
+    def _journal(self, op, _id, client, *fields):
+        """ logs a mutation of a client, all of its entry for a register or only fields, call with mutex held
+
+        expiry is not logged, it follows from expires when the journal is recovered
+        """
+        if self.journal is None:
+            return
+        entry = self._entry(client)
+        self.journal.append(op, _id, **{f: entry[f] for f in fields or entry})
+
+    def _schedule(self, _id, client):
+        """ makes _reconcile look at the client once it expires, call with mutex held
+
+        KeepAlive only moves client.expires, the entry is moved when its old deadline comes up
+        """
+        client.deadline = client.expires
+        heapq.heappush(self.deadlines, (client.deadline, _id))
 
     def _handle_register(self, conn, msg):
         """ handles register request """
@@ -39,10 +131,19 @@ class RegistrationServer(Server):
         try:
             host = conn.getpeername()[0]
             _, p2port = msg.payload.split(Message.SR_FIELDS)
-            client = Client(host=host, p2port=p2port, cookie=random.randint(1000, 9999))
-            self.clients[Client.id(host, p2port)] = client
+            _id = Client.id(host, p2port)
+            holdings = self._holdings(msg, set())  # a bad header is refused before anything changes
+            client = Client(host=host, p2port=p2port, cookie=self._cookie(_id))
+            if _id in self.clients:
+                self._unpublish(_id, self.clients[_id])
+            self.clients[_id] = client
+            self._set_active(_id, True)
+            self._schedule(_id, client)
+            self._publish(_id, client, holdings)
+            self._journal("register", _id, client)
             self.logger.info("Registered new client {}".format(client))
             response = Response("Success", Status.Success.value)
+            response.headers[Headers.Cookie.name] = client.cookie
         except (KeyError, ValueError):
             self.logger.error("Failed registering new client {}: Bad Message".format(client))
             response = Response("Error", Status.BadMessage.value)
@@ -51,7 +152,6 @@ class RegistrationServer(Server):
             response = Response("Internal Error", Status.InternalError.value)
         finally:
             self.mutex.release()
-        response.headers[Headers.Cookie.name] = client.cookie
         return response
 
     def _handle_leave(self, conn, msg):
@@ -66,13 +166,16 @@ class RegistrationServer(Server):
                 raise ForbiddenError
             self.clients[client].ttl = 0
             self.clients[client].flag = Client.FLAG_INACTIVE
+            self._set_active(client, False)
+            self._unpublish(client, self.clients[client])
+            self._journal("leave", client, self.clients[client], "expires", "flag")
             self.logger.info("Removed client {}".format(client))
             response = Response("Success", Status.Success.value)
         except (KeyError, ValueError):
             self.logger.error("Failed removing client {}".format(self.clients[client]))
             response = Response("Error", Status.BadMessage.value)
         except ForbiddenError:
-            self.logger.error("Forbidden client: {}".format(self.clients[client]))
+            self.logger.error("Forbidden client: {}".format(client))
             response = Response("Forbidden", Status.Forbidden.value)
         except Exception as e:
             self.logger.error("Failed removing client {}: {}".format(self.clients[client], e))
@@ -82,26 +185,35 @@ class RegistrationServer(Server):
         return response
 
     def _handle_pquery(self, conn, msg):
-        """ handles query request """
+        """ handles query request, the list of active peers includes the client itself so that it can be cached,
+        a Sample of it does not """
         client = None
         response = Response("Success", Status.Success.value)
         try:
             host = conn.getpeername()[0]
             _, p2port = msg.payload.split(Message.SR_FIELDS)
             client = Client.id(host, p2port)
-            if not self._validate_cookie(client, msg):
+            if not self._validate_cookie(client, msg, cluster=True):
                 raise ForbiddenError
 
-            active_peers = set()
-            for _id, peer in self.clients.items():
-                if peer.flag is Client.FLAG_ACTIVE:
-                    active_peers.add(_id)
-            if client in active_peers:
-                active_peers.remove(client)  # remove the requesting client from the set of active peers
+            with self.mutex:  # handlers may run on worker threads while a Register changes the active set
+                active_peers, payload = self._active_peers()
+            if Headers.Sample.name in msg.headers:
+                sample = self._count(msg, Headers.Sample, 0)
+                # one more than asked for, in case the client is among them
+                picked = random.sample(active_peers, min(sample + 1, len(active_peers)))
+                payload = Message.SR_FIELDS.join([peer for peer in picked if peer != client][:sample])
+            elif Headers.Offset.name in msg.headers or Headers.Limit.name in msg.headers:
+                offset = self._count(msg, Headers.Offset, 0)
+                limit = self._count(msg, Headers.Limit, len(active_peers))
+                payload = Message.SR_FIELDS.join(active_peers[offset: offset + limit])
             self.logger.info("{} active peer(s) found".format(len(active_peers)))
-            response.payload = Message.SR_FIELDS.join(active_peers)
+            response.payload = payload
+        except (KeyError, ValueError) as e:
+            self.logger.error("Bad query from client {}: {}".format(client, e))
+            response = Response("Error", Status.BadMessage.value)
         except ForbiddenError:
-            self.logger.error("Forbidden client: {}".format(self.clients[client]))
+            self.logger.error("Forbidden client: {}".format(client))
             response = Response("Forbidden", Status.Forbidden.value)
         except Exception as e:
             self.logger.error("Failed querying list of clients: %s" % str(e))
@@ -118,15 +230,25 @@ class RegistrationServer(Server):
             client = Client.id(host, p2port)
             if not self._validate_cookie(client, msg):
                 raise ForbiddenError
+            holdings = self._holdings(msg, self.clients[client].rfcs)  # a bad header is refused before anything changes
+            was_active = self.clients[client].flag is Client.FLAG_ACTIVE
             self.clients[client].ttl = Client.TTL
             self.clients[client].flag = Client.FLAG_ACTIVE
+            if not was_active:
+                self._set_active(client, True)
+                self._schedule(client, self.clients[client])
+            if Headers.Holdings.name in msg.headers or not was_active:
+                self._publish(client, self.clients[client], holdings)
+                self._journal("keepalive", client, self.clients[client], "expires", "flag", "rfcs")
+            else:
+                self._journal("keepalive", client, self.clients[client], "expires", "flag")
             self.logger.info("Extended TTL for client {}".format(self.clients[client]))
             response = Response("Success: TTL Extended", Status.Success.value)
         except (KeyError, ValueError) as e:
             self.logger.error("Failed extending TTL for client {}: {}".format(self.clients[client], e))
             response = Response("Error", Status.BadMessage.value)
         except ForbiddenError:
-            self.logger.error("Forbidden client: {}".format(self.clients[client]))
+            self.logger.error("Forbidden client: {}".format(client))
             response = Response("Forbidden: Invalid cookie", Status.Forbidden.value)
         except Exception as e:
             self.logger.error("Failed extending TTL for client {}: {}".format(self.clients[client], e))
@@ -135,6 +257,64 @@ class RegistrationServer(Server):
             self.mutex.release()
         return response
 
+    def _handle_locate(self, conn, msg):
+        """ handles locate request, returns the active peers holding each of the Wanted RFCs """
+        client = None
+        try:
+            host = conn.getpeername()[0]
+            _, p2port = msg.payload.split(Message.SR_FIELDS)
+            client = Client.id(host, p2port)
+            if not self._validate_cookie(client, msg, cluster=True):
+                raise ForbiddenError
+            wanted = decode_rfc_set(msg.headers[Headers.Wanted.name])
+            with self.mutex:
+                located = {rfc: self.holders[rfc] - {client} for rfc in wanted if self.holders.get(rfc)}
+            located = {rfc: peers for rfc, peers in located.items() if peers}
+            self.logger.info("{} of {} RFC(s) located".format(len(located), len(wanted)))
+            payload = encode_index(located) if msg.version == Message.VERSION2 else str(located)
+            response = Response(payload, Status.Success.value)
+        except ForbiddenError:
+            self.logger.error("Forbidden client: {}".format(client))
+            response = Response("Forbidden", Status.Forbidden.value)
+        except (KeyError, ValueError) as e:
+            self.logger.error("Failed locating RFCs for client {}: {}".format(client, e))
+            response = Response("Error", Status.BadMessage.value)
+        except Exception as e:
+            self.logger.error("Failed locating RFCs: %s" % str(e))
+            response = Response(Status.InternalError.name, Status.InternalError.value)
+        return response
+
+    @staticmethod
+    def _count(msg, header, default):
+        """ value of a header counting peers, default when there is none, ValueError unless it is a number >= 0 """
+        value = int(msg.headers.get(header.name, default))
+        if value < 0:
+            raise ValueError("{} is negative".format(header.name))
+        return value
+
+    @staticmethod
+    def _holdings(msg, default):
+        """ RFCs listed in the Holdings header, default when there is none """
+        if Headers.Holdings.name in msg.headers:
+            return decode_rfc_set(msg.headers[Headers.Holdings.name])
+        return default
+
+    def _publish(self, _id, client, rfcs):
+        """ replaces the RFCs an active client holds in the inverted index, call with mutex held """
+        self._unpublish(_id, client)
+        client.rfcs = rfcs
+        for rfc in rfcs:
+            self.holders[rfc].add(_id)
+
+    def _unpublish(self, _id, client):
+        """ drops a client from the inverted index, it keeps its rfcs until the next publish, call with mutex held """
+        for rfc in client.rfcs:
+            peers = self.holders.get(rfc)
+            if peers:
+                peers.discard(_id)
+                if not peers:
+                    del self.holders[rfc]
+
     def _new_message_callback(self, conn, msg):
         """ processes a message """
         p2pmsg = Message()
@@ -148,7 +328,8 @@ class RegistrationServer(Server):
                     MethodTypes.Register.name: self._handle_register,
                     MethodTypes.Leave.name: self._handle_leave,
                     MethodTypes.PQuery.name: self._handle_pquery,
-                    MethodTypes.KeepAlive.name: self._handle_keep_alive
+                    MethodTypes.KeepAlive.name: self._handle_keep_alive,
+                    MethodTypes.Locate.name: self._handle_locate
                 }[x]
 
             func = handler(p2pmsg.method)
@@ -166,18 +347,28 @@ class RegistrationServer(Server):
             self.logger.info("Took %s ms to process request %s" %
                              ((end_time - start_time).microseconds / 1000, p2pmsg.method))
             # send some message back to the client no matter what
-            self.messages[conn].put(response.to_bytes())
+            self.messages[conn].put(response.negotiate(p2pmsg).to_bytes())
 
     def _new_connection_callback(self, conn):
         """ process new connection """
         pass
 
-    def _validate_cookie(self, client, msg):
+    def _cookie(self, _id):
+        """ cookie for a new registration, derived from the cluster secret when there is one """
+        if self.secret is None:
+            return random.randint(1000, 9999)
+        return int.from_bytes(hmac.new(self.secret, _id.encode('utf-8'), hashlib.sha256).digest()[:4], 'big')
+
+    def _validate_cookie(self, client, msg, cluster=False):
+        """ cluster: accept clients registered with another shard of the cluster too """
         try:
             cookie = msg.headers[Headers.Cookie.name]
         except KeyError:
             raise ForbiddenError
-        return self.clients[client].cookie == int(cookie)
+        if client in self.clients:
+            return self.clients[client].cookie == int(cookie)
+        # an unknown client, e.g. one whose Register was lost in a restart, is told to register again
+        return cluster and self.secret is not None and self._cookie(client) == int(cookie)
 
 
 if __name__ == "__main__":
@@ -2,9 +2,12 @@ import time
 import queue
 import socket
 import select
+import selectors
 import errno
+from concurrent.futures import ThreadPoolExecutor
 from math import inf
-from p2p.utils.app_utils import logger, send, recv, get_true_hostname
+from threading import Lock, current_thread
+from p2p.utils.app_utils import logger, get_true_hostname, raise_fd_limit, SendBuffer, FrameReader, RECV_SIZE
 
 
 class Server(object):
@@ -13,7 +16,17 @@ class Server(object):
     # reconcile interval
     INTERVAL = 5
 
-    def __init__(self, host, port):
+    # pending connections the OS queues up before they are accepted
+    BACKLOG = socket.SOMAXCONN
+
+    # event loops
+    SELECT = "select"  # select.select over lists of sockets
+    SELECTORS = "selectors"  # epoll/kqueue through selectors, O(1) per event
+
+    # messages waiting for a worker, per worker, before the loop handles messages itself
+    QUEUE_PER_WORKER = 4
+
+    def __init__(self, host, port, event_loop=SELECT, workers=0, reuse_port=False, recv_size=RECV_SIZE):
         # self.host = host
         self.host = get_true_hostname()
         self.port = port
@@ -22,6 +35,22 @@ class Server(object):
         self.conn = None
         self.logger = logger()
         self.messages = {}  # message queue
+        self._readers = {}  # conn -> FrameReader of the request being received
+        self.recv_size = recv_size  # most bytes asked for by one recv_into on a client connection
+        self._buffers = {}  # conn -> SendBuffer of responses being written
+        self.event_loop = event_loop
+        self.selector = None
+        self._wakeup = None  # socket pair used to interrupt selector.select
+        self._accepting = True
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        self.reuse_port = reuse_port  # lets several processes listen on the same port, the kernel balances them
+        self.workers = workers  # threads running _new_message_callback, 0 runs it on the loop thread
+        self._pool = None
+        self._loop_thread = None  # thread running the event loop
+        self._queued = 0  # messages handed to the pool and not yet handled
+        self._queued_lock = Lock()
+        self._completed = queue.Queue()  # connections whose messages were handled by a worker
 
     def _new_connection_callback(self, conn):
         """ callback for new connection. override """
@@ -35,69 +64,112 @@ class Server(object):
         """ startup operations. override """
         pass
 
+    def _on_stop(self):
+        """ shutdown operations, run once the loop and the workers are done. override """
+        pass
+
     def _reconcile(self):
         """ reconcile loop """
         pass
 
+    @property
+    def queue_depth(self):
+        """ number of messages waiting for or being handled by a worker """
+        return self._queued
+
     def start(self, timeout=inf):
         """ starts the server """
-        self._on_start()
+        if self.workers:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="handler")
+        self._loop_thread = current_thread()
+        self._wakeup = socket.socketpair()
+        self._wakeup[0].setblocking(0)
 
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.setblocking(0)
+        # connections are kept alive and closed by the server, don't let their TIME_WAIT block a restart
+        self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.conn.bind((self.host, self.port))
-        self.conn.listen(5)
+        self.conn.listen(Server.BACKLOG)
+        # listen first, whoever learns about this server in _on_start may connect right away
+        self._on_start()
+
+        if self.event_loop == Server.SELECTORS:
+            self._run_selectors(timeout)
+        else:
+            self._run_select(timeout)
 
-        inputs = [self.conn]
+    def _run_select(self, timeout):
+        """ select.select loop, calls _reconcile every INTERVAL seconds """
+        inputs = [self.conn, self._wakeup[0]]
         outputs = []
         timeout = time.time() + timeout
+        next_reconcile = time.monotonic() + Server.INTERVAL
         self.logger.info("Started server on (%s, %s)" % (self.host, self.port))
         while not self.stopped and inputs and time.time() < timeout:
             try:
                 # listen for connections
-                readable, writeable, exceptional = select.select(inputs, outputs, inputs, Server.INTERVAL)
+                readable, writeable, exceptional = select.select(inputs, outputs, inputs,
+                                                                 max(0, next_reconcile - time.monotonic()))
 
-                # reconcile state
-                self._reconcile()
+                # reconcile state, not on every wakeup or a busy server would do it all the time
+                if time.monotonic() >= next_reconcile:
+                    self._reconcile()
+                    next_reconcile = time.monotonic() + Server.INTERVAL
 
                 for s in readable:
                     if s is self.conn:
                         conn, client = s.accept()
                         self.logger.info("Accepted connection from %s" % str(client))
                         inputs.append(conn)
-                        self.messages[conn] = queue.Queue()
+                        self._add(conn)
                         self._new_connection_callback(conn)
+                    elif s is self._wakeup[0]:
+                        self._drain_wakeup()
+                        for conn in self._handled():
+                            if conn in self.messages and conn not in outputs:
+                                outputs.append(conn)
                     else:
-                        data = recv(s)
+                        data = self._receive(s)
+                        if data is None:
+                            # rest of the frame has not arrived yet
+                            continue
                         if data:
                             self.logger.info(
-                                "Received message {} from {}:{}".format(data, s.getpeername()[0], s.getpeername()[1]))
+                                "Received message of {} bytes from {}:{}".format(len(data), *s.getpeername()[:2]))
                             if s not in outputs:
                                 outputs.append(s)
-                            self._new_message_callback(s, data)
+                            self._dispatch(s, data)
                         else:
                             if s in outputs:
                                 outputs.remove(s)
                             inputs.remove(s)
-                            s.close()
-                            del self.messages[s]
+                            self._discard(s)
 
                 for s in writeable:
+                    if s not in self.messages:
+                        continue
                     try:
-                        next_msg = self.messages[s].get_nowait()
-                    except queue.Empty:
+                        if self._flush(s):
+                            outputs.remove(s)
+                    except (OSError, EOFError) as e:
+                        self.logger.error("Failed sending message: {}".format(e))
                         outputs.remove(s)
-                    except KeyError:
-                        pass
-                    else:
-                        send(s, next_msg)
+                        if s in inputs:
+                            inputs.remove(s)
+                        self._discard(s)
 
                 for s in exceptional:
-                    inputs.remove(s)
-                    for s in outputs:
+                    if s in inputs:
+                        inputs.remove(s)
+                    if s in outputs:
                         outputs.remove(s)
-                    s.close()
-                    del self.messages[s]
+                    if s in self.messages:
+                        self._discard(s)
+                    else:
+                        s.close()
 
             except OSError as e:
                 if e.errno == errno.EBADF:
@@ -106,7 +178,193 @@ class Server(object):
                 raise e
         else:
             self.logger.info("Server running on {}:{} stopped".format(self.host, self.port))
-            self.stop()
+            # close kept-alive client connections too, so pooled clients see the server going away
+            for s in list(self.messages):
+                self._discard(s)
+            self._shutdown()
+
+    def _run_selectors(self, timeout):
+        """ selectors loop, calls _reconcile every INTERVAL seconds """
+        raise_fd_limit()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.conn, selectors.EVENT_READ)
+        self.selector.register(self._wakeup[0], selectors.EVENT_READ)
+
+        timeout = time.time() + timeout
+        next_reconcile = time.monotonic() + Server.INTERVAL
+        self.logger.info("Started server on (%s, %s)" % (self.host, self.port))
+        while not self.stopped and time.time() < timeout:
+            for key, events in self.selector.select(max(0, next_reconcile - time.monotonic())):
+                s = key.fileobj
+                if s is self.conn:
+                    self._accept()
+                elif s is self._wakeup[0]:
+                    self._drain_wakeup()
+                    for conn in self._handled():
+                        self._write(conn)
+                else:
+                    if events & selectors.EVENT_READ:
+                        self._read(s)
+                    if events & selectors.EVENT_WRITE and s in self.messages:
+                        self._write(s)
+
+            if time.monotonic() >= next_reconcile:
+                self._reconcile()
+                next_reconcile = time.monotonic() + Server.INTERVAL
+
+        self.logger.info("Server running on {}:{} stopped".format(self.host, self.port))
+        for s in list(self.messages):
+            self._close(s)
+        self.selector.close()
+        self._shutdown()
+
+    def _accept(self):
+        """ accepts every pending connection """
+        while True:
+            try:
+                conn, client = self.conn.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.error("Failed accepting connection: {}".format(e))
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    # out of file descriptors, stop accepting until a connection is closed
+                    self.selector.unregister(self.conn)
+                    self._accepting = False
+                return
+            self.logger.info("Accepted connection from %s" % str(client))
+            self._add(conn)
+            self.selector.register(conn, selectors.EVENT_READ)
+            self._new_connection_callback(conn)
+
+    def _read(self, s):
+        """ reads one message from a client, closes the connection when the client is gone """
+        data = self._receive(s)
+        if data is None:
+            return
+        if not data:
+            self._close(s)
+            return
+        self.logger.info("Received message of {} bytes from {}:{}".format(len(data), *s.getpeername()[:2]))
+        self._dispatch(s, data)
+        # most responses fit in the socket buffer, write them now instead of waiting for the next select
+        self._write(s)
+
+    def _write(self, s):
+        """ writes queued messages until the socket would block, waits for EVENT_WRITE only if some are left """
+        if s not in self.messages:
+            return  # closed while a worker was handling its message
+        try:
+            done = self._flush(s)
+        except (OSError, EOFError) as e:
+            self.logger.error("Failed sending message: {}".format(e))
+            self._close(s)
+            return
+        events = selectors.EVENT_READ if done else selectors.EVENT_READ | selectors.EVENT_WRITE
+        if self.selector.get_key(s).events != events:
+            self.selector.modify(s, events)
+
+    def _close(self, s):
+        self.selector.unregister(s)
+        self._discard(s)
+        if not self._accepting and not self.stopped:
+            self.selector.register(self.conn, selectors.EVENT_READ)
+            self._accepting = True
+
+    def _add(self, conn):
+        """ sets up a new client connection, both loops only ever write to it when it is writable """
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.messages[conn] = queue.Queue()
+        self._readers[conn] = FrameReader(self.recv_size)
+        self._buffers[conn] = SendBuffer()
+
+    def _receive(self, s):
+        """ next complete message from a client, None while it is incomplete, b'' once the client is gone """
+        try:
+            return self._readers[s].read(s)
+        except OSError:
+            return b''
+
+    def _flush(self, s):
+        """ moves queued messages into the send buffer of a client and writes as much of it as the socket
+        takes without blocking, returns True once nothing is left to write """
+        buffer = self._buffers[s]
+        while True:
+            try:
+                buffer.push(self.messages[s].get_nowait())
+            except queue.Empty:
+                break
+        return buffer.flush(s)
+
+    def on_loop(self):
+        """ True when called on the event loop thread, which serves no other connection meanwhile """
+        return current_thread() is self._loop_thread
+
+    def _dispatch(self, conn, msg):
+        """ hands a message to a worker, or handles it on the loop thread when there are no workers or
+        all of them are busy, which also stops the loop from reading faster than the workers keep up """
+        if self._pool is not None:
+            with self._queued_lock:
+                accept = self._queued < self.workers * Server.QUEUE_PER_WORKER
+                if accept:
+                    self._queued += 1
+            if accept:
+                self._pool.submit(self._handle, conn, msg)
+                return
+        self._new_message_callback(conn, msg)
+
+    def _handle(self, conn, msg):
+        """ runs on a worker, then tells the loop that conn has messages to send """
+        try:
+            self._new_message_callback(conn, msg)
+        except Exception as e:
+            self.logger.error("Failed handling message: {}".format(e))
+        finally:
+            with self._queued_lock:
+                self._queued -= 1
+            self._completed.put(conn)
+            self._wake()
+
+    def _handled(self):
+        """ connections completed by workers since the last call """
+        conns = []
+        while True:
+            try:
+                conns.append(self._completed.get_nowait())
+            except queue.Empty:
+                return conns
+
+    def _discard(self, s):
+        """ closes a client connection and drops its unsent messages """
+        s.close()
+        del self.messages[s]
+        del self._readers[s]
+        self._buffers.pop(s).close()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _wake(self):
+        """ interrupts a waiting selector loop """
+        try:
+            self._wakeup[1].send(b'\0')
+        except (OSError, TypeError):
+            pass
+
+    def _shutdown(self):
+        """ stops the workers and closes the wakeup sockets once the loop is done """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self.stop()
+        self._on_stop()
+        for s in self._wakeup:
+            s.close()
 
     def stop(self):
         """ stops the server """
@@ -115,3 +373,4 @@ class Server(object):
             self.conn.close()
         except OSError as e:
             self.logger.error('Error shutting down socket... {}'.format(e))
+        self._wake()
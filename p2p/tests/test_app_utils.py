@@ -0,0 +1,117 @@
+import os
+import socket
+import tempfile
+import unittest
+
+from p2p.utils.app_utils import SendBuffer, FrameReader, FileFrame, FrameTooLargeError, recv, send
+
+
+class SendBufferTest(unittest.TestCase):
+    """ non-blocking writes and reads of length prefixed frames """
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.a.setblocking(False)
+        self.b.setblocking(False)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_flush(self):
+        """ a frame larger than the socket buffer is written over several flushes """
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(os.urandom(1 << 20))
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        big = os.urandom(1 << 20)
+
+        buffer = SendBuffer()
+        buffer.push(big)
+        buffer.push(FileFrame(b'head', f.name, 10, 1000, b'tail'))
+        buffer.push(b'small')
+        self.assertFalse(buffer.flush(self.a))
+
+        reader = FrameReader()
+        frames = []
+        while len(frames) < 3:
+            frame = reader.read(self.b)
+            if frame is None:
+                buffer.flush(self.a)
+            else:
+                frames.append(frame)
+        self.assertTrue(buffer.flush(self.a))
+        self.assertEqual(len(buffer), 0)
+
+        with open(f.name, 'rb') as data:
+            data.seek(10)
+            self.assertEqual(frames, [big, b'head' + data.read(1000) + b'tail', b'small'])
+        self.assertIsNone(reader.read(self.b))
+
+    def test_read_closed(self):
+        """ a closed connection reads as b'' """
+        self.a.close()
+        self.assertEqual(FrameReader().read(self.b), b'')
+
+    def test_blocking_peer(self):
+        """ frames written by the buffer can be read by the blocking recv and vice versa """
+        self.b.setblocking(True)
+        buffer = SendBuffer()
+        buffer.push(b'ping')
+        self.assertTrue(buffer.flush(self.a))
+        self.assertEqual(recv(self.b), b'ping')
+        send(self.b, b'pong')
+        self.assertEqual(FrameReader().read(self.a), b'pong')
+
+    def test_recv(self):
+        """ the blocking recv fills one buffer in place and hands out a view of it """
+        self.a.setblocking(True)
+        self.b.setblocking(True)
+        big = os.urandom(100000)
+        send(self.a, big)
+        data = recv(self.b, recv_size=1000)
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(data, big)
+        self.a.sendall(b'\x00\x00\x00\x10short')
+        self.a.close()
+        self.assertEqual(recv(self.b), b'short')
+        self.assertEqual(recv(self.b), b'')
+
+    def test_max_frame(self):
+        """ a length prefix announcing more than max_frame bytes is refused before anything is allocated """
+        self.a.setblocking(True)
+        self.b.setblocking(True)
+        self.a.sendall(b'\xff\xff\xff\xff')
+        with self.assertRaises(FrameTooLargeError):
+            recv(self.b)
+        self.a.sendall(b'\x00\x00\x04\x00')
+        with self.assertRaises(FrameTooLargeError):
+            recv(self.b, max_frame=1023)
+        self.a.sendall(b'\x00\x00\x04\x01')
+        with self.assertRaises(FrameTooLargeError):
+            FrameReader(max_frame=1024).read(self.b)
+
+    def test_read_in_place(self):
+        """ FrameReader fills one buffer per frame, recv_size bytes at a time, and hands out a view of it """
+        calls = []
+
+        class Socket(object):
+            def recv_into(_, buf, size):
+                calls.append(size)
+                return self.b.recv_into(buf, size)
+
+        big = os.urandom(100000)
+        buffer = SendBuffer()
+        buffer.push(big)
+        reader = FrameReader(recv_size=30000)
+        frame = None
+        while frame is None:
+            buffer.flush(self.a)
+            frame = reader.read(Socket())
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(frame, big)
+        self.assertLessEqual(max(calls), 30000)
+
+
+if __name__ == "__main__":
+    unittest.main()
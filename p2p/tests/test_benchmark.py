@@ -0,0 +1,70 @@
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'experiment'))
+
+from benchmark import PortAllocator, percentile, summarize
+from p2p.utils.app_utils import get_true_hostname
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_port_allocator(self):
+        allocator = PortAllocator()
+        first = allocator.block(3)
+        self.assertEqual(len(set(first)), 3)
+        self.assertTrue(all(allocator.first <= port <= allocator.last for port in first))
+
+        # a port something listens on is skipped, and no port is handed out twice
+        with socket.socket() as s:
+            s.bind((get_true_hostname(), allocator.next))
+            s.listen(1)
+            taken = s.getsockname()[1]
+            second = allocator.block(3)
+        self.assertNotIn(taken, second)
+        self.assertFalse(set(first) & set(second))
+
+    def test_port_allocator_wraps(self):
+        allocator = PortAllocator()
+        allocator.next = allocator.last
+        ports = allocator.block(2)
+        self.assertEqual(len(set(ports)), 2)
+        self.assertTrue(all(allocator.first <= port <= allocator.last for port in ports))
+        self.assertLess(allocator.next, allocator.last)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([4, 1, 3, 2], 0), 1)
+        self.assertEqual(percentile([4, 1, 3, 2], 100), 4)
+        self.assertAlmostEqual(percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertAlmostEqual(percentile(range(11), 90), 9)
+
+    def test_summarize(self):
+        trials = [dict(task='task2', dataset='rfcs', peers=2, total=1.0, times=[0.5, 1.0], complete=2),
+                  dict(task='task2', dataset='rfcs', peers=2, total=3.0, times=[2.0, 3.0], complete=2),
+                  dict(task='task2', dataset='rfcs', peers=2, total=4.0, times=[4.0], complete=1),
+                  dict(task='task1', dataset='rfcs', peers=2, total=4.0, times=[4.0], complete=1)]
+        rows = {row['task']: row for row in summarize(trials)}
+
+        # the incomplete trial is counted, but not timed
+        row = rows['task2']
+        self.assertEqual((row['trials'], row['incomplete']), (3, 1))
+        self.assertAlmostEqual(row['complete'], 5 / 6)
+        self.assertAlmostEqual(row['total_mean'], 2.0)
+        self.assertAlmostEqual(row['total_p50'], 2.0)
+        self.assertAlmostEqual(row['total_p99'], 2.98)
+        self.assertAlmostEqual(row['peer_p50'], 1.5)
+
+        row = rows['task1']
+        self.assertEqual((row['trials'], row['incomplete']), (1, 1))
+        self.assertIsNone(row['total_mean'])
+        self.assertIsNone(row['total_p50'])
+        self.assertIsNone(row['peer_p90'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,17 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
+from p2p.client.client import Peer
+from p2p.proto.proto import Message, MethodTypes, Headers, ServerResponse, ContentTypes, decode_index
+from p2p.proto.proto import parse_content_range, decompress
+from p2p.utils.app_constants import RFC_PATH
+from p2p.utils.app_utils import send, recv
+
 
 class P2PClient(unittest.TestCase):
     """ Peer to Peer Client Test """
@@ -15,3 +27,172 @@ class P2PClient(unittest.TestCase):
     def test_receive(self):
         """ receives a message """
         pass
+
+    def test_index_since(self):
+        """ merges RFC Index updates and returns only what changed after a version """
+        peer = Peer("127.0.0.1", 0, {"1", "2"})
+        me, epoch = str(peer), peer.index_epoch
+        index, version = peer.index_since(0)
+        self.assertEqual((index, version), ({me: {"1", "2"}}, 1))
+
+        peer._update_rfc_index({"a:1": {"3"}, me: {"2"}})
+        peer._update_rfc_index({"a:1": {"3", "4"}, "b:2": {"5"}})
+        self.assertEqual(peer.rfc_index, {me: {"1", "2"}, "a:1": {"3", "4"}, "b:2": {"5"}})
+        self.assertEqual(peer.index_since(1, epoch), ({"a:1": {"3", "4"}, "b:2": {"5"}}, 4))
+        self.assertEqual(peer.index_since(3, epoch), ({"b:2": {"5"}}, 4))
+        self.assertEqual(peer.index_since(4, epoch), ({}, 4))
+        # a version this peer never had, or one of another run of it, gets the whole index
+        self.assertEqual(peer.index_since(9, epoch)[0], peer.rfc_index)
+        self.assertEqual(peer.index_since(3)[0], peer.rfc_index)
+
+    def test_index_since_restart(self):
+        """ a peer that restarted answers a Since counted in its earlier run with its whole RFC Index """
+        client = Peer("127.0.0.1", 0, set())
+        server = Peer("127.0.0.1", 0, {"1"})
+        address = str(server)
+        client._request = lambda _, msg: ServerResponse().from_bytes(
+            server.server._handle_rfcquery(None, msg).to_bytes())
+
+        server._update_rfc_index({"a:1": {"2"}, "b:2": {"3"}})
+        self.assertEqual(client.RFCQuery(address), {address: {"1"}, "a:1": {"2"}, "b:2": {"3"}})
+        self.assertEqual(client.index_seen[address], (server.index_epoch, 3))
+        server._update_rfc_index({"c:3": {"4"}})
+        self.assertEqual(client.RFCQuery(address), {"c:3": {"4"}})
+
+        # the new run is past the version the client saw, but it knows other peers
+        server = Peer("127.0.0.1", 0, {"1"})
+        for peer in ("d:4", "e:5", "f:6"):
+            server._update_rfc_index({peer: {"5"}})
+        self.assertEqual(server.index_version, 4)
+        self.assertEqual(client.RFCQuery(address), {address: {"1"}, "d:4": {"5"}, "e:5": {"5"}, "f:6": {"5"}})
+        self.assertEqual(client.index_seen[address], (server.index_epoch, 4))
+        server._update_rfc_index({"g:7": {"6"}})
+        self.assertEqual(client.RFCQuery(address), {"g:7": {"6"}})
+
+    def test_rfcquery_wanted(self):
+        """ answers RFCQuery with the intersection of its RFC Index and the Wanted RFCs """
+        peer = Peer("127.0.0.1", 0, {"8423", "8424", "8430"}, version=Message.VERSION2)
+        peer._update_rfc_index({"a:1": {"8425"}, "b:2": {"8431"}})
+        msg = peer.new_message(MethodTypes.RFCQuery, headers={Headers.Wanted.name: "8424-8426"})
+        response = peer.server._handle_rfcquery(None, msg)
+        self.assertEqual(decode_index(response.payload), {str(peer): {"8424"}, "a:1": {"8425"}})
+        self.assertEqual(response.headers[Headers.IndexVersion.name], 3)
+
+    def test_getrfc_range(self):
+        """ a Range running past the end of an RFC is served up to its last byte, like the first chunk of a
+        chunked download of an RFC smaller than the chunk size """
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        peer = Peer("127.0.0.1", 0, {"8423"}, manifest_path=os.path.join(spool_dir, "manifest.json"))
+        peer.load_rfcs()
+        peer.rfc_data["8424"] = b"short"  # downloaded, served from memory
+        size = os.path.getsize(os.path.join(RFC_PATH, "rfc8423.txt"))
+
+        for rfc, total in (("8423", size), ("8424", 5)):
+            msg = peer.new_message(MethodTypes.GetRFC, rfc, {Headers.Accept.name: ContentTypes.Raw.name,
+                                                             Headers.Range.name: "0-{}".format(size * 10)})
+            msg.version = Message.VERSION2
+            response = peer.server._handle_getrfc(None, msg).negotiate(msg)
+            response = ServerResponse().from_bytes(response.to_bytes())
+            self.assertEqual(int(response.status), 200)
+            self.assertEqual(parse_content_range(response.headers[Headers.ContentRange.name]), (0, total - 1, total))
+            self.assertEqual(len(response.payload), total)
+
+    def test_getrfc_encoding_loop(self):
+        """ on the event loop, an RFC not compressed yet is sent as is and compressed for the next requests """
+        peer = Peer("127.0.0.1", 0, {"8423"})
+        peer.load_rfcs()
+        peer.server._loop_thread = threading.current_thread()  # handled as if on the loop of a server with no workers
+        with open(os.path.join(RFC_PATH, "rfc8423.txt"), 'rb') as f:
+            expected = f.read()
+
+        def fetch():
+            msg = peer.new_message(MethodTypes.GetRFC, "8423", {Headers.Accept.name: ContentTypes.Raw.name,
+                                                                 Headers.AcceptEncoding.name: "zlib"})
+            msg.version = Message.VERSION2
+            response = peer.server._handle_getrfc(None, msg).negotiate(msg)
+            return ServerResponse().from_bytes(response.to_bytes())
+
+        response = fetch()
+        self.assertNotIn(Headers.ContentEncoding.name, response.headers)
+        self.assertEqual(bytes(response.payload), expected)
+        deadline = time.monotonic() + 5
+        while peer.rfc_data.compressing and time.monotonic() < deadline:
+            time.sleep(0.01)
+        response = fetch()
+        self.assertEqual(response.headers[Headers.ContentEncoding.name], "zlib")
+        self.assertEqual(decompress(bytes(response.payload), "zlib"), expected)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "SO_REUSEPORT is not supported on this platform")
+    def test_server_processes(self):
+        """ a peer with 2 server processes serves GetRFC from its own server and from the spawned one, which also
+        serves RFCs spooled after it started and answers RFCQuery from the peer's RFC Index """
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        with socket.socket() as s:
+            s.bind(('', 0))
+            port = s.getsockname()[1]
+        peer = Peer("127.0.0.1", port, {"8423"}, server_processes=2, spool_dir=os.path.join(spool_dir, "spool"),
+                    manifest_path=os.path.join(spool_dir, "manifest.json"), version=Message.VERSION2)
+        peer.server.register = False  # no RS to register with
+        with open(os.path.join(RFC_PATH, "rfc8423.txt"), 'rb') as f:
+            expected = f.read()
+
+        def request(method, payload, headers):
+            """ a request on a new connection, so the kernel picks the process serving it """
+            msg = peer.new_message(method, payload, headers)
+            with socket.create_connection((peer.server.host, port), timeout=5) as conn:
+                send(conn, msg)
+                response = ServerResponse().from_bytes(recv(conn))
+            self.assertEqual(int(response.status), 200)
+            return response
+
+        def fetch(rfc):
+            return bytes(request(MethodTypes.GetRFC, rfc, {Headers.Accept.name: ContentTypes.Raw.name}).payload)
+
+        def retry(f, *args):
+            """ f(*args) once a process listens """
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    return f(*args)
+                except (ConnectionRefusedError, ConnectionResetError):
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+
+        peer.start()
+        try:
+            self.assertEqual(len(peer._processes), 1)
+            self.assertEqual(retry(fetch, "8423"), expected)
+            peer.rfc_data["8424"] = b"downloaded"  # spooled by the peer's own process
+            peer._update_rfc_index({"a:1": {"9999"}})
+
+            # without the peer's own server, the spawned process still serves the port
+            peer.server.stop()
+            peer._server_thread.join()
+            for _ in range(5):
+                self.assertEqual(retry(fetch, "8423"), expected)
+            self.assertEqual(retry(fetch, "8424"), b"downloaded")
+            response = retry(request, MethodTypes.RFCQuery, "", {})
+            self.assertEqual(response.headers[Headers.IndexEpoch.name], peer.index_epoch)
+            self.assertEqual(decode_index(response.payload), {str(peer): {"8423"}, "a:1": {"9999"}})
+            since = {Headers.IndexEpoch.name: peer.index_epoch, Headers.Since.name: 1}
+            self.assertEqual(decode_index(retry(request, MethodTypes.RFCQuery, "", since).payload),
+                             {"a:1": {"9999"}})
+        finally:
+            peer.server.stop()
+            for process in peer._processes:
+                process.terminate()
+                process.join()
+
+    def test_holdings_processes(self):
+        """ with several server processes only RFCs every process can serve from a file are published """
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        peer = Peer("127.0.0.1", 0, {"8423"}, server_processes=2, manifest_path=os.path.join(spool_dir, "manifest.json"))
+        peer.load_rfcs()
+        peer.rfc_data["8424"] = b"in memory"
+        self.assertEqual(peer.server._holdings({}), {"8423"})
+        peer.server_processes = 1
+        self.assertEqual(peer.server._holdings({}), {"8423", "8424"})
@@ -0,0 +1,194 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from collections import defaultdict
+from threading import Lock
+
+from p2p.client.downloader import Downloader
+from p2p.client.partial import PartialFile
+from p2p.client.scheduler import ThroughputScheduler
+from p2p.client.store import RFCStore
+
+DATA = {"8423": bytes(range(256)) * 40, "8424": b"short"}
+
+
+class FakePeer(object):
+    """ records how many GetRFC requests are in flight """
+
+    def __init__(self, block_size=None):
+        self.mutex = Lock()
+        self.rfc_data = {}
+        self.block_size = block_size  # when set, the first chunk brings the digests of blocks of this size
+        self.inflight = defaultdict(int)
+        self.max_seen = defaultdict(int)
+        self.served = defaultdict(int)
+
+    def fetch_interested_rfc(self, peer, rfc):
+        with self.mutex:
+            self.inflight[peer] += 1
+            self.inflight['all'] += 1
+            for k in (peer, 'all'):
+                self.max_seen[k] = max(self.max_seen[k], self.inflight[k])
+        time.sleep(0.3 if peer == "slow" else 0.01)
+        with self.mutex:
+            self.inflight[peer] -= 1
+            self.inflight['all'] -= 1
+            self.served[peer] += 1
+        if peer == "broken":
+            return {}
+        return {rfc: rfc.encode()}
+
+    def GetRFCRange(self, peer, rfc, first, last):
+        data = DATA[rfc]
+        with self.mutex:
+            self.served[peer] += 1
+        if peer == "broken":
+            return b'', 0, None
+        digests = None
+        if self.block_size and first == 0:
+            digests = self.block_size, [hashlib.sha256(data[i: i + self.block_size]).hexdigest()
+                                        for i in range(0, len(data), self.block_size)]
+        if peer == "flaky" and first > 0:
+            return b'', 0, None
+        chunk = data[first: last + 1]
+        if peer == "corrupt" and first > 0:
+            chunk = bytes(len(chunk))
+        return chunk, len(data), digests
+
+    def _update_rfc_data(self, new_rfc):
+        with self.mutex:
+            self.rfc_data.update(new_rfc)
+
+
+class DownloaderTest(unittest.TestCase):
+    """ concurrent download engine """
+
+    def test_download(self):
+        """ downloads every job and reports per peer timings """
+        peer = FakePeer()
+        holders = {str(i): ["p1"] for i in range(10)}
+        holders.update({str(i): ["p2"] for i in range(10, 15)})
+        times = Downloader(peer, max_inflight=4, max_inflight_per_peer=2).download(holders)
+
+        self.assertEqual(sorted(times), ["p1", "p2"])
+        self.assertEqual(sorted(rfc for rfc, _ in times["p1"]), sorted(str(i) for i in range(10)))
+        self.assertEqual(len(times["p2"]), 5)
+        self.assertEqual(len(peer.rfc_data), 15)
+        self.assertLessEqual(peer.max_seen["all"], 4)
+        self.assertLessEqual(peer.max_seen["p1"], 2)
+        self.assertLessEqual(peer.max_seen["p2"], 2)
+
+    def test_serial(self):
+        """ default limits behave like the serial loop """
+        peer = FakePeer()
+        times = Downloader(peer).download({"1": ["p1"], "2": ["p2"], "3": ["p1"]})
+        self.assertEqual([rfc for rfc, _ in times["p1"]], ["1", "3"])
+        self.assertEqual(peer.max_seen["all"], 1)
+
+    def test_download_retry(self):
+        """ an RFC a holder failed to send is fetched from its other holders, once """
+        peer = FakePeer()
+        Downloader(peer, max_inflight=2).download({"1": ["broken", "p1"], "2": ["broken"], "3": ["p1"]})
+        self.assertEqual(peer.rfc_data, {"1": b"1", "3": b"3"})
+        self.assertEqual(peer.served, {"broken": 2, "p1": 2})
+
+    def test_download_scheduled(self):
+        """ transfers measured during a download decide where the rest of it goes """
+        peer = FakePeer()
+        holders = {str(i): ["slow", "fast"] for i in range(10)}
+        Downloader(peer, max_inflight=2).download(holders, ThroughputScheduler())
+        self.assertEqual(len(peer.rfc_data), 10)
+        # the slow peer is tried once, the fast one serves everything after measuring both
+        self.assertLessEqual(peer.served["slow"], 2)
+
+    def test_download_chunked(self):
+        """ splits RFCs into chunks pulled from every holder and reassembles them """
+        peer = FakePeer()
+        holders = {"8423": ["broken", "p1", "p2"], "8424": ["p2"]}
+        times = Downloader(peer, max_inflight=4, max_inflight_per_peer=2).download_chunked(holders, 1000)
+
+        self.assertEqual(peer.rfc_data, DATA)
+        self.assertGreater(peer.served["p1"], 1)
+        self.assertGreater(peer.served["p2"], 1)
+        self.assertEqual(peer.served["broken"], 1)
+        self.assertEqual(sorted(rfc for rfc, _ in times["p2"]), ["8423", "8424"])
+
+    def test_download_chunked_no_holder(self):
+        """ gives up on an RFC once all of its holders failed """
+        peer = FakePeer()
+        Downloader(peer, max_inflight=2).download_chunked({"8423": ["broken"], "8424": ["p1"]}, 2)
+        self.assertEqual(peer.rfc_data, {"8424": b"short"})
+
+    def test_download_chunked_resume(self):
+        """ verified blocks are kept on disk and a later download only fetches the missing ones, chunk_size
+        bytes at a time """
+        partial_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, partial_dir)
+        peer = FakePeer(block_size=1000)
+        peer.rfc_data = RFCStore(spool_dir=partial_dir)
+        downloader = Downloader(peer, max_inflight=2, partial_dir=partial_dir)
+
+        # the flaky peer serves the first chunk and goes away
+        downloader.download_chunked({"8423": ["flaky"]}, 2500)
+        self.assertNotIn("8423", peer.rfc_data)
+        partial = PartialFile.resume(os.path.join(partial_dir, "rfc8423.txt"))
+        self.assertEqual(len(partial.missing()), 9)
+
+        downloader.download_chunked({"8423": ["p1"], "8424": ["p1"]}, 2500)
+        # blocks 2-10 in ranges of 2 blocks, and 8424
+        self.assertEqual(peer.served["p1"], 5 + 1)
+        self.assertEqual(bytes(peer.rfc_data["8423"]), DATA["8423"])
+        self.assertEqual(bytes(peer.rfc_data["8424"]), DATA["8424"])
+        self.assertIsNone(PartialFile.resume(os.path.join(partial_dir, "rfc8423.txt")))
+
+    def test_download_chunked_poisoned(self):
+        """ a partial download whose digests the holders don't match is started over instead of being stuck """
+        partial_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, partial_dir)
+        path = os.path.join(partial_dir, "rfc8423.txt")
+        data = DATA["8423"]
+        good = [hashlib.sha256(data[i: i + 1000]).hexdigest() for i in range(0, len(data), 1000)]
+        bad = [hashlib.sha256(b"stale").hexdigest()] * len(good)
+
+        # wrong from the first block on, the digests sent with the first chunk tell
+        # only block 0 right, every other block fails verification with every holder
+        for digests in (bad, good[:1] + bad[1:]):
+            partial = PartialFile.create(path, len(data), 1000, digests)
+            if digests[0] == good[0]:
+                partial.write(0, data[:1000])
+            peer = FakePeer(block_size=1000)
+            peer.rfc_data = RFCStore(spool_dir=partial_dir)
+            Downloader(peer, max_inflight=2, partial_dir=partial_dir).download_chunked({"8423": ["p1", "p2"]}, 2500)
+            self.assertEqual(bytes(peer.rfc_data["8423"]), data)
+            self.assertEqual(sorted(os.listdir(partial_dir)), ["rfc8423.txt"])
+            os.remove(path)
+
+        # the only holder is corrupt, its partial download is not left behind to fail again, also while chunks
+        # of the attempt given up on are still in flight
+        for max_inflight in (1, 4):
+            peer = FakePeer(block_size=256)
+            peer.rfc_data = RFCStore(spool_dir=partial_dir)
+            Downloader(peer, max_inflight, max_inflight, partial_dir=partial_dir).download_chunked(
+                {"8423": ["corrupt"], "8424": ["p1"]}, 256)
+            self.assertNotIn("8423", peer.rfc_data)
+            self.assertEqual(bytes(peer.rfc_data["8424"]), DATA["8424"])
+            self.assertEqual(sorted(os.listdir(partial_dir)), ["rfc8424.txt"])
+            os.remove(os.path.join(partial_dir, "rfc8424.txt"))
+
+    def test_download_chunked_gone(self):
+        """ an RFC whose holders all fail is given up on while chunks of it are in flight, its partial download
+        is kept for the next call """
+        partial_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, partial_dir)
+        peer = FakePeer(block_size=256)
+        peer.rfc_data = RFCStore(spool_dir=partial_dir)
+        Downloader(peer, 4, 4, partial_dir=partial_dir).download_chunked({"8423": ["flaky"]}, 256)
+        self.assertNotIn("8423", peer.rfc_data)
+        partial = PartialFile.resume(os.path.join(partial_dir, "rfc8423.txt"))
+        self.assertEqual(partial.missing()[0][0], 256)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from p2p.server.journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+    """ write-ahead log of the RS client list """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_recover(self):
+        """ records are replayed on top of the snapshot, a torn last record is ignored """
+        journal = Journal(self.dir, snapshot_every=3)
+        journal.open()
+        journal.append("register", "a", cookie=1, flag=1)
+        journal.append("register", "b", cookie=2, flag=1)
+        journal.append("leave", "b", flag=0)
+        self.assertTrue(journal.due())
+        journal.snapshot({"a": dict(cookie=1, flag=1), "b": dict(cookie=2, flag=0)})
+        self.assertFalse(journal.due())
+        journal.append("keepalive", "a", flag=1, expires=10)
+        journal.append("register", "c", cookie=3, flag=1)
+        journal.close()
+        with open(journal.log_path, 'a') as f:
+            f.write('{"op": "leave", "id": ')
+
+        journal = Journal(self.dir)
+        self.assertEqual(journal.recover(), {"a": dict(cookie=1, flag=1, expires=10), "b": dict(cookie=2, flag=0),
+                                             "c": dict(cookie=3, flag=1)})
+        self.assertEqual(journal.records, 2)
+
+    def test_snapshot_background(self):
+        """ the snapshot is written by the journal thread, a crash before it is done loses nothing """
+        journal = Journal(self.dir, sync_interval=60)
+        journal.open()
+        journal.append("register", "a", cookie=1, flag=1)
+        journal.append("register", "b", cookie=2, flag=1)
+        with journal.writing:
+            # snapshot returns while the journal thread is held up, appends go on to the new log
+            journal.snapshot({"a": dict(cookie=1, flag=1), "b": dict(cookie=2, flag=1)})
+            self.assertFalse(os.path.exists(journal.snapshot_path))
+            journal.append("leave", "b", flag=0)
+            self.assertFalse(journal.due())
+            journal.sync()
+            self.assertEqual(Journal(self.dir).recover(), {"a": dict(cookie=1, flag=1), "b": dict(cookie=2, flag=0)})
+        journal.close()
+        self.assertTrue(os.path.exists(journal.snapshot_path))
+        self.assertFalse(os.path.exists(journal.old_log_path))
+        journal = Journal(self.dir)
+        self.assertEqual(journal.recover(), {"a": dict(cookie=1, flag=1), "b": dict(cookie=2, flag=0)})
+        self.assertEqual(journal.records, 1)
+
+    def test_recover_fast(self):
+        """ thousands of clients are recovered well within a second """
+        journal = Journal(self.dir)
+        journal.open()
+        for i in range(5000):
+            journal.append("register", str(i), host="127.0.0.1", p2port=str(i), cookie=i, expires=time.time(),
+                           flag=1, rfcs="8423-8430")
+        journal.close()
+        self.assertGreater(os.path.getsize(journal.log_path), 0)
+        start_time = time.perf_counter()
+        self.assertEqual(len(Journal(self.dir).recover()), 5000)
+        self.assertLess(time.perf_counter() - start_time, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
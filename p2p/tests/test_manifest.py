@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from p2p.client.manifest import Manifest
+
+
+class ManifestTest(unittest.TestCase):
+    """ persistent RFC catalog """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for rfc in ("8423", "8424"):
+            with open(os.path.join(self.dir, "rfc{}.txt".format(rfc)), 'wb') as f:
+                f.write(rfc.encode())
+
+    def test_load(self):
+        """ builds the manifest once and reuses it while the files are unchanged """
+        entries = Manifest(self.dir).load()
+        self.assertEqual(sorted(entries), ["8423", "8424"])
+        self.assertEqual(entries["8423"]["size"], 4)
+        self.assertEqual(entries["8423"]["offset"], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, Manifest.NAME)))
+
+        with mock.patch.object(Manifest, "_hash") as _hash:
+            manifest = Manifest(self.dir)
+            self.assertEqual(manifest.load(), entries)
+            _hash.assert_not_called()
+        self.assertEqual(manifest.file("8424"), os.path.join(self.dir, "rfc8424.txt"))
+
+    def test_write_failed(self):
+        """ a manifest that can't be saved leaves no temporary file behind, the catalog is still loaded """
+        path = os.path.join(self.dir, "cache")
+        os.mkdir(path)  # os.replace can't put a file over a directory
+        self.assertEqual(sorted(Manifest(self.dir, path).load()), ["8423", "8424"])
+        self.assertEqual(sorted(os.listdir(self.dir)), ["cache", "rfc8423.txt", "rfc8424.txt"])
+
+    def test_changed(self):
+        """ rehashes only files whose mtime or size changed and forgets removed ones """
+        Manifest(self.dir).load()
+        time.sleep(0.01)
+        with open(os.path.join(self.dir, "rfc8423.txt"), 'wb') as f:
+            f.write(b"changed")
+        os.remove(os.path.join(self.dir, "rfc8424.txt"))
+
+        entries = Manifest(self.dir).load()
+        self.assertEqual(list(entries), ["8423"])
+        self.assertEqual(entries["8423"]["sha256"], Manifest._hash(os.path.join(self.dir, "rfc8423.txt")))
+        self.assertEqual(Manifest(self.dir)._read(), entries)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,15 @@
+import time
 from p2p.proto.proto import Message, Headers, MethodTypes
 from p2p.proto.proto import ServerResponse as Response
+from p2p.proto.proto import encode_index, decode_index, encode_rfc_set, decode_rfc_set
+from p2p.proto.proto import CODECS, choose_encoding, compress, decompress
 import unittest
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # defines protocols required by P2P-DI System
 
@@ -63,6 +71,94 @@ class MessageTest(unittest.TestCase):
         self.assertEqual(str(msg), "Register<fs>P2Pv1<hs>hf1: hv1<fs>hf2: hv2<cs>Payload")
         pass
 
+    def test_v2(self):
+        """ binary P2Pv2 round trip """
+        msg = Message()
+        msg.method = MethodTypes.Register.name
+        msg.headers = {Headers.Cookie.name: 1234, Headers.ContentType.name: 'text'}
+        msg.version = Message.VERSION2
+        msg.payload = "127.0.0.1<fs>9999"
+        data = msg.to_bytes()
+        self.assertTrue(data.startswith(Message.MAGIC))
+
+        e = {
+            "method": "Register",
+            "version": "P2Pv2",
+            "headers": {
+                "Cookie": 1234,
+                "ContentType": "text"
+            },
+            "payload": "127.0.0.1<fs>9999"
+        }
+        self.assertEqual(Message().from_bytes(data).to_dict(), e)
+
+        msg.payload = b"\x00raw body<cs>"
+        self.assertEqual(Message().from_bytes(msg.to_bytes()).payload, b"\x00raw body<cs>")
+
+        # P2Pv1 messages are still understood
+        msg.version = Message.VERSION
+        msg.payload = "Payload"
+        self.assertEqual(Message().from_bytes(msg.to_bytes()).version, Message.VERSION)
+
+        with self.assertRaises(ValueError):
+            Message().from_bytes(Message.MAGIC + b"\x02")
+
+        msg.version = Message.VERSION2
+        msg.headers = {'hf1': 'hv1'}
+        with self.assertRaises(ValueError):
+            msg.to_bytes()
+
+    def test_index(self):
+        """ RFC Index encoding used by P2Pv2 """
+        index = {"127.0.0.1:1": {"8423", "8424"}, "127.0.0.1:2": set()}
+        self.assertEqual(decode_index(encode_index(index)), index)
+        self.assertEqual(decode_index(""), {})
+
+    def test_rfc_set(self):
+        """ Wanted header encoding of a set of RFC numbers """
+        rfcs = {"8423", "8424", "8425", "8440", "8442", "8443", "0791"}
+        self.assertEqual(encode_rfc_set(rfcs), "0791,8423-8425,8440,8442-8443")
+        self.assertEqual(decode_rfc_set(encode_rfc_set(rfcs)), rfcs)
+        self.assertEqual(decode_rfc_set(encode_rfc_set(set())), set())
+
+    def test_rfc_set_bound(self):
+        """ ranges are not expanded into more RFC numbers than the limit """
+        start_time = time.perf_counter()
+        for value in ("0-4000000000", "1-40000,40001-80000", "0-9,0-4000000000"):
+            with self.assertRaises(ValueError):
+                decode_rfc_set(value)
+        self.assertLess(time.perf_counter() - start_time, 1)
+        self.assertEqual(len(decode_rfc_set("1-10", limit=10)), 10)
+        with self.assertRaises(ValueError):
+            decode_rfc_set("1-10,12", limit=10)
+
+    def test_encoding(self):
+        """ GetRFC body codecs and their negotiation """
+        data = b"Request for Comments: 8423\n" * 100
+        for encoding in CODECS:
+            self.assertLess(len(compress(data, encoding)), len(data) / 4)
+            self.assertEqual(decompress(compress(data, encoding), encoding), data)
+        self.assertEqual(choose_encoding("br, lzma,zlib"), "lzma")
+        self.assertIsNone(choose_encoding("br"))
+        with self.assertRaises(ValueError):
+            decompress(data, "zlib")
+        with self.assertRaises(ValueError):
+            decompress(data, "br")
+
+    def test_corrupt_encoding(self):
+        """ every codec reports a corrupt or truncated body as ValueError """
+        data = b"Request for Comments: 8423\n" * 100
+        for encoding in CODECS:
+            for body in (b"garbage" * 10, compress(data, encoding)[:-10]):
+                with self.assertRaises(ValueError):
+                    decompress(body, encoding)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_corrupt_zstd(self):
+        """ zstandard's own error is a ValueError too """
+        with self.assertRaises(ValueError):
+            decompress(b"\x28\xb5\x2f\xfd" + b"garbage", "zstd")
+
 
 if __name__ == "__main__":
     unittest.main()
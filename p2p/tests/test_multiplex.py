@@ -0,0 +1,88 @@
+import socket
+import threading
+import unittest
+
+from p2p.client.multiplex import MultiplexedConnection
+from p2p.proto.proto import Message, MethodTypes, ServerResponse as Response
+from p2p.utils.app_utils import send, recv
+
+
+class MultiplexedConnectionTest(unittest.TestCase):
+    """ many requests on one connection """
+
+    def setUp(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+
+    def tearDown(self):
+        self.sock.close()
+
+    def _reverse_server(self, count):
+        """ reads count requests, then answers them in reverse order """
+        conn, _ = self.sock.accept()
+        with conn:
+            requests = [Message().from_bytes(recv(conn)) for _ in range(count)]
+            for request in reversed(requests):
+                send(conn, Response(request.payload).negotiate(request))
+
+    def _message(self, payload):
+        msg = Message()
+        msg.method = MethodTypes.GetRFC.name
+        msg.version = Message.VERSION2
+        msg.payload = payload
+        return msg
+
+    def test_out_of_order(self):
+        """ responses sent out of order reach the right request """
+        server = threading.Thread(target=self._reverse_server, args=(3,))
+        server.start()
+        channel = MultiplexedConnection(self.sock.getsockname())
+        futures = [channel.submit(self._message(rfc)) for rfc in ["8423", "8424", "8425"]]
+        self.assertEqual([f.result(timeout=5).payload for f in futures], ["8423", "8424", "8425"])
+        server.join()
+        channel.close()
+
+    def test_closed(self):
+        """ requests fail once the server went away """
+        server = threading.Thread(target=lambda: self.sock.accept()[0].close())
+        server.start()
+        channel = MultiplexedConnection(self.sock.getsockname())
+        server.join()
+        channel._reader.join(5)  # the reader saw the connection close
+        self.assertTrue(channel.closed)
+        self.assertRaises(ConnectionError, channel.submit, self._message("8423"))
+        channel.close()
+
+    def test_timeout(self):
+        """ a request the server never answers times out and is forgotten """
+        conns = []
+        server = threading.Thread(target=lambda: conns.append(self.sock.accept()[0]))
+        server.start()
+        channel = MultiplexedConnection(self.sock.getsockname(), timeout=0.1)
+        server.join()
+        self.assertRaises(TimeoutError, channel.request, self._message("8423"))
+        self.assertEqual(channel.pending, {})
+        channel.close()
+        conns[0].close()
+
+    def test_no_request_id(self):
+        """ an error response without a RequestId fails the oldest request instead of leaving it waiting """
+
+        def server():
+            conn, _ = self.sock.accept()
+            with conn:
+                recv(conn)
+                send(conn, Response("Bad Request", 400))
+                recv(conn)
+
+        thread = threading.Thread(target=server)
+        thread.start()
+        channel = MultiplexedConnection(self.sock.getsockname())
+        self.assertRaises(ValueError, channel.request, self._message("8423"), 5)
+        self.assertEqual(channel.pending, {})
+        channel.close()
+        thread.join()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from p2p.client.partial import PartialFile
+
+DATA = bytes(range(256)) * 10
+
+
+class PartialFileTest(unittest.TestCase):
+    """ resumable download state on disk """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "rfc8423.txt")
+        self.digests = [hashlib.sha256(DATA[i: i + 1000]).hexdigest() for i in range(0, len(DATA), 1000)]
+
+    def test_resume(self):
+        """ only whole verified blocks are written, and the bitmap survives a restart """
+        partial = PartialFile.create(self.path, len(DATA), 1000, self.digests)
+        self.assertEqual(partial.missing(), [(0, 999), (1000, 1999), (2000, 2559)])
+        self.assertEqual(partial.write(500, DATA[500: 2100]), 1)
+        self.assertTrue(partial.verified(1000, 1999))
+        self.assertFalse(partial.verified(500, 1500))
+        with self.assertRaises(ValueError):
+            partial.write(2000, bytes(560))
+
+        partial = PartialFile.resume(self.path)
+        self.assertEqual(partial.missing(), [(0, 999), (2000, 2559)])
+        self.assertEqual(partial.write(0, DATA[:1000]) + partial.write(2000, DATA[2000:]), 2)
+        self.assertTrue(partial.complete())
+        partial.finish()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertIsNone(PartialFile.resume(self.path))
+
+    def test_missing(self):
+        """ runs of missing blocks are merged into ranges of up to chunk_size bytes """
+        digests = [hashlib.sha256(DATA[i: i + 256]).hexdigest() for i in range(0, len(DATA), 256)]
+        partial = PartialFile.create(self.path, len(DATA), 256, digests)
+        partial.write(768, DATA[768: 1024])
+        self.assertEqual(partial.missing(600), [(0, 511), (512, 767), (1024, 1535), (1536, 2047), (2048, 2559)])
+        self.assertEqual(partial.missing(100), partial.missing())
+        self.assertEqual(partial.missing(10000), [(0, 767), (1024, 2559)])
+        partial.discard()
+        self.assertIsNone(PartialFile.resume(self.path))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_create(self):
+        with self.assertRaises(ValueError):
+            PartialFile.create(self.path, len(DATA), 1000, self.digests[:2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import socket
+import threading
+import time
+import unittest
+
+from p2p.client.pool import ConnectionPool
+from p2p.proto.proto import Message, MethodTypes
+from p2p.utils.app_utils import send, recv
+
+
+class EchoServer(object):
+    """ echoes every frame back, counts accepted connections """
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        self.accepted = []
+        self.received = 0
+        self.swallow = 0  # number of requests to read and then close the connection on without replying
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.accepted.append(conn)
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn):
+        try:
+            while True:
+                data = recv(conn)
+                if not data:
+                    return
+                self.received += 1
+                if self.swallow:
+                    self.swallow -= 1
+                    conn.shutdown(socket.SHUT_RDWR)
+                    conn.close()
+                    return
+                send(conn, data)
+        except OSError:
+            pass
+
+    def drop_connections(self):
+        for conn in self.accepted:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """ connection pool """
+
+    def setUp(self):
+        self.server = EchoServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_reuse(self):
+        """ consecutive requests share one connection """
+        pool = ConnectionPool()
+        for i in range(5):
+            self.assertEqual(pool.request(self.server.address, bytes([i])), bytes([i]))
+        self.assertEqual(len(self.server.accepted), 1)
+        self.assertEqual(len(pool), 1)
+        pool.close()
+        self.assertEqual(len(pool), 0)
+
+    def test_reconnect(self):
+        """ a connection closed by the server is replaced transparently """
+        pool = ConnectionPool()
+        pool.request(self.server.address, b'a')
+        self.server.drop_connections()
+        time.sleep(0.1)
+        self.assertEqual(pool.request(self.server.address, b'b'), b'b')
+        self.assertEqual(len(self.server.accepted), 2)
+        pool.close()
+
+    def test_retry_idempotent(self):
+        """ a request lost with a reused connection is sent again only if sending it twice is harmless """
+        pool = ConnectionPool()
+        for method, retried in ((MethodTypes.GetRFC, True), (MethodTypes.Register, False)):
+            msg = Message()
+            msg.method, msg.version, msg.headers, msg.payload = method.name, Message.VERSION, {}, "8423"
+            pool.request(self.server.address, msg)
+            received = self.server.received
+            self.server.swallow = 1
+            if retried:
+                self.assertEqual(pool.request(self.server.address, msg), msg.to_bytes())
+            else:
+                self.assertRaises(OSError, pool.request, self.server.address, msg)
+            self.assertEqual(self.server.received - received, 2 if retried else 1)
+        pool.close()
+
+    def test_idle_timeout(self):
+        """ connections idle for too long are not reused """
+        pool = ConnectionPool(idle_timeout=0.05)
+        pool.request(self.server.address, b'a')
+        time.sleep(0.1)
+        pool.request(self.server.address, b'b')
+        self.assertEqual(len(self.server.accepted), 2)
+        self.assertEqual(len(pool), 1)
+        pool.close()
+
+    def test_max_size(self):
+        """ the pool never keeps more than max_size idle connections """
+        other = EchoServer()
+        pool = ConnectionPool(max_size=1)
+        pool.request(self.server.address, b'a')
+        pool.request(other.address, b'b')
+        self.assertEqual(len(pool), 1)
+        pool.request(other.address, b'c')
+        self.assertEqual(len(other.accepted), 1)
+        pool.close()
+        other.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
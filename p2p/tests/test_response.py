@@ -1,5 +1,9 @@
 from p2p.proto.proto import ServerResponse as Message, ResponseStatus as Status
-from p2p.proto.proto import Headers, MethodTypes
+from p2p.proto.proto import Headers, MethodTypes, ContentTypes, RawResponse
+from p2p.utils.app_utils import send, recv
+import os
+import socket
+import tempfile
 import unittest
 
 
@@ -53,6 +57,47 @@ class ServerResponseTest(unittest.TestCase):
         self.assertEqual(str(msg), "Response<fs>P2Pv1<hs>hf1: hv1<fs>hf2: hv2<cs>Success<cs>200")
         pass
 
+    def test_raw_response(self):
+        """ raw response streamed from a file reads back as a normal response """
+        with tempfile.NamedTemporaryFile('wb', suffix='.txt', delete=False) as f:
+            f.write(b"RFC 8423 body")
+        try:
+            for response in [RawResponse(body=b"RFC 8423 body"), RawResponse(path=f.name)]:
+                a, b = socket.socketpair()
+                with a, b:
+                    send(a, response.to_frame())
+                    msg = Message().from_bytes(recv(b))
+                self.assertEqual(msg.payload, "RFC 8423 body")
+                self.assertEqual(msg.status, "200")
+                self.assertEqual(msg.headers[Headers.ContentType.name], ContentTypes.Raw.name)
+                self.assertEqual(msg.headers[Headers.ContentLength.name], "13")
+        finally:
+            os.unlink(f.name)
+
+    def test_v2(self):
+        """ P2Pv2 responses carry the status in the fixed header """
+        request = Message()
+        request.version = Message.VERSION2
+        msg = Message("Forbidden", Status.Forbidden.value).negotiate(request)
+        data = Message().from_bytes(msg.to_bytes())
+        self.assertEqual((data.version, data.payload, data.status), ("P2Pv2", "Forbidden", "403"))
+
+        request.headers[Headers.RequestId.name] = 42
+        msg = Message("Success").negotiate(request)
+        self.assertEqual(Message().from_bytes(msg.to_bytes()).headers[Headers.RequestId.name], 42)
+
+        with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+            f.write(b"RFC 8423 body")
+        try:
+            a, b = socket.socketpair()
+            with a, b:
+                send(a, RawResponse(path=f.name).negotiate(request).to_frame())
+                data = Message().from_bytes(recv(b))
+            self.assertEqual((data.payload, data.status), (b"RFC 8423 body", "200"))
+            self.assertEqual(data.headers[Headers.ContentLength.name], 13)
+        finally:
+            os.unlink(f.name)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+from collections import Counter
+
+from p2p.server.ring import HashRing
+
+
+class HashRingTest(unittest.TestCase):
+    """ consistent hashing of peer ids onto RS shards """
+
+    def test_owner(self):
+        """ peers are spread over all shards and only the ones of a removed shard move """
+        shards = [("127.0.0.1", port) for port in range(65423, 65427)]
+        ring = HashRing(shards)
+        peers = ["127.0.0.1:{}".format(port) for port in range(1000, 5000)]
+        owners = {peer: ring.owner(peer) for peer in peers}
+        counts = Counter(owners.values())
+        self.assertEqual(set(counts), set(shards))
+        self.assertGreater(min(counts.values()), len(peers) / len(shards) / 2)
+
+        smaller = HashRing(shards[:3])
+        moved = [peer for peer in peers if smaller.owner(peer) != owners[peer]]
+        self.assertEqual({owners[peer] for peer in moved}, {shards[3]})
+
+    def test_single(self):
+        ring = HashRing([("127.0.0.1", 65423), ("127.0.0.1", 65423)])
+        self.assertEqual(len(ring), 1)
+        self.assertEqual(ring.owner("127.0.0.1:1000"), ("127.0.0.1", 65423))
+        with self.assertRaises(ValueError):
+            HashRing([])
+
+
+if __name__ == "__main__":
+    unittest.main()
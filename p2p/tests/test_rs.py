@@ -1,16 +1,27 @@
+import queue
 import random
+import shutil
+import tempfile
 import time
 import socket
 import unittest
 import threading
 from p2p.server.rs import RegistrationServer
-from p2p.proto.proto import Message, MethodTypes, Headers, ServerResponse, ResponseStatus
+from p2p.server.server import Server
+from p2p.proto.proto import Message, MethodTypes, Headers, ServerResponse, ResponseStatus, decode_index
 from p2p.utils.app_constants import RS, RS_HOST, RS_PORT
 from p2p.utils.app_utils import send, recv
 
 random.seed(0)
 
 
+class FakeConn(object):
+    """ stands in for a client connection """
+
+    def getpeername(self):
+        return "127.0.0.1", 0
+
+
 class RegistrationServerTest(unittest.TestCase):
     """ Registration Server Tests"""
 
@@ -92,10 +103,22 @@ class RegistrationServerTest(unittest.TestCase):
 
     def test_start(self):
         """ starts the server and tries connecting """
+        self._start(Server.SELECT)
+
+    def test_start_selectors(self):
+        """ starts the server on the selectors event loop and tries connecting """
+        self._start(Server.SELECTORS)
+
+    def test_start_workers(self):
+        """ starts the server handling messages on a worker pool and tries connecting """
+        rs = self._start(Server.SELECTORS, workers=2)
+        self.assertEqual(rs.queue_depth, 0)
+
+    def _start(self, event_loop, workers=0):
         threads = []
         self.buffer = []
         self.fail_buffer = []
-        rs = RegistrationServer(RS_HOST, RS_PORT)
+        rs = RegistrationServer(RS_HOST, RS_PORT, event_loop, workers)
         server_thread = threading.Thread(target=rs.start, kwargs=dict(timeout=10, ))
         server_thread.start()
         time.sleep(5)
@@ -115,6 +138,139 @@ class RegistrationServerTest(unittest.TestCase):
 
         expected = "Response<fs>P2Pv1<cs>Method not allowed<cs>405"
         self.assertEqual([expected, expected, expected], self.fail_buffer)
+        return rs
+
+    def test_locate(self):
+        """ answers Locate from the holdings published by Register and KeepAlive until the TTL expires """
+        rs = RegistrationServer(RS_HOST, RS_PORT)
+
+        def request(method, port, headers):
+            return self._request(rs, method, port, headers)
+
+        cookies = {}
+        for port, holdings in ((1, "8423-8425"), (2, "8424"), (3, "")):
+            response = request(MethodTypes.Register, port, {Headers.Holdings.name: holdings})
+            cookies[port] = {Headers.Cookie.name: int(response.headers[Headers.Cookie.name])}
+        request(MethodTypes.KeepAlive, 3, dict(cookies[3], **{Headers.Holdings.name: "8425"}))
+
+        wanted = {Headers.Wanted.name: "8423-8426"}
+        located = decode_index(request(MethodTypes.Locate, 2, dict(cookies[2], **wanted)).payload)
+        self.assertEqual(located, {"8423": {"127.0.0.1:1"}, "8424": {"127.0.0.1:1"},
+                                   "8425": {"127.0.0.1:1", "127.0.0.1:3"}})
+
+        with rs.mutex:
+            rs.clients["127.0.0.1:1"].ttl = 0
+            rs._schedule("127.0.0.1:1", rs.clients["127.0.0.1:1"])
+        rs._reconcile()
+        located = decode_index(request(MethodTypes.Locate, 2, dict(cookies[2], **wanted)).payload)
+        self.assertEqual(located, {"8425": {"127.0.0.1:3"}})
+
+        request(MethodTypes.KeepAlive, 1, cookies[1])
+        located = decode_index(request(MethodTypes.Locate, 3, dict(cookies[3], **wanted)).payload)
+        self.assertEqual(located, {"8423": {"127.0.0.1:1"}, "8424": {"127.0.0.1:1", "127.0.0.1:2"},
+                                   "8425": {"127.0.0.1:1"}})
+        self.assertEqual(int(request(MethodTypes.Locate, 3, dict(cookies[1], **wanted)).status),
+                         ResponseStatus.Forbidden.value)
+
+        # ranges listing billions of RFCs are refused, without registering the client
+        huge = "0-4000000000"
+        self.assertEqual(int(request(MethodTypes.Locate, 3, dict(cookies[3], Wanted=huge)).status),
+                         ResponseStatus.BadMessage.value)
+        self.assertEqual(int(request(MethodTypes.Register, 4, {Headers.Holdings.name: huge}).status),
+                         ResponseStatus.BadMessage.value)
+        self.assertNotIn("127.0.0.1:4", rs.clients)
+
+    def test_pquery(self):
+        """ lists active peers from the cached active set, paged or sampled """
+        rs = RegistrationServer(RS_HOST, RS_PORT)
+        cookies = {}
+        for port in range(1, 6):
+            response = self._request(rs, MethodTypes.Register, port, {})
+            cookies[port] = {Headers.Cookie.name: int(response.headers[Headers.Cookie.name])}
+        self._request(rs, MethodTypes.Leave, 5, cookies[5])
+
+        def pquery(**headers):
+            payload = self._request(rs, MethodTypes.PQuery, 1, dict(cookies[1], **headers)).payload
+            return payload.split(Message.SR_FIELDS) if payload else []
+
+        everyone = ["127.0.0.1:{}".format(port) for port in range(1, 5)]
+        self.assertEqual(pquery(), everyone)
+        cached = rs._active
+        self.assertEqual(pquery(), everyone)
+        self.assertIs(rs._active, cached)  # not built again until the active set changes
+        self.assertEqual(pquery(Offset=1, Limit=2), everyone[1:3])
+        self.assertEqual(pquery(Offset=3), everyone[3:])
+        for _ in range(20):
+            sample = pquery(Sample=2)
+            self.assertEqual(len(sample), 2)
+            self.assertTrue(set(sample) <= set(everyone[1:]))  # never the client asking
+        self.assertEqual(sorted(pquery(Sample=10)), everyone[1:])
+        self.assertEqual(pquery(Sample=0), [])
+
+        for headers in (dict(Offset="x"), dict(Limit=-1), dict(Offset=-2, Limit=1), dict(Sample="two"),
+                        dict(Sample=-1)):
+            response = self._request(rs, MethodTypes.PQuery, 1, dict(cookies[1], **headers))
+            self.assertEqual(int(response.status), ResponseStatus.BadMessage.value, headers)
+
+        self._request(rs, MethodTypes.Leave, 2, cookies[2])
+        self.assertEqual(pquery(), ["127.0.0.1:1", "127.0.0.1:3", "127.0.0.1:4"])
+
+    def test_journal(self):
+        """ a restarted RS recovers its clients with their cookies and holdings from the journal """
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        rs = RegistrationServer(RS_HOST, RS_PORT, journal_dir=journal_dir)
+        rs._on_start()
+        cookies = {}
+        for port, holdings in ((1, "8423"), (2, "8424"), (3, "8425")):
+            response = self._request(rs, MethodTypes.Register, port, {Headers.Holdings.name: holdings})
+            cookies[port] = {Headers.Cookie.name: int(response.headers[Headers.Cookie.name])}
+        self._request(rs, MethodTypes.KeepAlive, 1, dict(cookies[1], **{Headers.Holdings.name: "8423,8426"}))
+        self._request(rs, MethodTypes.Leave, 3, cookies[3])
+        rs._on_stop()
+
+        rs = RegistrationServer(RS_HOST, RS_PORT, journal_dir=journal_dir)
+        rs._on_start()
+        self.addCleanup(rs._on_stop)
+        self.assertEqual(rs.active, {"127.0.0.1:1", "127.0.0.1:2"})
+        self.assertEqual(rs.clients["127.0.0.1:3"].flag, 0)
+        wanted = {Headers.Wanted.name: "8423-8426"}
+        located = decode_index(self._request(rs, MethodTypes.Locate, 2, dict(cookies[2], **wanted)).payload)
+        self.assertEqual(located, {"8423": {"127.0.0.1:1"}, "8426": {"127.0.0.1:1"}})
+        response = self._request(rs, MethodTypes.KeepAlive, 1, cookies[1])
+        self.assertEqual(int(response.status), ResponseStatus.Success.value)
+        response = self._request(rs, MethodTypes.KeepAlive, 4, cookies[1])
+        self.assertEqual(int(response.status), ResponseStatus.Forbidden.value)
+
+    def test_cluster(self):
+        """ shards sharing a secret accept each other's cookies for PQuery and Locate, not for KeepAlive """
+        home = RegistrationServer(RS_HOST, RS_PORT, secret="secret")
+        other = RegistrationServer(RS_HOST, RS_PORT + 1, secret="secret")
+        response = self._request(home, MethodTypes.Register, 1, {Headers.Holdings.name: "8423"})
+        cookie = {Headers.Cookie.name: int(response.headers[Headers.Cookie.name])}
+        self._request(other, MethodTypes.Register, 2, {Headers.Holdings.name: "8424"})
+
+        self.assertEqual(self._request(other, MethodTypes.PQuery, 1, cookie).payload, "127.0.0.1:2")
+        located = decode_index(self._request(other, MethodTypes.Locate, 1,
+                                             dict(cookie, **{Headers.Wanted.name: "8423-8424"})).payload)
+        self.assertEqual(located, {"8424": {"127.0.0.1:2"}})
+        self.assertEqual(int(self._request(other, MethodTypes.KeepAlive, 1, cookie).status),
+                         ResponseStatus.Forbidden.value)
+        self.assertEqual(int(self._request(other, MethodTypes.PQuery, 1, {Headers.Cookie.name: 1}).status),
+                         ResponseStatus.Forbidden.value)
+
+    @staticmethod
+    def _request(rs, method, port, headers):
+        """ passes a P2Pv2 request from 127.0.0.1 and p2p port to the RS, returns its response """
+        msg = Message()
+        msg.method = method.name
+        msg.version = Message.VERSION2
+        msg.headers = dict(headers)
+        msg.payload = "host{}{}".format(Message.SR_FIELDS, port)
+        conn = FakeConn()
+        rs.messages[conn] = queue.Queue()
+        rs._new_message_callback(conn, msg.to_bytes())
+        return ServerResponse().from_bytes(rs.messages[conn].get())
 
     def test_stop(self):
         """ stops the server """
@@ -0,0 +1,47 @@
+import unittest
+from collections import defaultdict
+
+from p2p.client.scheduler import Scheduler, RarestFirstScheduler, ThroughputScheduler
+
+HOLDERS = {"8423": ["a", "b", "c"], "8424": ["a"], "8425": ["b", "c"], "8426": ["a", "b", "c"], "8427": []}
+
+
+class SchedulerTest(unittest.TestCase):
+    """ peer selection strategies """
+
+    def test_in_order(self):
+        """ the first holder of every RFC, in RFC Index order """
+        scheduler = Scheduler()
+        self.assertEqual(scheduler.order(HOLDERS), ["8423", "8424", "8425", "8426"])
+        self.assertEqual(scheduler.choose("8425", HOLDERS["8425"], {"b": 5, "c": 0}), "b")
+
+    def test_rarest_first(self):
+        """ RFCs with the fewest holders first, each from the holder with the fewest requests queued """
+        scheduler = RarestFirstScheduler()
+        self.assertEqual(scheduler.order(HOLDERS), ["8424", "8425", "8423", "8426"])
+        self.assertEqual(scheduler.choose("8423", HOLDERS["8423"], {"a": 1, "b": 1, "c": 0}), "c")
+        self.assertEqual(scheduler.choose("8423", HOLDERS["8423"], {"a": 0, "b": 0, "c": 0}), "a")
+
+    def test_throughput(self):
+        """ slow peers get less work, unmeasured peers are tried """
+        scheduler = ThroughputScheduler()
+        scheduler.record_latency("a", 0.001)
+        scheduler.record_transfer("a", 100000, 0.011)
+        scheduler.record_latency("b", 0.001)
+        scheduler.record_transfer("b", 100000, 1.001)
+        self.assertAlmostEqual(scheduler.throughput["a"], 1e7)
+        self.assertEqual(scheduler.mean_size, 100000)
+
+        # a, 100 times faster than b, is chosen even with 20 requests queued at it
+        load = defaultdict(int, a=20)
+        self.assertEqual(scheduler.choose("8423", ["a", "b"], load), "a")
+        load["a"] = 200
+        self.assertEqual(scheduler.choose("8423", ["a", "b"], load), "b")
+        self.assertEqual(scheduler.choose("8423", ["b", "c"], defaultdict(int)), "c")
+
+        scheduler.record_latency("a", 0.002)
+        self.assertAlmostEqual(scheduler.latency["a"], 0.0013)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from p2p.client.store import RFCStore
+from p2p.proto.proto import decompress
+
+
+class RFCStoreTest(unittest.TestCase):
+    """ lazy RFC content store """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.paths = {}
+        for rfc in ("8423", "8424", "8425"):
+            self.paths[rfc] = os.path.join(self.dir, "rfc{}.txt".format(rfc))
+            with open(self.paths[rfc], 'wb') as f:
+                f.write(rfc.encode() * 100)
+
+    def test_lazy(self):
+        """ files are mapped on first lookup and the least recently used ones are dropped over budget """
+        store = RFCStore(budget=800)
+        for rfc, path in self.paths.items():
+            store.add_file(rfc, path)
+        self.assertEqual(store.mapped_bytes, 0)
+        self.assertEqual(sorted(store), ["8423", "8424", "8425"])
+
+        self.assertEqual(bytes(store["8423"]), b"8423" * 100)
+        self.assertEqual(bytes(store["8424"]), b"8424" * 100)
+        store["8423"]
+        self.assertEqual(bytes(store["8425"]), b"8425" * 100)
+        self.assertEqual(list(store.mapped), ["8423", "8425"])
+        self.assertEqual(store.mapped_bytes, 800)
+        self.assertEqual(store.path("8424"), self.paths["8424"])
+
+    def test_memory(self):
+        """ downloaded RFCs stay in memory without a spool directory """
+        store = RFCStore()
+        store.update({"1": b"one"})
+        self.assertEqual(store["1"], b"one")
+        self.assertIsNone(store.path("1"))
+        self.assertIn("1", store)
+        self.assertNotIn("2", store)
+        with self.assertRaises(KeyError):
+            store["2"]
+        # the view of a received frame is kept, not copied
+        frame = memoryview(b"headerthree")
+        store["3"] = frame[6:]
+        self.assertIs(store["3"].obj, frame.obj)
+        self.assertEqual(store["3"], b"three")
+
+    def test_spool(self):
+        """ downloaded RFCs are written to the spool directory and served from there """
+        spool = os.path.join(self.dir, "spool")
+        store = RFCStore(spool_dir=spool)
+        store["1"] = b"one"
+        self.assertEqual(store.path("1"), os.path.join(spool, "rfc1.txt"))
+        self.assertEqual(bytes(store["1"]), b"one")
+        self.assertEqual(store.memory, {})
+        del store["1"]
+        self.assertEqual(len(store), 0)
+
+    def test_compress(self):
+        """ compressed copies are cached within their budget and dropped when the RFC changes """
+        store = RFCStore(compressed_budget=40)
+        for rfc, path in self.paths.items():
+            store.add_file(rfc, path)
+        data = store.compress("8423", "zlib")
+        self.assertEqual(decompress(data, "zlib"), b"8423" * 100)
+        self.assertIs(store.compress("8423", "zlib"), data)
+        store.compress("8424", "zlib")
+        store.compress("8425", "zlib")
+        self.assertEqual(list(store.compressed), [("8424", "zlib"), ("8425", "zlib")])
+        store["8425"] = b"changed"
+        self.assertEqual(list(store.compressed), [("8424", "zlib")])
+        self.assertEqual(decompress(store.compress("8425", "zlib"), "zlib"), b"changed")
+
+    def test_compress_later(self):
+        """ without waiting, the RFC is compressed in the background and served from the cache afterwards """
+        store = RFCStore(compressed_budget=40)
+        store.add_file("8423", self.paths["8423"])
+        self.assertIsNone(store.compress("8423", "zlib", wait=False))
+        deadline = time.monotonic() + 5
+        while store.compressing and time.monotonic() < deadline:
+            time.sleep(0.01)
+        data = store.compress("8423", "zlib", wait=False)
+        self.assertEqual(decompress(data, "zlib"), b"8423" * 100)
+
+        # one too large for the budget is compressed once, never in the background again
+        store = RFCStore(compressed_budget=1)
+        store.add_file("8423", self.paths["8423"])
+        self.assertIsNotNone(store.compress("8423", "zlib"))
+        self.assertIsNone(store.compress("8423", "zlib", wait=False))
+        self.assertEqual(store.compressing, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,27 @@
 from struct import pack, unpack
+import os
 import logging
+import multiprocessing
 import socket
 import errno
 import time
 from functools import wraps
 from itertools import chain
+from collections import deque
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 MAX_BUFFER_SIZE = 8192
 
+# most bytes a single recv_into of a frame asks for, see recv
+RECV_SIZE = 256 * 1024
+
+# largest frame recv and FrameReader accept, a length prefix announcing more is not trusted with a buffer
+MAX_FRAME = 256 * 1024 * 1024
+
 
 def logger():
     _logger = logging.getLogger(__name__)
@@ -59,10 +73,178 @@ def get_true_hostname():
     return address
 
 
+class FileFrame(object):
+    """ a frame whose body is streamed from a file instead of memory """
+
+    def __init__(self, head, path, offset, count, tail=b''):
+        self.head = head
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.tail = tail
+
+    def __len__(self):
+        return len(self.head) + self.count + len(self.tail)
+
+
+def raise_fd_limit():
+    """ lets the process open as many sockets as the hard limit allows """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logger().warning("Could not raise open file limit: {}".format(e))
+
+
+def process_context():
+    """ multiprocessing context for the processes of a peer, an RS cluster or a swarm
+
+    they are spawned rather than forked, a forked process would inherit every socket of its parent and keep
+    them open after the parent closed them
+    """
+    return multiprocessing.get_context('spawn')
+
+
+class SendBuffer(object):
+    """ frames waiting to be written to a non-blocking socket, flushed whenever the socket is writable """
+
+    def __init__(self):
+        self.parts = deque()  # memoryviews of bytes and [file, offset, remaining] of FileFrames
+
+    def push(self, msg):
+        """ queues one message behind its length prefix """
+        if isinstance(msg, FileFrame):
+            self.parts.append(memoryview(pack('>I', len(msg)) + msg.head))
+            if msg.count:
+                self.parts.append([open(msg.path, 'rb'), msg.offset, msg.count])
+            if msg.tail:
+                self.parts.append(memoryview(msg.tail))
+            return
+        if not isinstance(msg, (bytes, bytearray, memoryview)):
+            msg = msg.to_bytes()
+        if len(msg) <= MAX_BUFFER_SIZE:
+            # one segment for small frames
+            self.parts.append(memoryview(pack('>I', len(msg)) + msg))
+        else:
+            self.parts.append(memoryview(pack('>I', len(msg))))
+            self.parts.append(memoryview(msg))
+
+    def flush(self, sock):
+        """ writes until the socket would block, returns True once everything is written """
+        while self.parts:
+            part = self.parts[0]
+            try:
+                if isinstance(part, memoryview):
+                    sent = sock.send(part)
+                    if sent < len(part):
+                        self.parts[0] = part[sent:]
+                        return False
+                else:
+                    sent = self._send_file(sock, *part)
+                    part[1] += sent
+                    part[2] -= sent
+                    if part[2]:
+                        continue
+                    part[0].close()
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.parts.popleft()
+        return True
+
+    def close(self):
+        """ drops whatever was not written yet """
+        for part in self.parts:
+            if not isinstance(part, memoryview):
+                part[0].close()
+        self.parts.clear()
+
+    def __len__(self):
+        return len(self.parts)
+
+    @staticmethod
+    def _send_file(sock, f, offset, remaining):
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset, remaining)
+        else:
+            f.seek(offset)
+            data = f.read(min(remaining, MAX_BUFFER_SIZE))
+            sent = sock.send(data) if data else 0
+        if not sent:
+            raise EOFError("{} truncated while sending".format(f.name))
+        return sent
+
+
+class FrameReader(object):
+    """ reassembles length prefixed frames arriving in pieces on a non-blocking socket
+
+    like recv, every frame is received in place into a buffer of its own, recv_size bytes at a time at most
+    """
+
+    def __init__(self, recv_size=RECV_SIZE, max_frame=MAX_FRAME):
+        self.recv_size = recv_size
+        self.max_frame = max_frame
+        self.header = bytearray(4)
+        self.body = None  # bytearray of the announced length once the header is complete
+        self.filled = 0
+
+    def read(self, sock):
+        """ reads what has arrived, returns a memoryview of a complete frame, None if it is still incomplete and
+        b'' once the peer closed the connection. Raises FrameTooLargeError for a frame over max_frame bytes """
+        while True:
+            buf = self.header if self.body is None else self.body
+            if self.filled == len(buf):
+                if self.body is not None:
+                    frame = memoryview(self.body)
+                    self.body, self.filled = None, 0
+                    return frame
+                self.body, self.filled = bytearray(_frame_length(self.header, self.max_frame)), 0
+                continue
+            try:
+                received = sock.recv_into(memoryview(buf)[self.filled:], min(len(buf) - self.filled, self.recv_size))
+            except (BlockingIOError, InterruptedError):
+                return None
+            if not received:
+                return b''
+            self.filled += received
+
+
 def send(sock, msg):
-    if not isinstance(msg, bytes):
+    if isinstance(msg, FileFrame):
+        return _send_file(sock, msg)
+    if not isinstance(msg, (bytes, bytearray, memoryview)):
         msg = msg.to_bytes()
-    msg = pack('>I', len(msg)) + msg
+    _send(sock, pack('>I', len(msg)) + msg)
+
+
+def _send_file(sock, frame):
+    """ sends the file part of the frame with os.sendfile, without copying it into user space """
+    _send(sock, pack('>I', len(frame)) + frame.head)
+    with open(frame.path, 'rb') as f:
+        offset, remaining = frame.offset, frame.count
+        while remaining:
+            try:
+                if hasattr(os, 'sendfile'):
+                    sent = os.sendfile(sock.fileno(), f.fileno(), offset, remaining)
+                else:
+                    f.seek(offset)
+                    sent = sock.send(f.read(min(remaining, MAX_BUFFER_SIZE)))
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    time.sleep(0.1)
+                    continue
+                raise e
+            if not sent:
+                raise EOFError("{} truncated while sending".format(frame.path))
+            offset += sent
+            remaining -= sent
+    _send(sock, frame.tail)
+
+
+def _send(sock, msg):
+    msg = memoryview(msg)  # slices of a memoryview don't copy the message
     sent = 0
     while sent != len(msg):
         upto = min(len(msg) - sent, MAX_BUFFER_SIZE)
@@ -75,30 +257,36 @@ def send(sock, msg):
             raise e
 
 
-def recv(sock):
-    raw_len = _recv(sock, 4)
-    if not raw_len:
+def recv(sock, recv_size=RECV_SIZE, max_frame=MAX_FRAME):
+    """ reads one frame, returns a memoryview of it, empty if the connection was closed
+
+    the frame is received in place into one buffer of the announced length, recv_size bytes at a time at most.
+    Raises FrameTooLargeError when more than max_frame bytes are announced, the connection is of no use after that
+    """
+    raw_len = _recv(sock, 4, recv_size)
+    if len(raw_len) < 4:
         return b''
-    msg_len = unpack('>I', raw_len)[0]
-    data = _recv(sock, msg_len)
-    return data
+    return _recv(sock, _frame_length(raw_len, max_frame), recv_size)
 
 
-def _recv(sock, msg_len):
-    data = b''
-    while len(data) < msg_len:
-        packet = sock.recv(_get_buffer_size(msg_len, len(data)))
-        if not packet:
-            return data
-        data += packet
-    return data
+def _frame_length(prefix, max_frame):
+    """ length announced by the 4 byte prefix of a frame """
+    length = unpack('>I', prefix)[0]
+    if length > max_frame:
+        raise FrameTooLargeError("Frame of {} bytes is larger than {}".format(length, max_frame))
+    return length
 
 
-def _get_buffer_size(msg_length, buffer_length):
-    remaining_msg_size = msg_length - buffer_length
-    if remaining_msg_size > MAX_BUFFER_SIZE:
-        return MAX_BUFFER_SIZE
-    return remaining_msg_size
+def _recv(sock, msg_len, recv_size=RECV_SIZE):
+    """ memoryview of the next msg_len bytes, shorter if the connection was closed before they all arrived """
+    view = memoryview(bytearray(msg_len))
+    received = 0
+    while received < msg_len:
+        n = sock.recv_into(view[received:], min(msg_len - received, recv_size))
+        if not n:
+            break
+        received += n
+    return view[:received]
 
 
 class ForbiddenError(Exception):
@@ -111,3 +299,7 @@ class CriticalError(Exception):
 
 class NotFoundError(Exception):
     pass
+
+
+class FrameTooLargeError(ConnectionError):
+    pass